@@ -0,0 +1,112 @@
+import json
+import time
+import numpy as np
+from harness import measure
+from orderbook_aggregator import OrderBookAggregator, ENGINES
+from book_view import BookView
+from strategy_engine import ImbalanceStrategy
+from analytics import OrderFlowAnalytics
+
+SIZES = (1_000, 10_000, 100_000)
+QUICK_SIZES = (1_000, 10_000)
+# (tick_size, depth) requested by the dashboards: data_fetcher, strategy,
+# default /snapshot and the z-slider heatmap
+SNAPSHOT_PARAMS = ((20, 500), (1, 10), (10, 1000), (1, 1000))
+MID_PRICE = 60000.0
+PRICE_TICK = 0.1
+
+def build_book(engine, levels, seed=0):
+    # `levels` levels per side on every other tick around MID_PRICE, so
+    # inserts have free ticks both near and away from the touch
+    rng = np.random.default_rng(seed)
+    order_book = ENGINES[engine]()
+    offsets = np.arange(1, levels + 1) * 2
+    order_book.apply_levels('bid', np.round(MID_PRICE - offsets * PRICE_TICK, 1), rng.uniform(0.001, 5, levels))
+    order_book.apply_levels('ask', np.round(MID_PRICE + offsets * PRICE_TICK, 1), rng.uniform(0.001, 5, levels))
+    return order_book
+
+def update_mixes(levels, count=1000, seed=1):
+    # Prices for each update pattern: existing levels are on even tick
+    # offsets from the mid, free ones on odd offsets; "near" is within 50
+    # ticks of the touch, "away" beyond the first 10% of the book
+    rng = np.random.default_rng(seed)
+    near = rng.integers(1, 25, count)
+    away = rng.integers(max(levels // 10, 26), levels, count)
+    price = lambda offsets: np.round(MID_PRICE - offsets * PRICE_TICK, 1).tolist()
+    return {
+        'modify_near': price(near * 2),
+        'modify_away': price(away * 2),
+        'insert_delete_near': price(near * 2 + 1),
+        'insert_delete_away': price(away * 2 + 1),
+    }
+
+def diff_message(rng, update_id, changes=20):
+    offsets = rng.integers(1, 200, changes)
+    sides = rng.random(changes) < 0.5
+    levels = lambda mask, sign: [[f"{MID_PRICE + sign * o * PRICE_TICK:.1f}", f"{a:.3f}"]
+                                 for o, a in zip(offsets[mask], rng.uniform(0, 5, mask.sum()))]
+    return {'e': 'depthUpdate', 'E': int(time.time() * 1000), 'U': update_id, 'u': update_id, 'pu': update_id - 1,
+            'b': levels(sides, -2), 'a': levels(~sides, 2)}
+
+def bench_updates(engine, levels, results, number):
+    order_book = build_book(engine, levels)
+    for name, prices in update_mixes(levels, number).items():
+        amounts = [1.5] * len(prices)
+        if name.startswith('modify'):
+            updates = iter(zip(prices * 10, amounts * 10))
+            fn = lambda: order_book.update('bid', *next(updates))
+        else:
+            # An insert then its delete, so the book size stays constant
+            updates = iter([(p, a) for price, amount in zip(prices, amounts) for p, a in ((price, amount), (price, 0.0))] * 10)
+            fn = lambda: order_book.update('bid', *next(updates))
+        results[f'book.update.{name}.{engine}.{levels}'] = measure(fn, number=len(prices), repeat=5)
+
+    rng = np.random.default_rng(2)
+    batch_prices = np.round(MID_PRICE - rng.integers(1, 2 * levels, 100) * PRICE_TICK, 1)
+    batch_amounts = np.where(rng.random(100) < 0.3, 0.0, rng.uniform(0.001, 5, 100))
+    results[f'book.apply_levels.100.{engine}.{levels}'] = measure(
+        lambda: order_book.apply_levels('bid', batch_prices, batch_amounts), number=200, repeat=5)
+
+    # First request of a tick size on a freshly published view, which
+    # aggregates the levels; later requests reuse the view's buckets
+    views = [None]
+    fresh_view = lambda: views.__setitem__(0, BookView.from_book(order_book))
+    for tick_size, depth in SNAPSHOT_PARAMS:
+        results[f'view.get_levels.first.{tick_size}.{depth}.{engine}.{levels}'] = measure(
+            lambda: views[0].get_levels(tick_size, depth), number=1, repeat=20, setup=fresh_view)
+
+def bench_aggregator(engine, levels, results, number):
+    aggregator = OrderBookAggregator(engine=engine)
+    aggregator.order_book = build_book(engine, levels)
+    rng = np.random.default_rng(3)
+    messages = [json.loads(json.dumps(diff_message(rng, 1000 + i))) for i in range(number)]
+    feed = iter(messages * 10)
+    results[f'aggregator.process_message.{engine}.{levels}'] = measure(
+        lambda: aggregator.process_message(next(feed)), number=number, repeat=5)
+    results[f'aggregator.publish.{engine}.{levels}'] = measure(lambda: aggregator.publish(force=True), number=20, repeat=5)
+    aggregator.publish(force=True)
+    for tick_size, depth in SNAPSHOT_PARAMS:
+        results[f'aggregator.get_last_snapshot.{tick_size}.{depth}.{engine}.{levels}'] = measure(
+            lambda: aggregator.get_last_snapshot(0, tick_size, depth), number=20, repeat=5)
+
+def bench_listeners(engine, levels, results, number):
+    # Per batch cost of the diff listeners run after every applied message
+    aggregator = OrderBookAggregator(engine=engine)
+    aggregator.order_book = build_book(engine, levels)
+    aggregator.sync.on_snapshot(0)
+    diffs = [diff_message(np.random.default_rng(4), 1)]
+    strategy = ImbalanceStrategy(aggregator)
+    analytics = OrderFlowAnalytics(aggregator)
+    results[f'listener.strategy.{engine}.{levels}'] = measure(lambda: strategy.on_diffs(diffs), number=number, repeat=5)
+    results[f'listener.analytics.{engine}.{levels}'] = measure(lambda: analytics.on_diffs(diffs), number=number, repeat=5)
+
+def run(quick=False):
+    results = {}
+    number = 200 if quick else 1000
+    for levels in (QUICK_SIZES if quick else SIZES):
+        for engine in ENGINES:
+            print(f"order book: {engine} engine, {levels} levels per side")
+            bench_updates(engine, levels, results, number)
+            bench_aggregator(engine, levels, results, number)
+            bench_listeners(engine, levels, results, number)
+    return results
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import time
+import aiohttp
+from aiohttp import web
+from harness import percentiles
+from bench_book import build_book
+
+# The API is served in-process from a book filled by build_book, without
+# any exchange connection, exchange info lookup or checkpoint
+os.environ['SYMBOLS'] = 'BTCUSDT'
+os.environ['SHARDS'] = '0'
+os.environ['CHECKPOINT_DIR'] = ''
+import app
+import snapshot_codec
+
+PRICE_TICKS = {'BTCUSDT': 0.1}
+
+ENDPOINTS = (
+    ('snapshot.json.20.500', '/snapshot/20/500', {}),
+    ('snapshot.json.1.10', '/snapshot/1/10', {}),
+    ('snapshot.json.10.1000', '/snapshot/10/1000', {}),
+    ('snapshot.binary.20.500', '/snapshot/20/500', {'Accept': snapshot_codec.CONTENT_TYPE}),
+    ('imbalance.10000', '/imbalance/10000', {}),
+    ('cumulative_volume.100', '/cumulative_volume/100', {}),
+    ('spread', '/spread', {}),
+    ('lag', '/lag', {}),
+)
+CLIENTS = (1, 16, 64)
+QUICK_CLIENTS = (1, 16)
+
+async def client(session, url, headers, deadline, latencies):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter_ns()
+        async with session.get(url, headers=headers) as response:
+            await response.read()
+            response.raise_for_status()
+        latencies.append((time.perf_counter_ns() - start) / 1000)
+
+async def load(base_url, path, headers, clients, duration):
+    # `clients` concurrent connections each issuing requests back to back
+    # for `duration` seconds
+    latencies = []
+    connector = aiohttp.TCPConnector(limit=clients)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async with session.get(base_url + path, headers=headers) as response:
+            await response.read()
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[client(session, base_url + path, headers, deadline, latencies) for _ in range(clients)])
+    return {**percentiles(latencies), 'requests_per_s': len(latencies) / duration, 'clients': clients}
+
+async def serve_and_load(levels, engine, duration, clients_list, results):
+    http_app = app.create_app(PRICE_TICKS)
+    aggregator = app.order_book_aggregator
+    aggregator.order_book = build_book(engine, levels)
+    aggregator.publish(force=True)
+    runner = web.AppRunner(http_app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0, backlog=1024)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        for name, path, headers in ENDPOINTS:
+            for clients in clients_list:
+                results[f'http.{name}.{engine}.{levels}.c{clients}'] = await load(
+                    f"http://127.0.0.1:{port}", path, headers, clients, duration)
+    finally:
+        await runner.cleanup()
+
+def run(quick=False):
+    # Client and server share one event loop, so latencies include the
+    # client's own overhead; compare runs against each other, not against
+    # numbers measured with an external load generator
+    results = {}
+    duration = 0.5 if quick else 3
+    for levels in ((10_000,) if quick else (1_000, 10_000, 100_000)):
+        print(f"http: {levels} levels per side")
+        asyncio.run(serve_and_load(levels, 'tree', duration, QUICK_CLIENTS if quick else CLIENTS, results))
+    return results
@@ -0,0 +1,72 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Server modules import each other by bare name
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+def measure(fn, number=1000, repeat=5, setup=None):
+    # Per-call time in µs over `repeat` runs of `number` calls; `setup` runs
+    # untimed before each run
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter_ns()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter_ns() - start) / number / 1000)
+    return {'median_us': statistics.median(runs), 'min_us': min(runs), 'number': number, 'repeat': repeat}
+
+def percentiles(samples_us):
+    samples = sorted(samples_us)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'p50_us': pick(0.50), 'p90_us': pick(0.90), 'p99_us': pick(0.99), 'max_us': samples[-1], 'count': len(samples)}
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    import numpy
+    import pandas
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'numpy': numpy.__version__,
+        'pandas': pandas.__version__,
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def save(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+# Metric compared against the baseline for each kind of result, lower is better
+KEY_METRICS = ('median_us', 'p50_us', 'p99_us')
+
+def compare(results, baseline, threshold=0.10):
+    # Returns (name, metric, baseline, current, ratio) rows and the rows
+    # slower than the baseline by more than `threshold`
+    rows = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in KEY_METRICS:
+            if metric in result and metric in baseline[name] and baseline[name][metric]:
+                rows.append((name, metric, baseline[name][metric], result[metric], result[metric] / baseline[name][metric]))
+    regressions = [row for row in rows if row[4] > 1 + threshold]
+    return rows, regressions
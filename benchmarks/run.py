@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import harness
+import bench_book
+import bench_http
+
+SUITES = {
+    'book': bench_book.run,
+    'http': bench_http.run,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the order book hot paths and the HTTP API")
+    parser.add_argument('--suite', action='append', choices=list(SUITES), help="suite to run, repeatable, all by default")
+    parser.add_argument('--quick', action='store_true', help="smaller books and shorter runs")
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'latest.json'),
+                        help="JSON file for the results")
+    parser.add_argument('--baseline', help="results file of a previous run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for suite in args.suite or SUITES:
+        results.update(SUITES[suite](quick=args.quick))
+    harness.save(results, args.output)
+    print(f"{len(results)} results written to {args.output}")
+
+    if not args.baseline:
+        for name, result in sorted(results.items()):
+            metric = 'median_us' if 'median_us' in result else 'p50_us'
+            print(f"{name:<60} {result[metric]:>12.2f} µs")
+        return
+    rows, regressions = harness.compare(results, harness.load(args.baseline), args.threshold)
+    for name, metric, before, after, ratio in rows:
+        flag = ' REGRESSION' if ratio > 1 + args.threshold else ''
+        print(f"{name:<60} {metric:<10} {before:>12.2f} -> {after:>12.2f} µs  x{ratio:.2f}{flag}")
+    print(f"{len(regressions)} regressions over {args.threshold:.0%} out of {len(rows)} compared metrics")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
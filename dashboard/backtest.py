@@ -0,0 +1,161 @@
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from storage import SnapshotStore
+
+# Offline replay of the imbalance strategy run live by
+# server/strategy_engine.py: buy with the whole balance when the imbalance
+# rises above its rolling `quantile` over the last `window` seconds, sell
+# when it falls below the 1 - quantile level, at most one trade per
+# `cooldown` seconds, trades at the best bid, fee on sells. Thresholds are
+# computed once per window for every quantile of the grid, and the trade
+# loop only visits threshold crossings, so a configuration costs a few
+# vectorised passes over the series.
+
+def imbalance_series(levels, depth=10000):
+    # Per snapshot timestamp: best bid and volume imbalance within `depth`
+    # bps of the mid, from timestamp/price/amount/side level rows such as
+    # SnapshotStore.read() or the server's /history
+    timestamps, snapshot = np.unique(levels['timestamp'].to_numpy(), return_inverse=True)
+    prices = levels['price'].to_numpy()
+    amounts = levels['amount'].to_numpy(dtype=np.float64)
+    is_ask = (levels['side'] == 'ask').to_numpy()
+
+    best_ask = np.full(len(timestamps), np.inf)
+    best_bid = np.full(len(timestamps), -np.inf)
+    np.minimum.at(best_ask, snapshot[is_ask], prices[is_ask])
+    np.maximum.at(best_bid, snapshot[~is_ask], prices[~is_ask])
+    mid_price = (best_ask + best_bid) / 2
+
+    inside = np.where(is_ask, prices <= mid_price[snapshot] * (1 + depth / 10000),
+                      prices >= mid_price[snapshot] * (1 - depth / 10000))
+    ask = np.bincount(snapshot, weights=np.where(inside & is_ask, amounts, 0), minlength=len(timestamps))
+    bid = np.bincount(snapshot, weights=np.where(inside & ~is_ask, amounts, 0), minlength=len(timestamps))
+    total = bid + ask
+    imbalance = np.divide(bid - ask, total, out=np.zeros_like(total), where=total != 0)
+
+    valid = np.isfinite(mid_price)
+    return timestamps[valid], imbalance[valid], best_bid[valid]
+
+def rolling_quantiles(timestamps, values, window, quantiles, chunk_cells=1 << 22):
+    # Quantiles of the values whose timestamp is within `window` seconds of
+    # each sample (inclusive, current sample included), linear interpolation.
+    # Windows are sorted once and every quantile is read from the sort.
+    starts = np.searchsorted(timestamps, timestamps - int(window * 1e6), side='left')
+    counts = np.arange(len(values)) - starts + 1
+    width = int(counts.max())
+    padded = np.concatenate([np.full(width - 1, np.inf), values])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width)
+    results = {q: np.empty(len(values)) for q in quantiles}
+    chunk_size = max(1, chunk_cells // width)
+    for first in range(0, len(values), chunk_size):
+        last = min(first + chunk_size, len(values))
+        block = windows[first:last].copy()
+        # Samples older than the window are pushed to the end of the sort
+        block[np.arange(width) < (width - counts[first:last])[:, None]] = np.inf
+        block.sort(axis=1)
+        rows = np.arange(last - first)
+        for q in quantiles:
+            position = q * (counts[first:last] - 1)
+            lower = position.astype(np.int64)
+            upper = np.minimum(lower + 1, counts[first:last] - 1)
+            low_values = block[rows, lower]
+            results[q][first:last] = low_values + (block[rows, upper] - low_values) * (position - lower)
+    return results
+
+def simulate(timestamps, imbalance, price, upper, lower, cooldown, fee_rate=0.0004, initial_balance=10000):
+    buys = np.flatnonzero(imbalance > upper)
+    sells = np.flatnonzero(imbalance < lower)
+    cooldown_us = int(cooldown * 1e6)
+
+    # Alternate buy / sell crossings, skipping those inside the cooldown
+    trades = []
+    index, earliest, long = -1, timestamps[0], False
+    while True:
+        candidates = sells if long else buys
+        position = max(np.searchsorted(timestamps[candidates], earliest, side='left'),
+                       np.searchsorted(candidates, index, side='right'))
+        if position == len(candidates):
+            break
+        index = candidates[position]
+        trades.append(index)
+        earliest, long = timestamps[index] + cooldown_us, not long
+
+    trades = np.array(trades, dtype=np.int64)
+    trade_prices = price[trades]
+    # Balance is entirely in cash or entirely in the asset between trades:
+    # cash after a sell, units after a buy
+    factors = np.where(np.arange(len(trades)) % 2 == 1, trade_prices * (1 - fee_rate), 1 / trade_prices)
+    holdings = initial_balance * np.cumprod(factors)
+    cash = np.concatenate([[initial_balance], np.where(np.arange(len(trades)) % 2 == 1, holdings, 0.0)])
+    units = np.concatenate([[0.0], np.where(np.arange(len(trades)) % 2 == 0, holdings, 0.0)])
+    segment = np.searchsorted(trades, np.arange(len(price)), side='right')
+    equity = cash[segment] + units[segment] * price
+
+    peak = np.maximum.accumulate(equity)
+    notional = np.where(np.arange(len(trades)) % 2 == 0, holdings * trade_prices, holdings)
+    return {
+        'trades': len(trades),
+        'pnl': float(equity[-1] - initial_balance),
+        'return': float(equity[-1] / initial_balance - 1),
+        'max_drawdown': float(np.max(1 - equity / peak)),
+        'turnover': float(notional.sum() / initial_balance),
+    }
+
+_series = None
+
+def _init_worker(timestamps, imbalance, price):
+    global _series
+    _series = (timestamps, imbalance, price)
+
+def _run_window(window, quantiles, cooldowns, fee_rate, initial_balance):
+    timestamps, imbalance, price = _series
+    levels = sorted(set(quantiles) | {1 - q for q in quantiles})
+    thresholds = rolling_quantiles(timestamps, imbalance, window, levels)
+    results = []
+    for quantile, cooldown in itertools.product(quantiles, cooldowns):
+        result = simulate(timestamps, imbalance, price, thresholds[quantile], thresholds[1 - quantile],
+                          cooldown, fee_rate, initial_balance)
+        results.append({'window': window, 'quantile': quantile, 'cooldown': cooldown, **result})
+    return results
+
+def sweep(timestamps, imbalance, price, windows, quantiles, cooldowns, fee_rate=0.0004, initial_balance=10000, workers=None):
+    # One task per window length, spread over a process pool; returns one
+    # row per (window, quantile, cooldown)
+    quantiles = [round(q, 10) for q in quantiles]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(timestamps, imbalance, price)) as pool:
+        tasks = [pool.submit(_run_window, window, quantiles, cooldowns, fee_rate, initial_balance) for window in windows]
+        rows = [row for task in tasks for row in task.result()]
+    return pd.DataFrame(rows).sort_values('pnl', ascending=False, ignore_index=True)
+
+def parse_list(text):
+    return [float(value) for value in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the imbalance strategy over recorded snapshots")
+    parser.add_argument('--data', default='data_snapshot', help="SnapshotStore directory written by data_fetcher.py")
+    parser.add_argument('--start', type=int, help="first timestamp (µs)")
+    parser.add_argument('--end', type=int, help="last timestamp (µs)")
+    parser.add_argument('--depth', type=float, default=10000, help="bps around the mid used for the imbalance")
+    parser.add_argument('--windows', type=parse_list, default=[300, 600, 1800], help="rolling windows (s)")
+    parser.add_argument('--quantiles', type=parse_list, default=[0.7, 0.75, 0.8, 0.85, 0.9, 0.95])
+    parser.add_argument('--cooldowns', type=parse_list, default=[0, 60, 300], help="seconds between trades")
+    parser.add_argument('--fee-rate', type=float, default=0.0004)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', help="CSV file for the full results")
+    args = parser.parse_args()
+
+    levels = SnapshotStore(args.data).read(args.start, args.end)
+    timestamps, imbalance, price = imbalance_series(levels, args.depth)
+    print(f"{len(timestamps)} snapshots, {len(args.windows) * len(args.quantiles) * len(args.cooldowns)} configurations")
+    results = sweep(timestamps, imbalance, price, args.windows, args.quantiles, args.cooldowns,
+                    args.fee_rate, workers=args.workers)
+    print(results.head(20).to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import threading
+import time
+
+class Refresher:
+    # One daemon thread per dashboard process calling `refresh` every
+    # `interval` seconds; the callbacks of every open tab read what it cached
+    # instead of polling the server themselves. `refresh` takes `lock` only
+    # while it updates the cache, readers take it too. `version` counts the
+    # refreshes that returned True, i.e. changed the cached data.
+    def __init__(self, refresh, interval, name="refresher"):
+        self.refresh = refresh
+        self.interval = interval
+        self.name = name
+        self.lock = threading.Lock()
+        self.starting = threading.Lock()
+        self.refreshed = threading.Event()
+        self.thread = None
+        self.version = 0
+
+    def start(self, timeout=5):
+        # Called from page loads and callbacks rather than at import, so a
+        # server forking its workers gets one refresher in each; waits up to
+        # `timeout` seconds for the first refresh so a new page is not empty
+        with self.starting:
+            if self.thread is None or not self.thread.is_alive():
+                self.refreshed.clear()
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+        self.refreshed.wait(timeout)
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            try:
+                if self.refresh():
+                    self.version += 1
+            except Exception as error:
+                print(f"{self.name}: refresh failed: {error}")
+            self.refreshed.set()
+            time.sleep(max(0, self.interval - (time.monotonic() - start)))
+
+class FigureCache:
+    # Last figure built by `build` and the data version it was built for;
+    # page loads and full redraws in between share it, per-tab settings are
+    # applied to a copy. Figures are kept as dicts so they are not converted again
+    # for every response. Called with the refresher's lock held.
+    def __init__(self, build):
+        self.build = build
+        self.key = None
+        self.value = None
+
+    def get(self, key):
+        if self.value is None or key != self.key:
+            self.value = self.build()
+            self.key = key
+        return self.value
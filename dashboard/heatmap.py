@@ -1,20 +1,79 @@
 import dash
-from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash import dcc, html, Patch, ctx, no_update
+from dash.dependencies import Input, Output, State
 import plotly.graph_objects as go
 import numpy as np
 import pandas as pd
 import datetime
+import time
+from storage import SnapshotStore
+from tiles import TilePyramid, snapshot_matrix, RECORD_INTERVAL
+from cache import Refresher, FigureCache
+
+PRICE_TICK = 20
+WINDOW_MINUTES = 100
+REFRESH_INTERVAL = RECORD_INTERVAL  # seconds, the data fetcher's snapshot interval
+PATCH_COLUMNS = 30  # columns added or dropped beyond which a tab is redrawn
+Z_RANGE = [0, 300]  # initial colour scale bounds, each tab then has its own
+
+def to_epoch_us(value):
+    # Plotly axis ranges are local wall-clock strings
+    timestamp = pd.Timestamp(value).tz_localize(datetime.datetime.now().astimezone().tzinfo)
+    return timestamp.value // 1000
+
+def to_local(times):
+    return (
+        pd.to_datetime(times, unit="us", utc=True)
+        .tz_convert(datetime.datetime.now().astimezone().tzinfo)
+        .tz_localize(None)
+    )
+
+def update_view_range(relayout_data, view_range):
+    # Zooming or a range selector button sets an explicit time range,
+    # autoscale / reset goes back to the live window (None)
+    if relayout_data.get("xaxis.autorange"):
+        return None
+    x_range = relayout_data.get("xaxis.range") or [relayout_data.get("xaxis.range[0]"), relayout_data.get("xaxis.range[1]")]
+    y_range = relayout_data.get("yaxis.range") or [relayout_data.get("yaxis.range[0]"), relayout_data.get("yaxis.range[1]")]
+    if x_range[0] is None and view_range is None:
+        return None
+    start, end, price_low, price_high = view_range or (None, None, None, None)
+    if x_range[0] is not None:
+        start, end = (to_epoch_us(value) for value in x_range)
+    if relayout_data.get("yaxis.autorange"):
+        price_low, price_high = None, None
+    elif y_range[0] is not None:
+        price_low, price_high = y_range
+    return [start, end, price_low, price_high]
+
+def with_z_range(figure, z_range):
+    # The tab's colour scale on a figure dict shared by every tab: only the
+    # heatmap trace dict is copied, not its z values
+    if not figure.get("data"):
+        return figure
+    heatmap_trace = {**figure["data"][0], "zmin": z_range[0], "zmax": z_range[1]}
+    return {**figure, "data": [heatmap_trace, *figure["data"][1:]]}
 
 class OrderbookHeatmap:
-    def __init__(self, csv_file):
+    def __init__(self, directory):
         self.app = dash.Dash(__name__)
-        self.zmin = 0
-        self.zmax = 300
-        self.csv_file = csv_file
+        self.store = SnapshotStore(directory)
+        self.pyramid = TilePyramid(self.store, f"{directory}_tiles", RECORD_INTERVAL)
+        # Rolling price x time matrix: row i is price (key_base + i) * PRICE_TICK,
+        # column j the snapshot taken at times[j] (µs)
+        self.loaded_rows = {}
+        self.times = np.empty(0, dtype=np.int64)
+        self.mid_price = np.empty(0)
+        self.matrix = np.zeros((0, 0))
+        self.key_base = 0
+        # The matrix is shared by every open tab and refreshed once per
+        # snapshot by a single thread; the live figure is built once per
+        # refresh and a tab that already has it only gets the new columns;
+        # the colour scale and zoom of each tab are applied on top of it
+        self.refresher = Refresher(self.load_new_rows, REFRESH_INTERVAL, "heatmap")
+        self.live_figures = FigureCache(self.create_heatmap)
         self.setup_layout()
         self.setup_callbacks()
-        self.df = pd.DataFrame(columns=["timestamp", "price", "amount", "side"])
 
     def setup_layout(self):
         self.app.index_string = open("dashboard/assets/index.html", "r").read()
@@ -22,6 +81,11 @@ class OrderbookHeatmap:
         self.app.layout = html.Div(
             [
                 dcc.Graph(id="heatmap", style={"height": "90vh", "width": "100vw"}),
+                # Time columns and price rows of the live figure in this tab
+                dcc.Store(id="drawn"),
+                # Visible range picked in this tab, None while following the
+                # live window
+                dcc.Store(id="view-range"),
                 html.Div(
                     [
                         dcc.RangeSlider(
@@ -30,7 +94,7 @@ class OrderbookHeatmap:
                             max=1000,
                             step=1,
                             marks={i: str(i) for i in range(0, 1001, 100)},
-                            value=[self.zmin, self.zmax],
+                            value=Z_RANGE,
                             tooltip={"placement": "bottom", "always_visible": True},
                         ),
                         html.Div(
@@ -42,7 +106,7 @@ class OrderbookHeatmap:
                 ),
                 dcc.Interval(
                     id="interval-component",
-                    interval=60*1000,  # Update every 60 seconds
+                    interval=REFRESH_INTERVAL*1000,  # Update every snapshot
                     n_intervals=0,
                 ),
             ],
@@ -59,65 +123,163 @@ class OrderbookHeatmap:
 
     def setup_callbacks(self):
         @self.app.callback(
-            Output("heatmap", "figure"),
-            [Input("interval-component", "n_intervals"), Input("z-slider", "value")],
+            [Output("heatmap", "figure"), Output("drawn", "data"), Output("view-range", "data")],
+            [Input("interval-component", "n_intervals"), Input("heatmap", "relayoutData")],
+            [State("drawn", "data"), State("view-range", "data"), State("z-slider", "value")],
         )
-        def update_heatmap(n, z_range):
-            self.zmin, self.zmax = z_range
-
-            self.df = pd.read_csv(self.csv_file)
-            self.df.columns = ["timestamp", "price", "amount", "side"]
-            
-            self.df["timestamp"] = pd.to_datetime(self.df["timestamp"], format="%Y-%m-%d %H:%M")
-            
-            recent_time_limit = datetime.datetime.now() - datetime.timedelta(minutes=100)
-            self.df = self.df[self.df["timestamp"] > recent_time_limit]
-                        
-            return self.create_heatmap()
+        def update_heatmap(n, relayout_data, drawn, view_range, z_range):
+            self.refresher.start()
+            if ctx.triggered_id == "heatmap" and relayout_data:
+                view_range = update_view_range(relayout_data, view_range)
+            if view_range is not None:
+                return with_z_range(self.create_tile_heatmap(view_range), z_range), None, view_range
+            with self.refresher.lock:
+                update = self.live_patch(drawn) if drawn else None
+                if update is not None:
+                    return (*update, None)
+                figure, drawn = self.live_figures.get(self.refresher.version)
+                return with_z_range(figure, z_range), drawn, None
 
-    def create_heatmap(self):
-        if self.df.empty:
-            return go.Figure()
-        
-
-        df = (
-            self.df.groupby(["timestamp", "price", "side"])
-            .agg({"amount": "sum"})
-            .reset_index()
+        # Moving the slider only restyles the figure already in the browser
+        @self.app.callback(
+            Output("heatmap", "figure", allow_duplicate=True),
+            Input("z-slider", "value"),
+            prevent_initial_call=True,
         )
+        def update_z_range(z_range):
+            patch = Patch()
+            patch["data"][0]["zmin"], patch["data"][0]["zmax"] = z_range
+            return patch
 
-        mid_price = (
-            df[df.side == "ask"].groupby("timestamp").price.min()
-            + df[df.side == "bid"].groupby("timestamp").price.max()
-        ) / 2
+    def load_new_rows(self):
+        # Run by the refresher: reads only the rows appended to each
+        # partition since the last refresh
+        self.store.refresh()
+        window_start = int((time.time() - WINDOW_MINUTES * 60) * 1e6)
+        parts = []
+        for partition in self.store.partitions(start=window_start):
+            columns = self.store.columns(partition)
+            loaded = self.loaded_rows.get(partition, 0)
+            if len(columns["timestamp"]) > loaded:
+                parts.append({name: np.array(column[loaded:]) for name, column in columns.items()})
+                self.loaded_rows[partition] = len(columns["timestamp"])
+        with self.refresher.lock:
+            count = len(self.times)
+            if parts:
+                self.add_columns(*(np.concatenate([part[name] for part in parts]) for name in ("timestamp", "price", "amount", "side")))
+            self.drop_columns(window_start)
+            return bool(parts) or len(self.times) != count
 
-        all_prices = np.arange(
-            np.ceil(mid_price.min() * 0.98 / 20) * 20,
-            np.floor(mid_price.max() * 1.02 / 20) * 20 + 20,
-            20,
-        )
-        timestamps = df.timestamp.unique()
-        heatmap_data = np.zeros((len(all_prices), len(timestamps)))
+    def add_columns(self, timestamps, prices, amounts, sides):
+        times, key_low, block, mid_price = snapshot_matrix(timestamps, prices, amounts, sides, PRICE_TICK)
+
+        # Grow the price axis to cover the new keys
+        key_high = key_low + block.shape[0] - 1
+        rows, width = self.matrix.shape
+        low, high = key_low, key_high
+        if width:
+            low, high = min(low, self.key_base), max(high, self.key_base + rows - 1)
+        grown = np.zeros((high - low + 1, width + len(times)))
+        grown[self.key_base - low:self.key_base - low + rows, :width] = self.matrix
+        grown[key_low - low:key_high - low + 1, width:] = block
+        self.matrix, self.key_base = grown, low
 
-        price_to_index = {price: idx for idx, price in enumerate(all_prices)}
-        timestamps_to_index = {ts: idx for idx, ts in enumerate(timestamps)}
+        self.times = np.concatenate([self.times, times])
+        self.mid_price = np.concatenate([self.mid_price, mid_price])
 
-        grouped = df.groupby(["timestamp", "price"]).amount.sum().reset_index()
+    def drop_columns(self, window_start):
+        keep = self.times > window_start
+        self.times, self.mid_price, self.matrix = self.times[keep], self.mid_price[keep], self.matrix[:, keep]
+        # Trim empty price rows at both ends so the matrix stays bounded
+        filled = np.flatnonzero(self.matrix.any(axis=1))
+        if len(filled):
+            self.matrix = self.matrix[filled[0]:filled[-1] + 1]
+            self.key_base += filled[0]
 
-        for row in grouped.itertuples(index=False):
-            if row.price in price_to_index:
-                heatmap_data[
-                    price_to_index[row.price], timestamps_to_index[row.timestamp]
-                ] = row.amount
+    def create_tile_heatmap(self, view_range):
+        # Any explicit range is drawn from the tile level matching its
+        # extent, so a week costs about as much as the last hour
+        self.pyramid.refresh()
+        tiles = self.pyramid.query(*view_range)
+        if tiles is None:
+            return go.Figure(layout=dict(uirevision=True, template="plotly_dark")).to_dict()
+        times, prices, heatmap_data, mid_price = tiles
+        return self.build_figure(times, prices, heatmap_data, mid_price).to_dict()
+
+    def price_rows(self, key_low, key_high, columns=slice(None)):
+        # Rows key_low..key_high of the cached matrix, zero-padded where the
+        # range extends past it
+        heatmap_data = np.zeros((key_high - key_low + 1, len(self.times[columns])))
+        first = max(key_low, self.key_base)
+        last = min(key_high, self.key_base + self.matrix.shape[0] - 1)
+        if first <= last:
+            heatmap_data[first - key_low:last - key_low + 1] = self.matrix[first - self.key_base:last - self.key_base + 1, columns]
+        return heatmap_data
+
+    def create_heatmap(self):
+        # Full live figure and what it shows, called with the refresher's
+        # lock held
+        if not len(self.times) or np.isnan(self.mid_price).all():
+            return go.Figure().to_dict(), None
+
+        # Displayed price range: 2% around the mid prices
+        key_low = int(np.ceil(np.nanmin(self.mid_price) * 0.98 / PRICE_TICK))
+        key_high = int(np.floor(np.nanmax(self.mid_price) * 1.02 / PRICE_TICK))
+        all_prices = np.arange(key_low, key_high + 1) * PRICE_TICK
+        figure = self.build_figure(self.times, all_prices, self.price_rows(key_low, key_high), self.mid_price)
+        drawn = {"last": int(self.times[-1]), "count": len(self.times), "key_low": key_low, "key_high": key_high}
+        return figure.to_dict(), drawn
+
+    def live_patch(self, drawn):
+        # Columns added to and dropped from the window since the tab's last
+        # update, as a Patch on the figure it has; None when the new mid
+        # prices leave its price range or the change is too large to be
+        # cheaper than a redraw
+        if not len(self.times):
+            return None
+        new = self.times > drawn["last"]
+        added = int(new.sum())
+        dropped = drawn["count"] - (len(self.times) - added)
+        if not added and not dropped:
+            return no_update, no_update
+        if dropped < 0 or added + dropped > PATCH_COLUMNS:
+            return None
+        key_low, key_high = drawn["key_low"], drawn["key_high"]
+        mid_price = self.mid_price[new]
+        mids = mid_price[~np.isnan(mid_price)]
+        # Same rounding as create_heatmap's price range
+        if len(mids) and (np.ceil(mids.min() * 0.98 / PRICE_TICK) < key_low or np.floor(mids.max() * 1.02 / PRICE_TICK) > key_high):
+            return None
+
+        # z holds one row per time column (transposed), so a column is
+        # appended or dropped with a single operation
+        patch = Patch()
+        for _ in range(dropped):
+            for trace, key in ((0, "x"), (0, "z"), (1, "x"), (1, "y")):
+                del patch["data"][trace][key][0]
+        if added:
+            timestamps = list(to_local(self.times[new]))
+            patch["data"][0]["x"].extend(timestamps)
+            patch["data"][0]["z"].extend(self.price_rows(key_low, key_high, new).T.tolist())
+            patch["data"][1]["x"].extend(timestamps)
+            patch["data"][1]["y"].extend(mid_price.tolist())
+        return patch, {**drawn, "last": int(self.times[-1]), "count": len(self.times)}
+
+    def build_figure(self, times, all_prices, heatmap_data, mid_price):
+        # Plain lists rather than arrays: plotly >= 6 turns arrays into typed
+        # array objects in to_dict(), which the Patch extend/delete of
+        # live_patch cannot act on
+        timestamps = list(to_local(times))
 
         fig = go.Figure(
             data=go.Heatmap(
-                z=heatmap_data,
+                z=heatmap_data.T.tolist(),
+                transpose=True,
                 x=timestamps,
-                y=all_prices,
+                y=np.asarray(all_prices).tolist(),
                 colorscale="Viridis",
-                zmin=self.zmin,
-                zmax=self.zmax,
+                zmin=Z_RANGE[0],
+                zmax=Z_RANGE[1],
                 showscale=False,
             )
         )
@@ -127,7 +289,7 @@ class OrderbookHeatmap:
         fig.add_trace(
             go.Scatter(
                 x=timestamps,
-                y=mid_price,
+                y=np.asarray(mid_price).tolist(),
                 mode="lines",
                 line=dict(color="red", width=2),
                 showlegend=False,
@@ -171,6 +333,18 @@ class OrderbookHeatmap:
                     },
                 },
                 tickfont=dict(color="#636D7D"),
+                # Longer ranges are served from the tile pyramid
+                rangeselector=dict(
+                    buttons=[
+                        dict(count=1, label="1h", step="hour", stepmode="backward"),
+                        dict(count=6, label="6h", step="hour", stepmode="backward"),
+                        dict(count=1, label="1d", step="day", stepmode="backward"),
+                        dict(count=7, label="1w", step="day", stepmode="backward"),
+                        dict(label="live", step="all"),
+                    ],
+                    bgcolor="#333333",
+                    font=dict(color="#E0E0E0"),
+                ),
             ),
             uirevision=True,
             template="plotly_dark",
@@ -195,6 +369,7 @@ class OrderbookHeatmap:
 
 
 # Utilisation de la classe
-csv_file = "data_snapshot.csv"
-heatmap = OrderbookHeatmap(csv_file)
-heatmap.run()
+if __name__ == "__main__":
+    directory = "data_snapshot"
+    heatmap = OrderbookHeatmap(directory)
+    heatmap.run()
@@ -0,0 +1,31 @@
+import numpy as np
+
+class RingBuffer:
+    # Preallocated columns holding the last `capacity` samples, oldest
+    # overwritten first. Samples are appended in timestamp order.
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.columns = {field: np.full(capacity, np.nan) for field in fields}
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def last_timestamp(self):
+        return int(self.timestamps[self.next - 1]) if self.count else None
+
+    def append(self, timestamp, **values):
+        self.timestamps[self.next] = timestamp
+        for field, column in self.columns.items():
+            column[self.next] = values[field]
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def since(self, timestamp=None):
+        # Samples newer than `timestamp` (all of them for None), oldest first
+        rows = (self.next - self.count + np.arange(self.count)) % self.capacity
+        if timestamp is not None:
+            rows = rows[self.timestamps[rows] > timestamp]
+        return self.timestamps[rows], {field: column[rows] for field, column in self.columns.items()}
@@ -0,0 +1,32 @@
+import struct
+import numpy as np
+import pandas as pd
+import requests
+
+# Decoder for the columnar /snapshot format, layout documented in
+# server/snapshot_codec.py
+CONTENT_TYPE = 'application/x-orderbook-columns'
+MAGIC = b'OBK1'
+HEADER = struct.Struct('<4sBBHqII')
+
+def decode_snapshot(payload):
+    magic, version, _, _, timestamp, ask_count, bid_count = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != 1:
+        raise ValueError(f"not an order book snapshot (magic={magic!r}, version={version})")
+    columns = np.frombuffer(payload, dtype='<f8', offset=HEADER.size)
+    ask_prices, ask_amounts = columns[:ask_count], columns[ask_count:2 * ask_count]
+    bid_prices = columns[2 * ask_count:2 * ask_count + bid_count]
+    bid_amounts = columns[2 * ask_count + bid_count:2 * (ask_count + bid_count)]
+    return pd.DataFrame({
+        'timestamp': timestamp,
+        'price': np.concatenate([ask_prices, bid_prices]),
+        'amount': np.concatenate([ask_amounts, bid_amounts]),
+        'side': pd.Categorical(['ask'] * ask_count + ['bid'] * bid_count, categories=['ask', 'bid']),
+    })
+
+def fetch_snapshot(url, compress=False):
+    # Same rows as the JSON /snapshot response, fetched in the binary format
+    params = {'compress': 1} if compress else None
+    response = requests.get(url, headers={'Accept': CONTENT_TYPE}, params=params, timeout=10)
+    response.raise_for_status()
+    return decode_snapshot(response.content)
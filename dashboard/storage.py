@@ -0,0 +1,100 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Append-only, time-partitioned columnar storage for recorded snapshots.
+#
+#   <root>/index.json                 {partition start: {"first", "last", "rows"}}
+#   <root>/<partition start>/<column>.bin   raw little-endian column values
+#
+# Partitions cover `partition_seconds` of epoch µs timestamps and are named
+# after their start (µs). Columns are timestamp i8 (µs), price f8, amount f4
+# and side u1 (codes into SIDES). Rows are appended in time order, so each
+# column file can be memory-mapped and range-sliced with searchsorted. The
+# index is rewritten after every append and only rows it counts are read,
+# so a reader never sees a half-written append.
+COLUMNS = {'timestamp': '<i8', 'price': '<f8', 'amount': '<f4', 'side': 'u1'}
+SIDES = ['ask', 'bid']
+
+class SnapshotStore:
+    def __init__(self, root, partition_seconds=3600):
+        self.root = root
+        self.partition_size = int(partition_seconds * 1e6)
+        os.makedirs(root, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.root, 'index.json')) as f:
+                return {int(start): entry for start, entry in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self):
+        path = os.path.join(self.root, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({str(start): entry for start, entry in sorted(self.index.items())}, f)
+        os.replace(path + '.tmp', path)
+
+    def refresh(self):
+        # Picks up partitions appended by another process
+        self.index = self._load_index()
+
+    def append(self, df):
+        if df.empty:
+            return
+        timestamps = df['timestamp'].to_numpy(dtype=np.int64)
+        columns = {
+            'timestamp': timestamps,
+            'price': df['price'].to_numpy(dtype=np.float64),
+            'amount': df['amount'].to_numpy(dtype=np.float32),
+            'side': pd.Categorical(df['side'], categories=SIDES).codes.astype(np.uint8),
+        }
+        order = np.argsort(timestamps, kind='stable')
+        partitions = timestamps[order] // self.partition_size * self.partition_size
+        for start in np.unique(partitions):
+            rows = order[partitions == start]
+            directory = os.path.join(self.root, str(start))
+            os.makedirs(directory, exist_ok=True)
+            entry = self.index.get(int(start), {'first': int(timestamps[rows[0]]), 'last': 0, 'rows': 0})
+            for name, dtype in COLUMNS.items():
+                with open(os.path.join(directory, f'{name}.bin'), 'r+b' if entry['rows'] else 'wb') as f:
+                    # Drop anything past the indexed rows, left by an interrupted append
+                    f.truncate(entry['rows'] * np.dtype(dtype).itemsize)
+                    f.seek(0, os.SEEK_END)
+                    f.write(columns[name][rows].astype(dtype).tobytes())
+            entry['last'] = int(timestamps[rows[-1]])
+            entry['rows'] += len(rows)
+            self.index[int(start)] = entry
+        self._write_index()
+
+    def partitions(self, start=None, end=None):
+        # Partition starts whose recorded rows overlap [start, end]
+        return [
+            partition for partition, entry in sorted(self.index.items())
+            if (start is None or entry['last'] >= start) and (end is None or entry['first'] <= end)
+        ]
+
+    def columns(self, partition, rows=None):
+        # Memory-mapped columns of one partition, limited to its indexed rows
+        rows = self.index[partition]['rows'] if rows is None else rows
+        directory = os.path.join(self.root, str(partition))
+        return {
+            name: np.memmap(os.path.join(directory, f'{name}.bin'), dtype=dtype, mode='r', shape=(rows,))
+            for name, dtype in COLUMNS.items()
+        }
+
+    def read(self, start=None, end=None):
+        # Rows with start <= timestamp <= end (µs), side as a categorical
+        parts = []
+        for partition in self.partitions(start, end):
+            columns = self.columns(partition)
+            first = np.searchsorted(columns['timestamp'], start, side='left') if start is not None else 0
+            last = np.searchsorted(columns['timestamp'], end, side='right') if end is not None else len(columns['timestamp'])
+            parts.append({name: np.array(column[first:last]) for name, column in columns.items()})
+        if not parts:
+            parts.append({name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()})
+        data = {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+        data['side'] = pd.Categorical.from_codes(data['side'], categories=SIDES)
+        return pd.DataFrame(data)
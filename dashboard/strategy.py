@@ -1,31 +1,42 @@
 import dash
-from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash import dcc, html, no_update
+from dash.dependencies import Input, Output, State
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
 import requests
-import datetime
-import numpy as np
+from series import RingBuffer
+from cache import Refresher, FigureCache
+
+HISTORY_SIZE = 3600  # points kept on the chart, one per second server-side
+FIELDS = ['portfolio_value', 'buy_and_hold_value']
 
 class Strategy:
-    def __init__(self, initial_balance=10000, fee_rate=0.0004):
+    # Viewer for the imbalance strategy run by the server next to the order
+    # book (server/strategy_engine.py); trading no longer depends on this
+    # page being open
+    def __init__(self, url='http://127.0.0.1:5000/strategy'):
         self.app = dash.Dash(__name__)
-        self.initial_balance = initial_balance
-        self.fee_rate = fee_rate
-        self.current_balance = initial_balance
-        self.current_btc = 0
-        self.portfolio_df = pd.DataFrame(columns=['timestamp', 'portfolio_value', 'buy_and_hold_value'])
-        self.volume_imbalance_df = pd.DataFrame(columns=['timestamp', 'volume_imbalance'])
-        self.btc_price = 0
-        self.last_trade_time = None
-        self.trade_action = None
+        self.url = url
+        # Portfolio history shared by every open tab, polled once per second
+        # by the refresher
+        self.history = RingBuffer(HISTORY_SIZE, FIELDS)
+        self.refresher = Refresher(self.refresh_history, 1, "strategy")
+        self.figures = FigureCache(lambda: self.create_portfolio_chart(self.history_since()).to_dict())
         self.setup_layout()
         self.setup_callbacks()
 
     def setup_layout(self):
-        self.app.layout = html.Div([
-            dcc.Graph(id='portfolio-chart', style={'height': '90vh', 'width': '100vw'}),
+        self.app.layout = self.serve_layout
+
+    def serve_layout(self):
+        self.refresher.start()
+        with self.refresher.lock:
+            last_sample = self.history.last_timestamp()
+            figure = self.figures.get(last_sample)
+        return html.Div([
+            dcc.Graph(id='portfolio-chart', figure=figure, style={'height': '90vh', 'width': '100vw'}),
+            dcc.Store(id='last-sample', data=last_sample),
             dcc.Interval(
                 id='interval-component',
                 interval=1000,  # Update every second
@@ -33,79 +44,45 @@ class Strategy:
             )
         ], style={'height': '100%', 'width': '100%', 'display': 'flex', 'flexDirection': 'column', 'backgroundColor': '#121212', 'margin': '0', 'padding': '0'})
 
+    def fetch_state(self, since=None):
+        params = {'since': since} if since is not None else None
+        return requests.get(self.url, params=params, timeout=5).json()
+
+    def refresh_history(self):
+        # Only the portfolio samples recorded since the last poll
+        state = self.fetch_state(self.history.last_timestamp())
+        history = state['history'] if state else None
+        if not history or not history['timestamp']:
+            return False
+        with self.refresher.lock:
+            for row in zip(history['timestamp'], *(history[field] for field in FIELDS)):
+                self.history.append(row[0], **dict(zip(FIELDS, row[1:])))
+        return True
+
+    def history_since(self, last_sample=None):
+        timestamps, columns = self.history.since(last_sample)
+        return {'timestamp': timestamps, **columns}
+
     def setup_callbacks(self):
         @self.app.callback(
-            Output('portfolio-chart', 'figure'),
-            [Input('interval-component', 'n_intervals')]
+            [Output('portfolio-chart', 'extendData'), Output('last-sample', 'data')],
+            [Input('interval-component', 'n_intervals')],
+            [State('last-sample', 'data')]
         )
-        def update_portfolio_chart(n):
-            # Récupération des valeurs de volume imbalance et du prix du BTC
-            amount_ask = requests.get('http://127.0.0.1:5000/volume_ask').json()
-            amount_bid = requests.get('http://127.0.0.1:5000/volume_bid').json()
-            
-            total_volume = amount_ask + amount_bid
-            volume_imbalance = (amount_bid - amount_ask ) / total_volume if total_volume != 0 else 0
-            snapshot = requests.get('http://127.0.0.1:5000/snapshot').json()
-            snapshot = pd.DataFrame(snapshot)
-            self.btc_price = snapshot[snapshot['side'] == 'bid']['price'].max()
-            timestamp = datetime.datetime.now().timestamp() * 1e6  # microsecondes
-
-            # Ajout des nouvelles données de volume imbalance
-            new_data = pd.DataFrame({
-                'timestamp': [timestamp],
-                'volume_imbalance': [volume_imbalance]
-            })
-            self.volume_imbalance_df = pd.concat([self.volume_imbalance_df, new_data], ignore_index=True)
-
-            # Calcul des seuils de 80% et 20% sur une fenêtre de 10 minutes
-            window_size = 10* 60 * 1000  # 10 minutes en millisecondes
-            now = datetime.datetime.now().timestamp() * 1e6
-            recent_data = self.volume_imbalance_df[self.volume_imbalance_df['timestamp'] >= (now - window_size)]
-            
-            if len(recent_data) > 0:
-                rolling_quantile_80 = recent_data['volume_imbalance'].rolling(window=len(recent_data), min_periods=1).quantile(0.80).iloc[-1]
-                rolling_quantile_20 = recent_data['volume_imbalance'].rolling(window=len(recent_data), min_periods=1).quantile(0.20).iloc[-1]
-            else:
-                rolling_quantile_80 = rolling_quantile_20 = 0  # Par défaut
-
-            # Exécution de la stratégie
-            if self.last_trade_time:
-                trade_elapsed_time = datetime.datetime.now() - self.last_trade_time
-                if trade_elapsed_time.total_seconds() < 60:
-                    return self.create_portfolio_chart()  # Pas assez de temps écoulé pour le prochain trade
-
-            if volume_imbalance > rolling_quantile_80 and self.current_btc == 0:
-                # Achat de BTC
-                amount_to_buy = self.current_balance / self.btc_price
-                self.current_btc = amount_to_buy
-                self.current_balance = 0
-                self.last_trade_time = datetime.datetime.now()
-                self.trade_action = 'buy'
-
-            elif volume_imbalance < rolling_quantile_20 and self.current_btc > 0:
-                # Vente de BTC
-                self.current_balance = self.current_btc * self.btc_price * (1 - self.fee_rate)
-                self.current_btc = 0
-                self.last_trade_time = datetime.datetime.now()
-                self.trade_action = 'sell'
-
-            # Mise à jour de la valeur du portefeuille
-            portfolio_value = self.current_balance + (self.current_btc * self.btc_price)
-            buy_and_hold_value = self.initial_balance / self.btc_price * self.btc_price
-
-            # Ajouter les données au DataFrame
-            new_data = pd.DataFrame({
-                'timestamp': [timestamp],
-                'portfolio_value': [portfolio_value],
-                'buy_and_hold_value': [buy_and_hold_value]
-            })
-            self.portfolio_df = pd.concat([self.portfolio_df, new_data], ignore_index=True)
-
-            return self.create_portfolio_chart()
-
-    def create_portfolio_chart(self):
+        def update_portfolio_chart(n, last_sample):
+            # Only the buffered samples this tab has not drawn yet
+            self.refresher.start()
+            with self.refresher.lock:
+                history = self.history_since(last_sample)
+            if not len(history['timestamp']):
+                return no_update, no_update
+            x = pd.to_datetime(history['timestamp'], unit='us')
+            update = dict(x=[x, x], y=[history['portfolio_value'], history['buy_and_hold_value']])
+            return (update, [0, 1], HISTORY_SIZE), int(history['timestamp'][-1])
+
+    def create_portfolio_chart(self, history):
         # Convertir les timestamps en format datetime pour les axes du graphique
-        self.portfolio_df['datetime'] = pd.to_datetime(self.portfolio_df['timestamp'], unit='us')
+        datetimes = pd.to_datetime(history['timestamp'], unit='us')
 
         # Création des sous-graphiques
         fig = make_subplots(
@@ -115,8 +92,8 @@ class Strategy:
 
         # Trace pour la valeur du portefeuille
         fig.add_trace(go.Scatter(
-            x=self.portfolio_df['datetime'],
-            y=self.portfolio_df['portfolio_value'],
+            x=datetimes,
+            y=history['portfolio_value'],
             mode='lines',
             line=dict(color='blue', width=2),
             name='Strategy Portfolio Value'
@@ -124,8 +101,8 @@ class Strategy:
 
         # Trace pour la valeur buy and hold
         fig.add_trace(go.Scatter(
-            x=self.portfolio_df['datetime'],
-            y=self.portfolio_df['buy_and_hold_value'],
+            x=datetimes,
+            y=history['buy_and_hold_value'],
             mode='lines',
             line=dict(color='green', width=2),
             name='Buy and Hold Value'
@@ -0,0 +1,131 @@
+import os
+import numpy as np
+import pandas as pd
+from storage import SnapshotStore, SIDES
+
+# Downsampled copies of the recorded snapshots at several time and price
+# resolutions. Each level (seconds, tick) is a SnapshotStore under
+# <root>/<seconds>s_<tick>/ holding, for every time slot, price bucket and
+# side, the mean amount over the snapshots taken in that slot. Its
+# partitions, TILE_COLUMNS slots wide, are the time tiles a view opens.
+# A slot is written once the source has a later snapshot, so coarse levels
+# lag the recording by up to one slot.
+RECORD_INTERVAL = 60  # seconds between the snapshots DataFetcher records
+COARSE_RESOLUTIONS = (10, 60, 900, 3600)
+PRICE_TICKS = (20, 100, 500)
+TILE_COLUMNS = 1024
+# Largest matrix sent to the browser
+MAX_COLUMNS = 1500
+MAX_ROWS = 800
+
+def snapshot_matrix(timestamps, prices, amounts, sides, tick, key_low=None, key_high=None):
+    # Price x time matrix of amounts summed per price bucket (both sides),
+    # one column per distinct timestamp, rows key_low..key_high; also returns
+    # the mid price of every column
+    times, columns = np.unique(timestamps, return_inverse=True)
+    keys = np.round(prices / tick).astype(np.int64)
+    key_low = keys.min() if key_low is None else key_low
+    key_high = keys.max() if key_high is None else key_high
+    inside = (keys >= key_low) & (keys <= key_high)
+    rows = key_high - key_low + 1
+    matrix = np.bincount(
+        (keys[inside] - key_low) * len(times) + columns[inside], weights=amounts[inside], minlength=rows * len(times)
+    ).reshape(rows, len(times))
+
+    best_ask = np.full(len(times), np.inf)
+    best_bid = np.full(len(times), -np.inf)
+    np.minimum.at(best_ask, columns[sides == 0], prices[sides == 0])
+    np.maximum.at(best_bid, columns[sides == 1], prices[sides == 1])
+    mid_price = np.where(np.isfinite(best_ask) & np.isfinite(best_bid), (best_ask + best_bid) / 2, np.nan)
+    return times, key_low, matrix, mid_price
+
+def time_resolutions(record_interval):
+    # Slot sizes (seconds) from the recording interval up; a finer slot holds
+    # at most one snapshot and would only copy the finest level
+    return tuple(sorted({record_interval, *(seconds for seconds in COARSE_RESOLUTIONS if seconds > record_interval)}))
+
+def downsample(df, slot_size, tick):
+    timestamps = df['timestamp'].to_numpy()
+    slots = timestamps // slot_size
+    # Snapshots taken in each slot, to average amounts over
+    snapshot_slots, snapshot_counts = np.unique(np.unique(timestamps) // slot_size, return_counts=True)
+    keys = np.round(df['price'].to_numpy() / tick).astype(np.int64)
+    groups, inverse = np.unique(
+        np.stack([slots, keys, df['side'].cat.codes.to_numpy().astype(np.int64)]), axis=1, return_inverse=True
+    )
+    sums = np.bincount(inverse.ravel(), weights=df['amount'].to_numpy(), minlength=groups.shape[1])
+    return pd.DataFrame({
+        'timestamp': groups[0] * slot_size,
+        'price': (groups[1] * tick).astype(np.float64),
+        'amount': sums / snapshot_counts[np.searchsorted(snapshot_slots, groups[0])],
+        'side': pd.Categorical.from_codes(groups[2], categories=SIDES),
+    })
+
+class TilePyramid:
+    def __init__(self, source, root, record_interval=RECORD_INTERVAL, price_ticks=PRICE_TICKS):
+        self.source = source
+        self.time_resolutions = time_resolutions(record_interval)
+        self.price_ticks = sorted(price_ticks)
+        self.levels = {
+            (seconds, tick): SnapshotStore(os.path.join(root, f'{seconds}s_{tick}'), partition_seconds=seconds * TILE_COLUMNS)
+            for seconds in self.time_resolutions for tick in self.price_ticks
+        }
+
+    def refresh(self):
+        for store in self.levels.values():
+            store.refresh()
+
+    def cursor(self, level):
+        # Start of the first slot not written yet, None for an empty level
+        store = self.levels[level]
+        if not store.index:
+            return None
+        return max(entry['last'] for entry in store.index.values()) + int(level[0] * 1e6)
+
+    def update(self):
+        # Appends the slots completed since the last update to every level;
+        # the source rows they need are read once
+        self.source.refresh()
+        if not self.source.index:
+            return
+        latest = max(entry['last'] for entry in self.source.index.values())
+        cursors = {level: self.cursor(level) for level in self.levels}
+        start = None if None in cursors.values() else min(cursors.values())
+        df = self.source.read(start, latest - 1)
+        timestamps = df['timestamp'].to_numpy()
+        for (seconds, tick), store in self.levels.items():
+            slot_size = int(seconds * 1e6)
+            end = latest // slot_size * slot_size
+            cursor = cursors[(seconds, tick)]
+            rows = (timestamps < end) if cursor is None else (timestamps >= cursor) & (timestamps < end)
+            if rows.any():
+                store.append(downsample(df[rows], slot_size, tick))
+
+    def query(self, start, end, price_low=None, price_high=None, max_columns=MAX_COLUMNS, max_rows=MAX_ROWS):
+        # Matrix for [start, end] (µs) at the finest level fitting in
+        # max_columns x max_rows; without a price range, 2% around the mids
+        seconds = next(
+            (seconds for seconds in self.time_resolutions if (end - start) / (seconds * 1e6) <= max_columns),
+            self.time_resolutions[-1],
+        )
+        if price_low is None or price_high is None:
+            df = self.levels[(seconds, self.price_ticks[-1])].read(start, end)
+            if df.empty:
+                return None
+            mid_price = snapshot_matrix(*self._columns(df), self.price_ticks[-1])[3]
+            price_low, price_high = np.nanmin(mid_price) * 0.98, np.nanmax(mid_price) * 1.02
+        tick = next(
+            (tick for tick in self.price_ticks if (price_high - price_low) / tick <= max_rows),
+            self.price_ticks[-1],
+        )
+        df = self.levels[(seconds, tick)].read(start, end)
+        if df.empty:
+            return None
+        key_low, key_high = int(np.ceil(price_low / tick)), int(np.floor(price_high / tick))
+        times, key_low, matrix, mid_price = snapshot_matrix(*self._columns(df), tick, key_low, key_high)
+        return times, np.arange(key_low, key_high + 1) * tick, matrix, mid_price
+
+    @staticmethod
+    def _columns(df):
+        return (df['timestamp'].to_numpy(), df['price'].to_numpy(), df['amount'].to_numpy(),
+                df['side'].cat.codes.to_numpy())
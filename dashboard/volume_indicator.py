@@ -1,16 +1,29 @@
 import dash
-from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash import dcc, html, no_update
+from dash.dependencies import Input, Output, State
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
+import numpy as np
 import requests
 import datetime
+from series import RingBuffer
+from cache import Refresher, FigureCache
+
+WINDOW = 5 * 60  # samples kept, one per second
+FIELDS = ['amount_ask', 'amount_bid', 'total_volume', 'volume_imbalance', 'quantile_high', 'quantile_low']
 
 class VolumeIndicator:
-    def __init__(self):
+    def __init__(self, depth=10000, server_url='http://13.60.169.158:5000'):
         self.app = dash.Dash(__name__)
-        self.df = pd.DataFrame(columns=['timestamp', 'amount_ask', 'amount_bid', 'total_volume', 'volume_imbalance'])
+        self.depth = depth  # bps around mid used for the volumes, 10000 covers the whole book
+        self.server_url = server_url
+        # Shared by every open tab: one sample per second taken by the
+        # refresher, each tab is sent the samples it has not drawn yet
+        # through extendData
+        self.series = RingBuffer(WINDOW, FIELDS)
+        self.refresher = Refresher(self.sample, 1, "volume-indicator")
+        self.figures = FigureCache(lambda: self.create_volume_chart().to_dict())
         self.setup_layout()
         self.setup_callbacks()
 
@@ -19,8 +32,18 @@ class VolumeIndicator:
     def setup_layout(self):
         self.app.index_string = open('dashboard/assets/index.html', 'r').read()
 
-        self.app.layout = html.Div([
-            dcc.Graph(id='volume-chart', style={'height': '90vh', 'width': '100vw'}),
+        self.app.layout = self.serve_layout
+
+    def serve_layout(self):
+        # Built per page load, so a new tab starts from the buffered window;
+        # tabs opened between two samples share the same figure
+        self.refresher.start()
+        with self.refresher.lock:
+            last_sample = self.series.last_timestamp()
+            figure = self.figures.get(last_sample)
+        return html.Div([
+            dcc.Graph(id='volume-chart', figure=figure, style={'height': '90vh', 'width': '100vw'}),
+            dcc.Store(id='last-sample', data=last_sample),
             dcc.Interval(
                 id='interval-component',
                 interval=1000,  # Update every second
@@ -30,37 +53,47 @@ class VolumeIndicator:
 
     def setup_callbacks(self):
         @self.app.callback(
-            Output('volume-chart', 'figure'),
-            [Input('interval-component', 'n_intervals')]
+            [Output('volume-chart', 'extendData'), Output('last-sample', 'data')],
+            [Input('interval-component', 'n_intervals')],
+            [State('last-sample', 'data')]
         )
-        def update_volume_chart(n):
-            amount_ask = requests.get('http://13.60.169.158:5000/volume_ask').json()
-            amount_bid = requests.get('http://13.60.169.158:5000/volume_bid').json()
-            
-            total_volume = amount_ask + amount_bid
-            volume_imbalance = (amount_bid - amount_ask ) / total_volume if total_volume != 0 else 0
-            
-            timestamp = datetime.datetime.now().timestamp() * 1e6  # microsecondes
-
-            new_data = pd.DataFrame({
-                'timestamp': [timestamp],
-                'amount_ask': [amount_ask],
-                'amount_bid': [amount_bid],
-                'total_volume': [total_volume],
-                'volume_imbalance': [volume_imbalance]
-            })
-            self.df = pd.concat([self.df, new_data], ignore_index=True)
-
-            # Filtrage pour les 5 dernières minutes
-            now = datetime.datetime.now()
-            five_minutes_ago = now - datetime.timedelta(minutes=5)
-            five_minutes_ago_timestamp = five_minutes_ago.timestamp() * 1e6  # microsecondes
-            self.df = self.df[self.df['timestamp'] >= five_minutes_ago_timestamp]
-
-            return self.create_volume_chart()
+        def update_volume_chart(n, last_sample):
+            self.refresher.start()
+            with self.refresher.lock:
+                timestamps, columns = self.series.since(last_sample)
+            if not len(timestamps):
+                return no_update, no_update
+            x = pd.to_datetime(timestamps, unit='us')
+            update = dict(x=[x] * len(FIELDS), y=[columns[field] for field in FIELDS])
+            return (update, list(range(len(FIELDS))), WINDOW), int(timestamps[-1])
+
+    def sample(self):
+        # Run by the refresher: one poll of the server per second whatever
+        # the number of tabs
+        volume = requests.get(f'{self.server_url}/imbalance/{self.depth}', timeout=5).json()
+        timestamp = datetime.datetime.now().timestamp() * 1e6  # microsecondes
+        volume_imbalance = volume['imbalance']
+        # Quantile lines are the thresholds of the server's strategy (whole
+        # book imbalance, rolling window kept server-side); a `since` in the
+        # future leaves out its portfolio history
+        strategy = requests.get(f'{self.server_url}/strategy', params={'since': int(timestamp)}, timeout=5).json() or {}
+        threshold = lambda key: np.nan if strategy.get(key) is None else strategy[key]
+        with self.refresher.lock:
+            self.series.append(
+                int(timestamp),
+                amount_ask=volume['ask'],
+                amount_bid=volume['bid'],
+                total_volume=volume['ask'] + volume['bid'],
+                volume_imbalance=volume_imbalance,
+                quantile_high=threshold('upper_threshold'),
+                quantile_low=threshold('lower_threshold'),
+            )
+        return True
 
     def create_volume_chart(self):
-        self.df['datetime'] = pd.to_datetime(self.df['timestamp'], unit='us')
+        # Trace order matches FIELDS, extendData appends to traces by index
+        timestamps, columns = self.series.since()
+        datetimes = pd.to_datetime(timestamps, unit='us')
 
         fig = make_subplots(
             rows=2, cols=2,
@@ -70,53 +103,52 @@ class VolumeIndicator:
         )
 
         fig.add_trace(go.Scatter(
-            x=self.df['datetime'],
-            y=self.df['amount_ask'],
+            x=datetimes,
+            y=columns['amount_ask'],
             mode='lines',
             line=dict(color='orange', width=2),
             name='Volume Ask',
         ), row=1, col=1)
 
         fig.add_trace(go.Scatter(
-            x=self.df['datetime'],
-            y=self.df['amount_bid'],
+            x=datetimes,
+            y=columns['amount_bid'],
             mode='lines',
             line=dict(color='green', width=2),
             name='Volume Bid',
         ), row=2, col=1)
 
         fig.add_trace(go.Scatter(
-            x=self.df['datetime'],
-            y=self.df['total_volume'],
+            x=datetimes,
+            y=columns['total_volume'],
             mode='lines',
             line=dict(color='blue', width=2),
             name='Total Volume',
         ), row=1, col=2)
 
         fig.add_trace(go.Scatter(
-            x=self.df['datetime'],
-            y=self.df['volume_imbalance'],
+            x=datetimes,
+            y=columns['volume_imbalance'],
             mode='lines',
             line=dict(color='red', width=2),
             name='Volume Imbalance',
         ), row=2, col=2)
 
-        # add rolling quantile q=0.75
-        q = 0.80
+        # the strategy's upper and lower thresholds
         fig.add_trace(go.Scatter(
-            x=self.df['datetime'],
-            y=self.df['volume_imbalance'].rolling(window=5*60).quantile(q),
+            x=datetimes,
+            y=columns['quantile_high'],
             mode='lines',
             line=dict(color='orange', width=1, dash='dash'),
-            name='Volume Imbalance 75%',
+            name='Upper Threshold',
         ), row=2, col=2)
 
         fig.add_trace(go.Scatter(
-            x=self.df['datetime'],
-            y=self.df['volume_imbalance'].rolling(window=5*60).quantile(1-q),
+            x=datetimes,
+            y=columns['quantile_low'],
             mode='lines',
             line=dict(color='green', width=1, dash='dash'),
-            name='Volume Imbalance 25%',
+            name='Lower Threshold',
         ), row=2, col=2)
 
         fig.update_layout(
@@ -0,0 +1,114 @@
+import time
+import numpy as np
+from book_sync import BookSync
+
+class AnalyticsBuffer:
+    # Fixed-size ring buffer of float64 samples with an int64 timestamp (µs)
+    # per row; `columns()` returns the rows newer than `since` as parallel
+    # lists, oldest first
+    def __init__(self, fields, capacity=18000):
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros((capacity, len(self.fields)))
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, values):
+        self.timestamps[self.next] = timestamp
+        self.values[self.next] = values
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def extend(self, columns):
+        for row in zip(columns['timestamp'], *(columns[field] for field in self.fields)):
+            self.append(row[0], row[1:])
+
+    def last_timestamp(self):
+        return int(self.timestamps[self.next - 1]) if self.count else None
+
+    def columns(self, since=None, fields=None, limit=None):
+        fields = self.fields if fields is None else fields
+        unknown = [field for field in fields if field not in self.fields]
+        if unknown:
+            raise ValueError(f"unknown fields {', '.join(unknown)}")
+        rows = (np.arange(self.next - self.count, self.next)) % self.capacity
+        if since is not None:
+            rows = rows[np.searchsorted(self.timestamps[rows], since, side='right'):]
+        if limit is not None:
+            rows = rows[len(rows) - min(limit, len(rows)):]
+        columns = {'timestamp': self.timestamps[rows].tolist()}
+        for field in fields:
+            columns[field] = self.values[rows, self.fields.index(field)].tolist()
+        return columns
+
+def analytics_fields(bands):
+    return (['mid', 'microprice', 'spread', 'ofi', 'ofi_best', 'top_imbalance']
+            + [f'{side}_{band}' for band in bands for side in ('bid', 'ask')]
+            + ['bid_slope', 'ask_slope'])
+
+class OrderFlowAnalytics:
+    # Order-flow signals computed on every batch of diffs applied by an
+    # OrderBookAggregator while it is live, one buffered row per batch:
+    # microprice from the touch sizes, order-flow imbalance summed over the
+    # best `top_levels` levels (Cont et al., per level: bid size added or
+    # removed at an unchanged or better price minus the same on the ask),
+    # volume imbalance of those levels, resting volume within each of `bands`
+    # bps of the mid from the book's depth index, and the book pressure
+    # slope of each side (cumulative volume per bps, least squares through
+    # the origin over the bands). `columns()` is what /analytics serves.
+    def __init__(self, aggregator, top_levels=10, bands=(1, 5, 10, 25, 50, 100), capacity=18000):
+        self.aggregator = aggregator
+        self.top_levels = top_levels
+        self.bands = bands
+        self.buffer = AnalyticsBuffer(analytics_fields(bands), capacity)
+        self.band_bps = np.array(bands, dtype=float)
+        self.previous = None
+        aggregator.diff_listeners.append(self.on_diffs)
+        aggregator.analytics = self
+
+    def top(self, side, pad):
+        # Best levels padded to `top_levels` with an empty level at `pad`
+        prices, amounts = self.aggregator.order_book.top_levels(side, self.top_levels)
+        missing = self.top_levels - len(prices)
+        return np.concatenate([prices, np.full(missing, pad)]), np.concatenate([amounts, np.zeros(missing)])
+
+    def order_flow(self, bids, asks):
+        (bid_prices, bid_amounts), (ask_prices, ask_amounts) = bids, asks
+        (old_bid_prices, old_bid_amounts), (old_ask_prices, old_ask_amounts) = self.previous
+        bid_flow = (np.where(bid_prices >= old_bid_prices, bid_amounts, 0)
+                    - np.where(bid_prices <= old_bid_prices, old_bid_amounts, 0))
+        ask_flow = (np.where(ask_prices <= old_ask_prices, ask_amounts, 0)
+                    - np.where(ask_prices >= old_ask_prices, old_ask_amounts, 0))
+        return bid_flow - ask_flow
+
+    def on_diffs(self, diffs):
+        if self.aggregator.sync.state != BookSync.LIVE:
+            self.previous = None
+            return
+        order_book = self.aggregator.order_book
+        bids, asks = self.top('bid', -np.inf), self.top('ask', np.inf)
+        (bid_prices, bid_amounts), (ask_prices, ask_amounts) = bids, asks
+        if not bid_amounts[0] or not ask_amounts[0]:
+            return
+        best_bid, best_ask = bid_prices[0], ask_prices[0]
+        microprice = (best_bid * ask_amounts[0] + best_ask * bid_amounts[0]) / (bid_amounts[0] + ask_amounts[0])
+        flow = self.order_flow(bids, asks) if self.previous is not None else np.zeros(self.top_levels)
+        self.previous = (bids, asks)
+        top_bid, top_ask = bid_amounts.sum(), ask_amounts.sum()
+
+        depth = np.array([[order_book.cumulative_volume('bid', band), order_book.cumulative_volume('ask', band)]
+                          for band in self.bands])
+        slopes = self.band_bps @ depth / (self.band_bps @ self.band_bps)
+        self.buffer.append(int(time.time() * 1e6), np.concatenate([
+            [(best_bid + best_ask) / 2, microprice, best_ask - best_bid, flow.sum(), flow[0],
+             (top_bid - top_ask) / (top_bid + top_ask)],
+            depth.ravel(),
+            slopes,
+        ]))
+
+    def columns(self, since=None, fields=None, limit=None):
+        return self.buffer.columns(since, fields, limit)
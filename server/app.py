@@ -1,39 +1,265 @@
-from flask import Flask, jsonify
-from flask_cors import CORS
-from threading import Thread
+from aiohttp import web, WSMsgType
 import asyncio
+import json
 from orderbook_aggregator import OrderBookAggregator
-import datetime
+from multi_symbol import SymbolManager
+from streaming import StreamHub
+from history import SnapshotHistory
+from strategy_engine import ImbalanceStrategy
+from analytics import OrderFlowAnalytics
+from shared_book import SharedBookWriter, ReadWorkers, segment_name
+from tick_buckets import default_tick_sizes
+from exchange_info import price_ticks, parse_price_ticks
+from book_routes import symbol_route, add_book_routes, json_response, cors, instrument
+import metrics
+import os
+import signal
+import time
 
-app = Flask(__name__)
-CORS(app)
+HOST = os.getenv("HTTP_HOST", "127.0.0.1")
+PORT = int(os.getenv("HTTP_PORT", "5000"))
+ENGINE = os.getenv("ORDERBOOK_ENGINE", "tree")
+# A single symbol is ingested in this process; with several symbols (or
+# SHARDS set) ingestion runs in SymbolManager worker processes
+SYMBOLS = os.getenv("SYMBOLS", "BTCUSDT").upper().split(",")
+SHARDS = int(os.getenv("SHARDS", "0"))
+# Exchange endpoints, pointed at server/replay.py for load tests
+WS_BASE_URL = os.getenv("WS_BASE_URL", "wss://fstream.binance.com")
+REST_BASE_URL = os.getenv("REST_BASE_URL", "https://fapi.binance.com")
+# Price tick of each symbol, "ETHUSDT:0.01,..."; symbols not listed are
+# looked up in the exchange info when the books are set up
+PRICE_TICKS = parse_price_ticks(os.getenv("PRICE_TICKS", ""))
+# Readers are served a copy of the book republished at most this often
+# (seconds), see OrderBookAggregator.publish
+PUBLISH_INTERVAL = float(os.getenv("PUBLISH_INTERVAL", "0.25"))
+# Server-side level history, see SnapshotHistory
+HISTORY_TICK_SIZE = int(os.getenv("HISTORY_TICK_SIZE", "20"))
+HISTORY_WIDTH = int(os.getenv("HISTORY_WIDTH", "1000"))
+HISTORY_CAPACITY = int(os.getenv("HISTORY_CAPACITY", "3600"))
+HISTORY_INTERVAL = float(os.getenv("HISTORY_INTERVAL", "1"))
+# Book checkpoints for warm restarts, see BookCheckpoint; off unless a directory is set
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "")
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", "5"))
+CHECKPOINT_MAX_AGE = float(os.getenv("CHECKPOINT_MAX_AGE", "600"))
+# With HTTP_WORKERS > 0 the books are mirrored into shared memory and that
+# many processes serve the BookReader endpoints (/snapshot, /volume_*,
+# /spread, ...) on READ_PORT, see shared_book.py
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", "0"))
+READ_PORT = int(os.getenv("READ_PORT", str(PORT + 1)))
+SHARED_BOOK_PREFIX = os.getenv("SHARED_BOOK_PREFIX", "orderbook")
+SHARED_BOOK_LEVELS = int(os.getenv("SHARED_BOOK_LEVELS", "100000"))
 
-order_book_aggregator = OrderBookAggregator()
+routes = web.RouteTableDef()
+# Filled by setup_books
+books = {}
+stream_hubs = {}
+histories = {}
+price_tick_of = {}
+order_book_aggregator = None
+symbol_manager = None
+read_workers = None
 
-@app.route('/snapshot/<int:tick_size>/<int:depth>', methods=['GET'])
-def snapshot(tick_size, depth):
-    current_time = datetime.datetime.now()
-    current_time = int(current_time.timestamp() * 1e6)
-    df = order_book_aggregator.get_last_snapshot(current_time, tick_size, depth)
-    return jsonify(df.to_dict(orient='records'))
+def setup_books(configured_ticks=PRICE_TICKS):
+    # Builds the books of SYMBOLS (exchange info lookup, aggregators,
+    # checkpoint restore). Not done at import: worker processes are spawned
+    # and import this module again.
+    global order_book_aggregator, symbol_manager
+    price_tick_of.update(price_ticks(SYMBOLS, REST_BASE_URL, configured_ticks))
+    if len(SYMBOLS) == 1 and not SHARDS:
+        order_book_aggregator = OrderBookAggregator(SYMBOLS[0], engine=ENGINE, price_tick=price_tick_of[SYMBOLS[0]],
+                                                    publish_interval=PUBLISH_INTERVAL,
+                                                    ws_base_url=WS_BASE_URL, rest_base_url=REST_BASE_URL,
+                                                    checkpoint_path=CHECKPOINT_DIR and os.path.join(CHECKPOINT_DIR, f"{SYMBOLS[0]}.book"),
+                                                    checkpoint_interval=CHECKPOINT_INTERVAL, checkpoint_max_age=CHECKPOINT_MAX_AGE)
+        # Shard workers attach their own strategies and analytics, see ShardIngestor
+        ImbalanceStrategy(order_book_aggregator)
+        OrderFlowAnalytics(order_book_aggregator)
+        books[SYMBOLS[0]] = order_book_aggregator
+    else:
+        symbol_manager = SymbolManager(SYMBOLS, SHARDS or None, price_ticks=dict(price_tick_of), engine=ENGINE,
+                                       publish_interval=PUBLISH_INTERVAL, ws_base_url=WS_BASE_URL, rest_base_url=REST_BASE_URL,
+                                       checkpoint_dir=CHECKPOINT_DIR or None, checkpoint_interval=CHECKPOINT_INTERVAL,
+                                       checkpoint_max_age=CHECKPOINT_MAX_AGE)
+        books.update(symbol_manager.books)
+        order_book_aggregator = books[SYMBOLS[0]]
+    stream_hubs.update((symbol, StreamHub(book)) for symbol, book in books.items())
+    histories.update(
+        (symbol, SnapshotHistory(HISTORY_TICK_SIZE, HISTORY_WIDTH, HISTORY_CAPACITY, HISTORY_INTERVAL))
+        for symbol in books
+    )
 
-@app.route('/volume_ask', methods=['GET'])
-def volume_ask():
-    return jsonify(order_book_aggregator.get_volume_ask())
+route = symbol_route(routes)
 
-@app.route('/volume_bid', methods=['GET'])
-def volume_bid():
-    return jsonify(order_book_aggregator.get_volume_bid())
+def book_of(request):
+    symbol = request.match_info.get('symbol', SYMBOLS[0]).upper()
+    if symbol not in books:
+        raise web.HTTPNotFound(text=f"unknown symbol {symbol}")
+    return books[symbol]
 
-@app.route('/spread', methods=['GET'])
-def spread():
-    return jsonify(order_book_aggregator.get_spread())
+add_book_routes(route, book_of)
+
+@route('/lag')
+async def lag(request):
+    return json_response(request, book_of(request).get_lag())
+
+@route('/history')
+async def history(request):
+    # ?start=&end= in µs, ?tick_size= a multiple of HISTORY_TICK_SIZE,
+    # ?resolution= in seconds; columns are returned as parallel lists
+    history = histories[book_of(request).symbol]
+    try:
+        start = int(request.query['start']) if 'start' in request.query else None
+        end = int(request.query['end']) if 'end' in request.query else None
+        tick_size = int(request.query.get('tick_size', history.tick_size))
+        if tick_size <= 0:
+            raise ValueError("tick_size must be positive")
+        resolution = int(float(request.query.get('resolution', 0)) * 1e6)
+        query_start = time.perf_counter()
+        df = history.query(start, end, tick_size, resolution)
+        metrics.STAGE_TIME.observe(time.perf_counter() - query_start, 'history', 'levels')
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    response = json_response(request, df.to_dict(orient='list'))
+    if request.query.get('compress') in ('1', 'true'):
+        response.enable_compression()
+    return response
+
+@route('/strategy')
+async def strategy(request):
+    # State of the imbalance strategy run on every book update, with the
+    # portfolio history newer than ?since= (µs)
+    since = request.query.get('since')
+    try:
+        state = book_of(request).get_strategy(int(since) if since else None)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return json_response(request, state)
+
+@route('/analytics')
+async def analytics(request):
+    # Order-flow signals computed on every book update, see
+    # OrderFlowAnalytics: samples newer than ?since= (µs), the latest ?limit=
+    # ones, restricted to the comma-separated ?fields=, as parallel lists
+    query = request.query
+    try:
+        since = int(query['since']) if 'since' in query else None
+        limit = int(query['limit']) if 'limit' in query else None
+        fields = query['fields'].split(',') if 'fields' in query else None
+        columns = book_of(request).get_analytics(since, fields, limit)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    response = json_response(request, columns)
+    if query.get('compress') in ('1', 'true'):
+        response.enable_compression()
+    return response
+
+@route('/stream')
+async def stream(request):
+    # Push endpoint, see StreamHub for the subscription messages
+    stream_hub = stream_hubs[book_of(request).symbol]
+    ws = web.WebSocketResponse(heartbeat=20)
+    await ws.prepare(request)
+    try:
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            try:
+                await stream_hub.handle_request(ws, json.loads(msg.data))
+            except (ValueError, TypeError) as e:
+                await ws.send_json({'type': 'error', 'error': str(e)})
+    finally:
+        stream_hub.unsubscribe_all(ws)
+    return ws
+
+def count_levels():
+    for symbol, book in books.items():
+        metrics.BOOK_LEVELS.set(len(book.view.bid_prices), symbol, 'bid')
+        metrics.BOOK_LEVELS.set(len(book.view.ask_prices), symbol, 'ask')
+
+metrics.registry.collectors.append(count_levels)
+
+@routes.get('/metrics')
+async def metrics_endpoint(request):
+    # Prometheus scrape endpoint, shard and read worker metrics included
+    remote_states = list(symbol_manager.shard_metrics.values()) if symbol_manager is not None else []
+    if read_workers is not None:
+        remote_states += read_workers.worker_metrics.values()
+    return web.Response(text=metrics.registry.render(remote_states),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+profiler = None
+MAX_PROFILE_SECONDS = 60
+
+@routes.get('/profile')
+async def profile(request):
+    # Samples the event loop thread for ?seconds= (default 10) every
+    # ?interval= seconds and returns collapsed stacks for flamegraph tools
+    global profiler
+    if profiler is not None:
+        raise web.HTTPConflict(text="a profile is already running")
+    try:
+        seconds = float(request.query.get('seconds', 10))
+        interval = float(request.query.get('interval', 0.005))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise web.HTTPBadRequest(text=f"seconds must be in (0, {MAX_PROFILE_SECONDS}]")
+    if not interval > 0:
+        raise web.HTTPBadRequest(text="interval must be positive")
+    profiler = metrics.SamplingProfiler(interval=interval)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stacks = profiler.stop()
+        profiler = None
+    return web.Response(text=stacks)
+
+def create_app(configured_ticks=PRICE_TICKS):
+    if not books:
+        setup_books(configured_ticks)
+    app = web.Application(middlewares=[instrument, cors])
+    app.add_routes(routes)
+    return app
 
 async def main():
-    websocket_task = asyncio.create_task(order_book_aggregator.connect())
-    flask_thread = Thread(target=lambda: app.run(port=5000, debug=True, use_reloader=False))
-    flask_thread.start()
-    await websocket_task
+    # The HTTP server and the WebSocket ingestion share this event loop;
+    # handlers only read the aggregator's published view. SIGTERM cancels
+    # it like Ctrl-C so the cleanup below runs (shared memory segments are
+    # unlinked, worker processes terminated)
+    global read_workers
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    runner = web.AppRunner(create_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, HOST, PORT, backlog=1024)
+    await site.start()
+    print(f"HTTP API listening on {HOST}:{PORT}")
+    tasks = [asyncio.create_task(histories[symbol].run(book)) for symbol, book in books.items()]
+    writers = []
+    if HTTP_WORKERS:
+        for symbol, book in books.items():
+            writer = SharedBookWriter(segment_name(SHARED_BOOK_PREFIX, symbol), SHARED_BOOK_LEVELS,
+                                      default_tick_sizes(price_tick_of[symbol]))
+            writers.append(writer)
+            tasks.append(asyncio.create_task(writer.run(book)))
+        read_workers = ReadWorkers(list(books), HTTP_WORKERS, SHARED_BOOK_PREFIX, HOST, READ_PORT)
+        tasks.append(asyncio.create_task(read_workers.run()))
+    try:
+        if symbol_manager is not None:
+            await symbol_manager.run()
+        else:
+            if order_book_aggregator.checkpoint is not None:
+                tasks.append(asyncio.create_task(order_book_aggregator.checkpoint.run(order_book_aggregator)))
+            await order_book_aggregator.connect()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for writer in writers:
+            writer.close()
+        await runner.cleanup()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        pass
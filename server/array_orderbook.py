@@ -0,0 +1,232 @@
+import numpy as np
+import pandas as pd
+from orderbook import BaseOrderBook
+from utils import last_occurrences
+
+SIDES = ('bid', 'ask')
+
+class ArrayOrderBook(BaseOrderBook):
+    # Prices are stored as integer ticks. Levels inside a window of `window`
+    # ticks live in contiguous arrays indexed by `tick - base`; levels outside
+    # the window go to a per-side overflow dict. The window is recentred around
+    # the mid whenever the touch drifts out of its central part.
+    def __init__(self, price_tick=0.1, window=1 << 16, recenter_margin=0.25):
+        super().__init__(price_tick)
+        self.window = window
+        self.recenter_margin = recenter_margin
+        self.base = None
+        self.amounts = {side: np.zeros(window) for side in SIDES}
+        self.overflow = {side: {} for side in SIDES}
+        self.best = {'bid': None, 'ask': None}
+
+    def clear(self):
+        self.base = None
+        self._clear_derived()
+        for side in SIDES:
+            self.amounts[side][:] = 0
+            self.overflow[side].clear()
+            self.best[side] = None
+
+    def to_tick(self, price):
+        return int(round(price * self.ticks_per_unit))
+
+    def update(self, side, price, amount):
+        tick = self.to_tick(price)
+        if self.base is None:
+            if amount == 0:
+                return
+            self.base = tick - self.window // 2
+
+        index = tick - self.base
+        if 0 <= index < self.window:
+            self._record(side, float(self.amounts[side][index]), amount)
+            self.amounts[side][index] = amount
+            self._update_best(side, tick, amount)
+            return
+
+        self._record(side, self.overflow[side].get(tick, 0), amount)
+        if amount != 0:
+            self.overflow[side][tick] = amount
+        else:
+            self.overflow[side].pop(tick, None)
+        self._update_best(side, tick, amount)
+
+    def apply_levels(self, side, prices, amounts):
+        if not len(prices):
+            return
+        ticks = np.round(prices * self.ticks_per_unit).astype(np.int64)
+        keep = last_occurrences(ticks)
+        ticks, amounts = ticks[keep], amounts[keep]
+
+        if self.base is None:
+            inserted = ticks[amounts != 0]
+            if not len(inserted):
+                return
+            self.base = int(inserted[0]) - self.window // 2
+
+        book, overflow = self.amounts[side], self.overflow[side]
+        index = ticks - self.base
+        inside = (index >= 0) & (index < self.window)
+        old_amounts = np.zeros(len(ticks))
+        old_amounts[inside] = book[index[inside]]
+        book[index[inside]] = amounts[inside]
+        for i in np.flatnonzero(~inside).tolist():
+            tick, amount = int(ticks[i]), float(amounts[i])
+            old_amounts[i] = overflow.get(tick, 0)
+            if amount != 0:
+                overflow[tick] = amount
+            else:
+                overflow.pop(tick, None)
+        self._record_many(side, old_amounts, amounts)
+
+        best = self.best[side]
+        inserted = ticks[amounts != 0]
+        if len(inserted):
+            candidate = int(inserted.max() if side == 'bid' else inserted.min())
+            if best is None or (candidate > best if side == 'bid' else candidate < best):
+                best = candidate
+        self.best[side] = best
+        if best is not None and best in set(ticks[amounts == 0].tolist()):
+            self._rescan_best(side)
+        self._maybe_recenter()
+
+    def _update_best(self, side, tick, amount):
+        best = self.best[side]
+        if amount != 0:
+            if best is None or (tick > best if side == 'bid' else tick < best):
+                self.best[side] = tick
+                self._maybe_recenter()
+        elif tick == best:
+            self._rescan_best(side)
+
+    def _rescan_best(self, side):
+        amounts, overflow = self.amounts[side], self.overflow[side]
+        nonzero = np.flatnonzero(amounts)
+        if side == 'bid':
+            candidates = [self.base + int(nonzero[-1])] if len(nonzero) else []
+            candidates += [max(overflow)] if overflow else []
+            self.best[side] = max(candidates) if candidates else None
+        else:
+            candidates = [self.base + int(nonzero[0])] if len(nonzero) else []
+            candidates += [min(overflow)] if overflow else []
+            self.best[side] = min(candidates) if candidates else None
+
+    def _maybe_recenter(self):
+        bid, ask = self.best['bid'], self.best['ask']
+        if bid is None or ask is None:
+            return
+        mid_index = (bid + ask) // 2 - self.base
+        margin = int(self.window * self.recenter_margin)
+        if margin <= mid_index < self.window - margin:
+            return
+        self.recenter((bid + ask) // 2 - self.window // 2)
+
+    def recenter(self, new_base):
+        shift = new_base - self.base
+        for side in SIDES:
+            amounts, overflow = self.amounts[side], self.overflow[side]
+            # Spill levels falling out of the new window into the overflow map
+            nonzero = np.flatnonzero(amounts)
+            outside = nonzero[(nonzero < shift) | (nonzero >= shift + self.window)]
+            for index in outside:
+                overflow[self.base + int(index)] = float(amounts[index])
+
+            shifted = np.zeros(self.window)
+            lo, hi = max(shift, 0), min(shift + self.window, self.window)
+            if lo < hi:
+                shifted[lo - shift:hi - shift] = amounts[lo:hi]
+            self.amounts[side] = shifted
+
+            # Pull overflow levels now covered by the window back into the array
+            for tick in [t for t in overflow if 0 <= t - new_base < self.window]:
+                shifted[tick - new_base] = overflow.pop(tick)
+        self.base = new_base
+
+    def levels(self, side):
+        amounts, overflow = self.amounts[side], self.overflow[side]
+        if self.base is None:
+            return np.empty(0), np.empty(0)
+        nonzero = np.flatnonzero(amounts)
+        ticks = self.base + nonzero
+        sizes = amounts[nonzero]
+        if overflow:
+            ticks = np.concatenate([ticks, np.fromiter(overflow.keys(), dtype=np.int64, count=len(overflow))])
+            sizes = np.concatenate([sizes, np.fromiter(overflow.values(), dtype=float, count=len(overflow))])
+            order = np.argsort(ticks, kind='stable')
+            ticks, sizes = ticks[order], sizes[order]
+        return ticks / self.ticks_per_unit, sizes
+
+    def top_levels(self, side, count):
+        # Best `count` levels of `side`, best first: the window is scanned
+        # outward from the touch over a span grown until enough levels are
+        # found, overflow levels beyond the window are only read if needed
+        best = self.best[side]
+        if best is None:
+            return np.empty(0), np.empty(0)
+        amounts, overflow = self.amounts[side], self.overflow[side]
+        index = best - self.base
+        if not 0 <= index < self.window:
+            prices, sizes = self.levels(side)
+            return (prices[::-1][:count], sizes[::-1][:count]) if side == 'bid' else (prices[:count], sizes[:count])
+        span = 4 * count
+        while True:
+            if side == 'bid':
+                start = max(index + 1 - span, 0)
+                found = np.flatnonzero(amounts[start:index + 1])[::-1][:count] + start
+                exhausted = start == 0
+            else:
+                end = min(index + span, self.window)
+                found = np.flatnonzero(amounts[index:end])[:count] + index
+                exhausted = end == self.window
+            if len(found) == count or exhausted:
+                break
+            span *= 4
+        ticks, sizes = self.base + found, amounts[found]
+        if len(found) < count and overflow:
+            if side == 'bid':
+                beyond = sorted((tick for tick in overflow if tick < self.base), reverse=True)
+            else:
+                beyond = sorted(tick for tick in overflow if tick >= self.base + self.window)
+            beyond = beyond[:count - len(found)]
+            ticks = np.concatenate([ticks, np.array(beyond, dtype=np.int64)])
+            sizes = np.concatenate([sizes, np.array([overflow[tick] for tick in beyond], dtype=float)])
+        return ticks / self.ticks_per_unit, sizes
+
+    def _volume_within(self, side, limit_tick):
+        # A slice sum of the window; overflow levels are only visited when the
+        # band reaches past the window, which recentring makes rare
+        best = self.best[side]
+        if best is None:
+            return 0.0
+        low, high = (best, limit_tick) if side == 'ask' else (limit_tick, best)
+        if low > high:
+            return 0.0
+        start, end = low - self.base, high - self.base + 1
+        total = float(self.amounts[side][max(start, 0):max(min(end, self.window), 0)].sum())
+        if start < 0 or end > self.window:
+            total += sum(amount for tick, amount in self.overflow[side].items()
+                         if low <= tick <= high and not 0 <= tick - self.base < self.window)
+        return total
+
+    def _aggregate(self, side, tick_size):
+        prices, amounts = self.levels(side)
+        buckets, inverse = np.unique(np.round(prices / tick_size), return_inverse=True)
+        totals = np.bincount(inverse, weights=amounts, minlength=len(buckets))
+        return pd.DataFrame({'price': buckets * tick_size, 'amount': totals})
+
+    def best_prices(self):
+        best_bid, best_ask = self.best['bid'], self.best['ask']
+        return (
+            best_bid / self.ticks_per_unit if best_bid is not None else None,
+            best_ask / self.ticks_per_unit if best_ask is not None else None,
+        )
+
+    def _rebuild_levels(self, tick_size, depth):
+        ask_df = self._aggregate('ask', tick_size)
+        bid_df = self._aggregate('bid', tick_size)
+
+        mid_price = (ask_df['price'].min() + bid_df['price'].max()) / 2
+        ask_df = ask_df[ask_df['price'] <= mid_price * (1 + depth / 10000)]
+        bid_df = bid_df[bid_df['price'] >= mid_price * (1 - depth / 10000)]
+
+        return ask_df, bid_df
@@ -0,0 +1,102 @@
+from aiohttp import web
+import datetime
+import time
+import snapshot_codec
+import metrics
+from tick_buckets import tick_size_of
+
+# Endpoints answered from BookReader queries alone, served by app.py and by
+# the read-only workers of shared_book.py
+
+def symbol_route(routes):
+    def route(path):
+        # Every endpoint is served for the first symbol at `path` and for any
+        # symbol at `/<SYMBOL><path>`
+        def register(handler):
+            routes.get(path)(handler)
+            routes.get('/{symbol:[A-Za-z0-9]+}' + path)(handler)
+            return handler
+        return register
+    return route
+
+def endpoint_of(request):
+    if request.match_info.http_exception is not None:
+        return 'unmatched'
+    return request.match_info.handler.__name__
+
+def json_response(request, data):
+    start = time.perf_counter()
+    response = web.json_response(data)
+    metrics.STAGE_TIME.observe(time.perf_counter() - start, endpoint_of(request), 'serialize')
+    return response
+
+@web.middleware
+async def cors(request, handler):
+    response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+@web.middleware
+async def instrument(request, handler):
+    # Serve time per endpoint; /stream connections are long-lived and left out
+    start = time.perf_counter()
+    response = await handler(request)
+    if not isinstance(response, web.WebSocketResponse):
+        metrics.SERVE_TIME.observe(time.perf_counter() - start, endpoint_of(request))
+    return response
+
+def add_book_routes(route, book_of):
+    @route(r'/snapshot/{tick_size:\d+(\.\d+)?}/{depth:\d+}')
+    async def snapshot(request):
+        book = book_of(request)
+        tick_size = tick_size_of(request.match_info['tick_size'])
+        depth = int(request.match_info['depth'])
+        if tick_size <= 0:
+            raise web.HTTPBadRequest(text="tick_size must be positive")
+        if depth == 0:
+            raise web.HTTPBadRequest(text="depth must be positive")
+        current_time = datetime.datetime.now()
+        current_time = int(current_time.timestamp() * 1e6)
+        # Clients accepting the columnar binary format get it instead of JSON
+        # records, deflate/gzip compressed when they pass ?compress=1
+        start = time.perf_counter()
+        if snapshot_codec.CONTENT_TYPE in request.headers.get('Accept', ''):
+            ask_df, bid_df = book.get_last_levels(tick_size, depth)
+            metrics.STAGE_TIME.observe(time.perf_counter() - start, 'snapshot', 'levels')
+            start = time.perf_counter()
+            response = web.Response(body=snapshot_codec.encode_snapshot(current_time, ask_df, bid_df),
+                                    content_type=snapshot_codec.CONTENT_TYPE)
+            metrics.STAGE_TIME.observe(time.perf_counter() - start, 'snapshot', 'serialize')
+        else:
+            df = book.get_last_snapshot(current_time, tick_size, depth)
+            metrics.STAGE_TIME.observe(time.perf_counter() - start, 'snapshot', 'levels')
+            response = json_response(request, df.to_dict(orient='records'))
+        if request.query.get('compress') in ('1', 'true'):
+            response.enable_compression()
+        return response
+
+    @route('/volume_ask')
+    async def volume_ask(request):
+        return json_response(request, book_of(request).get_volume_ask())
+
+    @route('/volume_bid')
+    async def volume_bid(request):
+        return json_response(request, book_of(request).get_volume_bid())
+
+    @route(r'/cumulative_volume/{depth:\d+}')
+    async def cumulative_volume(request):
+        return json_response(request, book_of(request).get_cumulative_volume(int(request.match_info['depth'])))
+
+    @route(r'/imbalance/{depth:\d+}')
+    async def imbalance(request):
+        return json_response(request, book_of(request).get_imbalance(int(request.match_info['depth'])))
+
+    @route(r'/fill_price/{side:bid|ask}/{quantity:\d+(\.\d+)?}')
+    async def fill_price(request):
+        side = request.match_info['side']
+        quantity = float(request.match_info['quantity'])
+        return json_response(request, book_of(request).get_fill_price(side, quantity))
+
+    @route('/spread')
+    async def spread(request):
+        return json_response(request, book_of(request).get_spread())
@@ -0,0 +1,68 @@
+from collections import deque
+
+class SequenceGap(Exception):
+    pass
+
+class BookSync:
+    # Binance diff-depth synchronisation: diffs are buffered until a REST
+    # snapshot is loaded, buffered diffs older than the snapshot are dropped and
+    # from then on only contiguous diffs are let through. Futures streams chain
+    # diffs with `pu` (previous final update id), spot streams with U == u + 1.
+    BUFFERING = 'buffering'
+    LIVE = 'live'
+
+    def __init__(self, max_buffer=5000):
+        self.buffer = deque(maxlen=max_buffer)
+        self.reset()
+
+    def reset(self):
+        self.state = self.BUFFERING
+        self.buffer.clear()
+        self.last_update_id = None
+        self.bridged = False
+
+    def resume(self, last_update_id):
+        # Continues a book restored at `last_update_id` without a snapshot: the
+        # next diff must follow it directly, otherwise SequenceGap
+        self.state = self.LIVE
+        self.buffer.clear()
+        self.last_update_id = last_update_id
+        self.bridged = True
+
+    def on_message(self, message):
+        # Returns the diffs to apply now, raises SequenceGap if one is missing
+        if self.state == self.BUFFERING:
+            self.buffer.append(message)
+            return []
+        return [message] if self._accept(message) else []
+
+    def on_snapshot(self, last_update_id):
+        self.state = self.LIVE
+        self.last_update_id = last_update_id
+        self.bridged = False
+        buffered = list(self.buffer)
+        self.buffer.clear()
+        return [message for message in buffered if self._accept(message)]
+
+    def _accept(self, message):
+        first_id, final_id = message['U'], message['u']
+        futures = 'pu' in message
+
+        if not self.bridged:
+            # The first applied diff must straddle the snapshot's update id,
+            # or on futures directly follow it
+            target = self.last_update_id if futures else self.last_update_id + 1
+            if final_id < target:
+                return False
+            if first_id > target and not (futures and message['pu'] == self.last_update_id):
+                raise SequenceGap(f"snapshot {self.last_update_id} older than diff {first_id}-{final_id}")
+            self.bridged = True
+        else:
+            if final_id <= self.last_update_id:
+                return False
+            previous_id = message['pu'] if futures else first_id - 1
+            if previous_id != self.last_update_id:
+                raise SequenceGap(f"expected diff after {self.last_update_id}, got {first_id}-{final_id}")
+
+        self.last_update_id = final_id
+        return True
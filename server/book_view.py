@@ -0,0 +1,145 @@
+import time
+import numpy as np
+import pandas as pd
+from tick_buckets import bucket_levels
+
+# Tick sizes whose aggregated levels a view keeps once computed
+CACHED_TICK_SIZES = 8
+
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+class BookView:
+    # Immutable, versioned copy of the book published by the ingestion side.
+    # Readers grab the latest view with a plain attribute read and never touch
+    # the structures the writer mutates. Bids are stored from the best price
+    # downwards and asks upwards, with cumulative amounts from the touch.
+    def __init__(self, version, last_update_id, event_time, bids, asks, buckets):
+        self.version = version
+        self.last_update_id = last_update_id
+        self.event_time = event_time
+        self.published_at = time.time()
+        self.bid_prices, self.bid_amounts = (_frozen(bids[0][::-1].copy()), _frozen(bids[1][::-1].copy()))
+        self.ask_prices, self.ask_amounts = (_frozen(asks[0].copy()), _frozen(asks[1].copy()))
+        self.bid_cumulative = _frozen(np.cumsum(self.bid_amounts))
+        self.ask_cumulative = _frozen(np.cumsum(self.ask_amounts))
+        self.totals = {
+            'bid': float(self.bid_cumulative[-1]) if len(self.bid_cumulative) else 0.0,
+            'ask': float(self.ask_cumulative[-1]) if len(self.ask_cumulative) else 0.0,
+        }
+        # {tick_size: {side: (prices, amounts)}}, prices ascending; filled on
+        # first use by side_levels unless given
+        self.buckets = {
+            tick_size: {side: (_frozen(prices), _frozen(amounts)) for side, (prices, amounts) in sides.items()}
+            for tick_size, sides in buckets.items()
+        }
+
+    @classmethod
+    def empty(cls):
+        return cls(0, None, None, (np.empty(0), np.empty(0)), (np.empty(0), np.empty(0)), {})
+
+    @classmethod
+    def from_book(cls, order_book, version=0, last_update_id=None, event_time=None):
+        return cls(version, last_update_id, event_time, order_book.levels('bid'), order_book.levels('ask'), {})
+
+    def best_prices(self):
+        best_bid = float(self.bid_prices[0]) if len(self.bid_prices) else None
+        best_ask = float(self.ask_prices[0]) if len(self.ask_prices) else None
+        return best_bid, best_ask
+
+    def mid_price(self):
+        best_bid, best_ask = self.best_prices()
+        if best_bid is None or best_ask is None:
+            return None
+        return (best_bid + best_ask) / 2
+
+    def spread(self):
+        best_bid, best_ask = self.best_prices()
+        if best_bid is None or best_ask is None:
+            return None
+        return best_ask - best_bid
+
+    def cumulative_volume(self, side, depth):
+        mid_price = self.mid_price()
+        if mid_price is None:
+            return 0.0
+        if side == 'ask':
+            count = np.searchsorted(self.ask_prices, mid_price * (1 + depth / 10000), side='right')
+            return float(self.ask_cumulative[count - 1]) if count else 0.0
+        count = np.searchsorted(-self.bid_prices, -mid_price * (1 - depth / 10000), side='right')
+        return float(self.bid_cumulative[count - 1]) if count else 0.0
+
+    def fill_price(self, side, quantity):
+        if quantity <= 0:
+            return None
+        prices, cumulative = (self.ask_prices, self.ask_cumulative) if side == 'ask' else (self.bid_prices, self.bid_cumulative)
+        index = np.searchsorted(cumulative, quantity - 1e-9)
+        return float(prices[index]) if index < len(prices) else None
+
+    def side_levels(self, side, tick_size):
+        # (prices, amounts) of one side aggregated to tick_size, ascending.
+        # Computed once per view and tick size for the first
+        # CACHED_TICK_SIZES tick sizes requested, then served from the view.
+        sides = self.buckets.get(tick_size)
+        if sides is None:
+            sides = {
+                'bid': tuple(_frozen(array) for array in bucket_levels(self.bid_prices[::-1], self.bid_amounts[::-1], tick_size)),
+                'ask': tuple(_frozen(array) for array in bucket_levels(self.ask_prices, self.ask_amounts, tick_size)),
+            }
+            if len(self.buckets) < CACHED_TICK_SIZES:
+                self.buckets[tick_size] = sides
+        return sides[side]
+
+    def get_levels(self, tick_size=10, depth=1000):
+        ask_prices, ask_amounts = self.side_levels('ask', tick_size)
+        bid_prices, bid_amounts = self.side_levels('bid', tick_size)
+        if not len(ask_prices) or not len(bid_prices):
+            empty = pd.DataFrame({'price': np.empty(0), 'amount': np.empty(0)})
+            return empty, empty.copy()
+
+        mid_price = (ask_prices[0] + bid_prices[-1]) / 2
+        ask_end = np.searchsorted(ask_prices, mid_price * (1 + depth / 10000), side='right')
+        bid_start = np.searchsorted(bid_prices, mid_price * (1 - depth / 10000), side='left')
+        ask_df = pd.DataFrame({'price': ask_prices[:ask_end], 'amount': ask_amounts[:ask_end]})
+        bid_df = pd.DataFrame({'price': bid_prices[bid_start:], 'amount': bid_amounts[bid_start:]})
+        return ask_df, bid_df
+
+class BookReader:
+    # Read-side queries answered from `self.view`, shared by
+    # OrderBookAggregator and the per-symbol books of SymbolManager
+    def get_last_levels(self, tick_size=10, depth=1000):
+        return self.view.get_levels(tick_size=tick_size, depth=depth)
+
+    def get_last_snapshot(self, current_time, tick_size=10, depth=1000):
+        ask_df, bid_df = self.get_last_levels(tick_size=tick_size, depth=depth)
+        ask_df['side'] = 'ask'
+        bid_df['side'] = 'bid'
+        snapshot_df = pd.concat([ask_df, bid_df], ignore_index=True)
+        snapshot_df['timestamp'] = current_time
+        return snapshot_df
+
+    def get_spread(self):
+        return self.view.spread()
+
+    def get_volume_ask(self):
+        return self.view.totals['ask']
+
+    def get_volume_bid(self):
+        return self.view.totals['bid']
+
+    def get_cumulative_volume(self, depth):
+        view = self.view
+        return {
+            'bid': view.cumulative_volume('bid', depth),
+            'ask': view.cumulative_volume('ask', depth),
+        }
+
+    def get_fill_price(self, side, quantity):
+        return self.view.fill_price(side, quantity)
+
+    def get_imbalance(self, depth):
+        volume = self.get_cumulative_volume(depth)
+        total_volume = volume['bid'] + volume['ask']
+        volume['imbalance'] = (volume['bid'] - volume['ask']) / total_volume if total_volume != 0 else 0
+        return volume
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import time
+import numpy as np
+
+MAGIC = b'OBCK'
+VERSION = 1
+# 48-byte header followed by bid prices, bid amounts, ask prices and ask
+# amounts as little-endian float64 arrays
+HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('last_update_id', '<i8'), ('event_time', '<i8'),
+                   ('saved_at', '<f8'), ('bids', '<i8'), ('asks', '<i8')])
+HEADER_WORDS = HEADER.itemsize // 8
+
+class BookCheckpoint:
+    # Published views of one book written every `interval` seconds to a
+    # memory-mapped file: the price/amount arrays of both sides plus the last
+    # applied update id. A new file is written next to the old one and renamed
+    # over it, so a crash mid-write leaves the previous checkpoint intact.
+    # Checkpoints older than `max_age` seconds are not loaded.
+    def __init__(self, path, interval=5, max_age=600):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.saved_version = None
+
+    def save(self, view):
+        bids, asks = len(view.bid_prices), len(view.ask_prices)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = self.path + '.tmp'
+        data = np.memmap(temporary, dtype='<f8', mode='w+', shape=HEADER_WORDS + 2 * (bids + asks))
+        data[:HEADER_WORDS].view(HEADER)[0] = (MAGIC, VERSION, view.last_update_id,
+                                               -1 if view.event_time is None else view.event_time,
+                                               time.time(), bids, asks)
+        offset = HEADER_WORDS
+        for array in (view.bid_prices, view.bid_amounts, view.ask_prices, view.ask_amounts):
+            data[offset:offset + len(array)] = array
+            offset += len(array)
+        data.flush()
+        del data
+        os.replace(temporary, self.path)
+        self.saved_version = view.version
+
+    def load(self):
+        # Header fields and the arrays of each side as read-only views of the
+        # mapped file, or None if there is no usable checkpoint
+        if not os.path.exists(self.path):
+            return None
+        data = np.memmap(self.path, dtype='<f8', mode='r')
+        if len(data) < HEADER_WORDS:
+            return None
+        header = data[:HEADER_WORDS].view(HEADER)[0]
+        bids, asks = int(header['bids']), int(header['asks'])
+        if (header['magic'] != MAGIC or header['version'] != VERSION
+                or len(data) != HEADER_WORDS + 2 * (bids + asks)):
+            print(f"Ignoring unreadable checkpoint {self.path}")
+            return None
+        age = time.time() - header['saved_at']
+        if self.max_age is not None and age > self.max_age:
+            print(f"Ignoring checkpoint {self.path} saved {age:.0f} s ago")
+            return None
+        offset = HEADER_WORDS
+        arrays = []
+        for size in (bids, bids, asks, asks):
+            arrays.append(data[offset:offset + size])
+            offset += size
+        return {
+            'last_update_id': int(header['last_update_id']),
+            'event_time': None if header['event_time'] < 0 else int(header['event_time']),
+            'saved_at': float(header['saved_at']),
+            'bid': (arrays[0], arrays[1]),
+            'ask': (arrays[2], arrays[3]),
+        }
+
+    async def run(self, book):
+        # Only views of a synced book carry an update id; a last checkpoint is
+        # written when the task is cancelled on shutdown
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                view = book.view
+                if view.last_update_id is not None and view.version != self.saved_version:
+                    await asyncio.to_thread(self.save, view)
+        finally:
+            view = book.view
+            if view.last_update_id is not None and view.version != self.saved_version:
+                self.save(view)
@@ -0,0 +1,41 @@
+import requests
+
+DEFAULT_PRICE_TICK = 0.1
+
+def parse_price_ticks(text):
+    # "ETHUSDT:0.01,SOLUSDT:0.001" as configured in PRICE_TICKS
+    ticks = {}
+    for item in filter(None, text.split(',')):
+        symbol, tick = item.split(':')
+        ticks[symbol.strip().upper()] = float(tick)
+    return ticks
+
+def fetch_price_ticks(symbols, rest_base_url="https://fapi.binance.com"):
+    # PRICE_FILTER tickSize of each symbol listed by the exchange
+    response = requests.get(f"{rest_base_url}/fapi/v1/exchangeInfo", timeout=10)
+    response.raise_for_status()
+    ticks = {}
+    for info in response.json()['symbols']:
+        if info['symbol'] not in symbols:
+            continue
+        for price_filter in info['filters']:
+            if price_filter['filterType'] == 'PRICE_FILTER':
+                ticks[info['symbol']] = float(price_filter['tickSize'])
+    return ticks
+
+def price_ticks(symbols, rest_base_url="https://fapi.binance.com", configured=None):
+    # Price tick of every symbol: the configured one, else the exchange's,
+    # else DEFAULT_PRICE_TICK if the exchange info cannot be fetched
+    configured = configured or {}
+    ticks = {symbol: configured[symbol] for symbol in symbols if symbol in configured}
+    missing = [symbol for symbol in symbols if symbol not in ticks]
+    if missing:
+        try:
+            ticks.update(fetch_price_ticks(missing, rest_base_url))
+        except Exception as e:
+            print(f"Error fetching exchange info: {e}")
+    for symbol in missing:
+        if symbol not in ticks:
+            print(f"No price tick for {symbol}, using {DEFAULT_PRICE_TICK}")
+            ticks[symbol] = DEFAULT_PRICE_TICK
+    return ticks
@@ -0,0 +1,90 @@
+import asyncio
+import time
+import numpy as np
+import pandas as pd
+
+class SnapshotHistory:
+    # Fixed-memory price x time ring buffer of aggregated level snapshots.
+    # Every `interval` seconds the published view is sampled at `tick_size`
+    # into a row of `width` price buckets centered on the mid price; a row
+    # stores the bucket key of its first column, so rows taken at different
+    # prices stay comparable. Once `capacity` rows are stored the oldest are
+    # overwritten, so memory is capacity * width * 8 bytes whatever the uptime.
+    def __init__(self, tick_size=20, width=1000, capacity=3600, interval=1.0):
+        self.tick_size = tick_size
+        self.width = width
+        self.capacity = capacity
+        self.interval = interval
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.base_keys = np.zeros(capacity, dtype=np.int64)
+        self.amounts = {side: np.zeros((capacity, width), dtype=np.float32) for side in ('bid', 'ask')}
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def record(self, timestamp, view):
+        mid_price = view.mid_price()
+        if mid_price is None:
+            return False
+        row = self.next
+        base_key = int(round(mid_price / self.tick_size)) - self.width // 2
+        self.timestamps[row] = timestamp
+        self.base_keys[row] = base_key
+        for side, amounts in self.amounts.items():
+            prices, side_amounts = view.side_levels(side, self.tick_size)
+            columns = np.round(prices / self.tick_size).astype(np.int64) - base_key
+            inside = (columns >= 0) & (columns < self.width)
+            amounts[row] = 0
+            amounts[row, columns[inside]] = side_amounts[inside]
+        self.next = (row + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return True
+
+    async def run(self, book):
+        # Samples `book.view` every interval, timestamps in µs like /snapshot
+        while True:
+            self.record(int(time.time() * 1e6), book.view)
+            await asyncio.sleep(self.interval)
+
+    def _rows(self, start, end, resolution):
+        rows = (self.next - self.count + np.arange(self.count)) % self.capacity
+        timestamps = self.timestamps[rows]
+        inside = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            inside &= timestamps >= start
+        if end is not None:
+            inside &= timestamps <= end
+        rows, timestamps = rows[inside], timestamps[inside]
+        if resolution and len(rows):
+            # Keep the last row of every resolution slot, stamped with the slot start
+            slots = timestamps // resolution
+            last = np.append(slots[1:] != slots[:-1], True)
+            rows, timestamps = rows[last], slots[last] * resolution
+        return rows, timestamps
+
+    def query(self, start=None, end=None, tick_size=None, resolution=None):
+        # Levels between start and end (µs, inclusive) as timestamp, price,
+        # amount and side columns, re-bucketed to tick_size (a multiple of the
+        # recorded tick size) and thinned to one row per resolution µs
+        tick_size = tick_size or self.tick_size
+        if tick_size % self.tick_size:
+            raise ValueError(f"tick_size must be a multiple of {self.tick_size}")
+        factor = tick_size // self.tick_size
+        rows, timestamps = self._rows(start, end, resolution)
+
+        columns = {'timestamp': [], 'price': [], 'amount': [], 'side': []}
+        for side, amounts in self.amounts.items():
+            selected = amounts[rows]
+            positions, offsets = np.nonzero(selected)
+            keys = np.round((self.base_keys[rows][positions] + offsets) / factor).astype(np.int64)
+            # One (row, key) group per output level
+            groups, inverse = np.unique(np.stack([positions, keys]), axis=1, return_inverse=True)
+            totals = np.bincount(inverse.ravel(), weights=selected[positions, offsets], minlength=groups.shape[1])
+            columns['timestamp'].append(timestamps[groups[0]])
+            columns['price'].append((groups[1] * tick_size).astype(np.float64))
+            columns['amount'].append(totals)
+            columns['side'].append(np.full(groups.shape[1], side))
+        df = pd.DataFrame({name: np.concatenate(parts) for name, parts in columns.items()})
+        return df.sort_values('timestamp', kind='stable', ignore_index=True)
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from collections import deque
+from utils import json_loads
+from metrics import QUEUE_WAIT
+
+def coalesce_messages(messages, key=None):
+    # Merges runs of contiguous depth diffs into one diff per run, keeping the
+    # last amount for every price level. The merged diff spans the run's update
+    # ids so BookSync still checks it against its neighbours. With `key`,
+    # diffs are merged per key (the symbol of a combined stream), each key's
+    # diffs staying in order.
+    merged = []
+    last = {}
+    for message in messages:
+        group = key(message) if key is not None else None
+        current = last.get(group)
+        if current is not None:
+            previous_id = message['pu'] if 'pu' in message else message['U'] - 1
+            if previous_id == current['u']:
+                current['b'].update(message['b'])
+                current['a'].update(message['a'])
+                current['u'] = message['u']
+                current['E'] = message.get('E')
+                continue
+        current = dict(message)
+        current['b'] = dict(message['b'])
+        current['a'] = dict(message['a'])
+        merged.append(current)
+        last[group] = current
+
+    for message in merged:
+        message['b'] = list(message['b'].items())
+        message['a'] = list(message['a'].items())
+    return merged
+
+class IngestQueue:
+    # Bounded hand-off between the socket reader and the book applier. Items
+    # are raw frames, preceded by already decoded diffs once the queue has been
+    # coalesced: whenever `maxsize` items are pending, everything queued is
+    # decoded and merged so the applier skips intermediate states. If that
+    # does not bring the queue under half of `maxsize` (diffs that cannot be
+    # merged), everything queued is dropped and `on_overflow` called so the
+    # book is resynced, as for lag. With maxsize None the queue is unbounded
+    # and never coalesces. `key` is passed on to coalesce_messages.
+    def __init__(self, maxsize=1000, decoder=json_loads, on_overflow=None, key=None):
+        self.maxsize = maxsize
+        self.decoder = decoder
+        self.on_overflow = on_overflow
+        self.key = key
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.coalesced_frames = 0
+        self.dropped_frames = 0
+        # perf_counter() when the oldest pending item was queued
+        self.oldest = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+    def wake(self):
+        self.ready.set()
+
+    def put(self, frame):
+        if not self.items:
+            self.oldest = time.perf_counter()
+        self.items.append(frame)
+        if self.maxsize is not None and len(self.items) >= self.maxsize:
+            self.coalesce()
+            if len(self.items) > self.maxsize // 2:
+                dropped = len(self.items)
+                self.dropped_frames += dropped
+                self.items.clear()
+                if self.on_overflow is not None:
+                    self.on_overflow(dropped)
+        self.ready.set()
+
+    def coalesce(self):
+        pending = len(self.items)
+        self.items = deque(coalesce_messages(self.decode(list(self.items)), self.key))
+        self.coalesced_frames += pending - len(self.items)
+
+    def decode(self, items):
+        messages = [item for item in items if isinstance(item, dict)]
+        frames = items[len(messages):]
+        if frames:
+            messages += self.decoder('[' + ','.join(frames) + ']')
+        return messages
+
+    async def get_batch(self):
+        await self.ready.wait()
+        self.ready.clear()
+        items, self.items = list(self.items), deque()
+        if items:
+            QUEUE_WAIT.observe(time.perf_counter() - self.oldest)
+        return self.decode(items)
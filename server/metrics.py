@@ -0,0 +1,181 @@
+import bisect
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+
+# Seconds, about x2.5 apart from 10 µs to 10 s
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+def _merge(sources):
+    # Sums series from several processes: counter values, or histogram
+    # bucket lists element-wise
+    series = {}
+    for source in sources:
+        for label_values, value in source.items():
+            if isinstance(value, list):
+                current = series.get(label_values, [0] * len(value))
+                series[label_values] = [a + b for a, b in zip(current, value)]
+            else:
+                series[label_values] = series.get(label_values, 0) + value
+    return series
+
+class Histogram:
+    # Cumulative bucket counts per label values, kept as one list
+    # [bucket counts..., +Inf count, sum] so observe() is a bisect and two
+    # additions
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        counts = self.series.get(label_values)
+        if counts is None:
+            counts = self.series[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def lines(self, series):
+        for label_values, counts in sorted(series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                le = 'le="' + (bound if bound == '+Inf' else _number(bound)) + '"'
+                yield f'{self.name}_bucket{_labels(self.labels, label_values, le)} {total}'
+            yield f'{self.name}_sum{_labels(self.labels, label_values)} {_number(counts[-1])}'
+            yield f'{self.name}_count{_labels(self.labels, label_values)} {total}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, *label_values, amount=1):
+        self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def lines(self, series):
+        for label_values, value in sorted(series.items()):
+            yield f'{self.name}{_labels(self.labels, label_values)} {_number(value)}'
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        self.series[label_values] = value
+
+class Registry:
+    # Metrics of this process. Shard workers ship their `state()` to the
+    # HTTP process, which adds it to its own series when rendering; gauges
+    # that are cheap to compute on demand are filled by `collectors` at
+    # scrape time rather than on the hot path.
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def state(self):
+        return {name: {key: list(value) if isinstance(value, list) else value for key, value in metric.series.items()}
+                for name, metric in self.metrics.items()}
+
+    def render(self, remote_states=()):
+        # Prometheus text exposition format
+        for collect in self.collectors:
+            collect()
+        output = []
+        for name, metric in self.metrics.items():
+            series = _merge([metric.series] + [state.get(name, {}) for state in remote_states])
+            if not series:
+                continue
+            output.append(f'# HELP {name} {metric.help}')
+            output.append(f'# TYPE {name} {metric.kind}')
+            output.extend(metric.lines(series))
+        return '\n'.join(output) + '\n'
+
+registry = Registry()
+
+# Ingestion
+EVENT_LAG = registry.histogram('orderbook_event_lag_seconds', 'Local apply time minus the exchange event time of the last diff of each batch', ('symbol',))
+QUEUE_WAIT = registry.histogram('orderbook_queue_wait_seconds', 'Time from the oldest frame of a batch being received to the batch being applied')
+BATCH_SIZE = registry.histogram('orderbook_batch_messages', 'Diffs per applied batch', ('symbol',), COUNT_BUCKETS)
+APPLY_TIME = registry.histogram('orderbook_apply_seconds', 'Sequence checks and book updates for one batch of diffs', ('symbol',))
+PUBLISH_TIME = registry.histogram('orderbook_publish_seconds', 'Time to publish a new BookView', ('symbol',))
+RECONNECTS = registry.counter('orderbook_reconnects_total', 'WebSocket reconnections, after an error or a closed connection', ('symbol',))
+RESYNCS = registry.counter('orderbook_resyncs_total', 'Book reloads from a REST snapshot', ('symbol',))
+BOOK_LEVELS = registry.gauge('orderbook_levels', 'Price levels held per side in the published view', ('symbol', 'side'))
+
+# HTTP API
+SERVE_TIME = registry.histogram('http_serve_seconds', 'Handler time per endpoint, serialisation included', ('endpoint',))
+STAGE_TIME = registry.histogram('http_stage_seconds', 'Level aggregation and serialisation time per endpoint', ('endpoint', 'stage'))
+
+class SamplingProfiler:
+    # Samples the stack of one thread every `interval` seconds from a
+    # background thread and counts identical stacks, in the collapsed format
+    # read by flamegraph.pl and speedscope. Costs nothing until started.
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.stacks.clear()
+        self.samples = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        return self.collapsed()
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
@@ -0,0 +1,263 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from collections import defaultdict, deque
+import websockets
+from book_view import BookView, BookReader
+from book_sync import BookSync
+from ingest import IngestQueue, coalesce_messages
+from utils import json_loads
+from orderbook_aggregator import OrderBookAggregator
+from strategy_engine import ImbalanceStrategy, history_columns
+from analytics import OrderFlowAnalytics, AnalyticsBuffer
+from exchange_info import DEFAULT_PRICE_TICK
+from metrics import registry, RECONNECTS
+
+def combined_stream_url(symbols, base_url="wss://fstream.binance.com"):
+    streams = '/'.join(f"{symbol.lower()}@depth@100ms" for symbol in symbols)
+    return f"{base_url}/stream?streams={streams}"
+
+class ShardIngestor:
+    # Runs in a worker process: one combined-stream connection for a group of
+    # symbols, one OrderBookAggregator per symbol for sync, book and views.
+    # Each published view, and the levels changed by the diffs applied since
+    # the previous one, are sent to the HTTP process through `updates`.
+    # `price_ticks` maps each symbol to its exchange price tick. The shared
+    # ingest queue is bounded by `queue_size` like a single symbol's, and
+    # coalesces per symbol.
+    def __init__(self, symbols, updates, ws_base_url="wss://fstream.binance.com", publish_interval=0.5, checkpoint_dir=None,
+                 price_ticks=None, decoder=json_loads, queue_size=1000, **options):
+        self.symbols = symbols
+        self.updates = updates
+        self.ws_url = combined_stream_url(symbols, ws_base_url)
+        price_ticks = price_ticks or {}
+        self.aggregators = {
+            symbol: OrderBookAggregator(symbol, price_tick=price_ticks.get(symbol, DEFAULT_PRICE_TICK),
+                                        publish_interval=publish_interval, ws_base_url=ws_base_url,
+                                        checkpoint_path=checkpoint_dir and os.path.join(checkpoint_dir, f"{symbol}.book"),
+                                        **options)
+            for symbol in symbols
+        }
+        # Latest amount of every level changed since the last export, per
+        # side, and the update id of the last diff included
+        self.pending_diffs = {symbol: {'b': {}, 'a': {}, 'u': None} for symbol in symbols}
+        for symbol, aggregator in self.aggregators.items():
+            ImbalanceStrategy(aggregator)
+            OrderFlowAnalytics(aggregator)
+            aggregator.diff_listeners.append(lambda updates, symbol=symbol: self.record_diffs(symbol, updates))
+        # Combined-stream frames are unwrapped to their diffs when decoded
+        self.queue = IngestQueue(queue_size, lambda text: [frame['data'] for frame in decoder(text)],
+                                 on_overflow=self.on_queue_overflow, key=lambda diff: diff['s'])
+        self.sent_versions = {symbol: None for symbol in symbols}
+        self.sent_history = {symbol: None for symbol in symbols}
+        self.sent_analytics = {symbol: None for symbol in symbols}
+        self.websocket = None
+
+    async def connect(self):
+        # Reconnects are counted as in OrderBookAggregator.connect
+        connections = 0
+        while True:
+            if connections:
+                for symbol in self.symbols:
+                    RECONNECTS.inc(symbol)
+            connections += 1
+            try:
+                print(f"Connecting to {self.ws_url}")
+                async with websockets.connect(self.ws_url, ping_interval=20, ping_timeout=10) as websocket:
+                    self.websocket = websocket
+                    print(f"WebSocket connected for {', '.join(self.symbols)}.")
+                    await self.listen()
+            except Exception as e:
+                print(f"Connection error: {e}")
+                await asyncio.sleep(5)
+
+    async def listen(self):
+        self.queue.clear()
+        for aggregator in self.aggregators.values():
+            if aggregator.sync.state != BookSync.LIVE:
+                aggregator.resync()
+        reader = asyncio.create_task(self.read_frames())
+        export = asyncio.create_task(self.export_views())
+        try:
+            while True:
+                messages = await self.queue.get_batch()
+                if messages:
+                    self.handle_messages(messages)
+                if reader.done() and not len(self.queue):
+                    break
+        finally:
+            reader.cancel()
+            export.cancel()
+
+    async def read_frames(self):
+        try:
+            async for data in self.websocket:
+                self.queue.put(data)
+        except Exception as e:
+            print(f"Error receiving message: {e}")
+        finally:
+            self.queue.wake()
+
+    def handle_messages(self, messages):
+        # Diffs are routed per symbol, so a gap only resyncs that symbol
+        per_symbol = defaultdict(list)
+        for message in messages:
+            per_symbol[message['s']].append(message)
+        for symbol, diffs in per_symbol.items():
+            if symbol in self.aggregators:
+                self.aggregators[symbol].handle_messages(coalesce_messages(diffs))
+
+    def on_queue_overflow(self, dropped):
+        # The dropped frames may hold diffs of every symbol of the shard
+        print(f"{', '.join(self.symbols)} ingest queue full, dropped {dropped} queued diffs, resyncing")
+        for aggregator in self.aggregators.values():
+            aggregator.resync()
+
+    def record_diffs(self, symbol, updates):
+        pending = self.pending_diffs[symbol]
+        for message in updates:
+            pending['b'].update(message['b'])
+            pending['a'].update(message['a'])
+        pending['u'] = updates[-1]['u']
+
+    async def export_views(self, interval=0.1):
+        # Views are also published right after a snapshot load and by the
+        # aggregators' publish timers, outside handle_messages, hence the
+        # polling
+        while True:
+            for symbol, aggregator in self.aggregators.items():
+                view = aggregator.view
+                if view.version != self.sent_versions[symbol]:
+                    self.sent_versions[symbol] = view.version
+                    # Only the strategy history samples not sent yet
+                    strategy = aggregator.get_strategy(self.sent_history[symbol])
+                    if strategy['history']['timestamp']:
+                        self.sent_history[symbol] = strategy['history']['timestamp'][-1]
+                    analytics = aggregator.get_analytics(self.sent_analytics[symbol])
+                    if analytics['timestamp']:
+                        self.sent_analytics[symbol] = analytics['timestamp'][-1]
+                    self.updates.put(('view', symbol, view, aggregator.get_lag(), strategy, analytics))
+                pending = self.pending_diffs[symbol]
+                if pending['b'] or pending['a']:
+                    self.pending_diffs[symbol] = {'b': {}, 'a': {}, 'u': None}
+                    # One coalesced diff for the /stream diffs channel
+                    self.updates.put(('diffs', symbol, {'b': list(pending['b'].items()), 'a': list(pending['a'].items()),
+                                                        'u': pending['u']}))
+            await asyncio.sleep(interval)
+
+    async def export_metrics(self, interval=1):
+        # This worker's metrics, connected or not, see Registry.render
+        while True:
+            self.updates.put(('metrics', ','.join(self.symbols), registry.state()))
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        tasks = [asyncio.create_task(self.export_metrics())]
+        tasks += [asyncio.create_task(aggregator.checkpoint.run(aggregator))
+                  for aggregator in self.aggregators.values() if aggregator.checkpoint is not None]
+        try:
+            await self.connect()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+def run_shard(symbols, updates, options):
+    asyncio.run(ShardIngestor(symbols, updates, **options).run())
+
+class RemoteBook(BookReader):
+    # HTTP-process stand-in for a symbol ingested by a worker process
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.view = BookView.empty()
+        self.lag = {}
+        self.diff_listeners = []
+        self.strategy_summary = None
+        self.strategy_history = deque(maxlen=3600)
+        self.analytics = None
+
+    def get_lag(self):
+        return self.lag
+
+    def on_diffs(self, updates):
+        for listener in self.diff_listeners:
+            listener(updates)
+
+    def update_strategy(self, state):
+        history = state.pop('history')
+        self.strategy_history.extend(zip(history['timestamp'], history['portfolio_value'], history['buy_and_hold_value']))
+        self.strategy_summary = state
+
+    def get_strategy(self, since=None):
+        if self.strategy_summary is None:
+            return None
+        return {**self.strategy_summary, 'history': history_columns(self.strategy_history, since)}
+
+    def update_analytics(self, columns):
+        if self.analytics is None:
+            self.analytics = AnalyticsBuffer([field for field in columns if field != 'timestamp'])
+        self.analytics.extend(columns)
+
+    def get_analytics(self, since=None, fields=None, limit=None):
+        return self.analytics.columns(since, fields, limit) if self.analytics is not None else None
+
+class SymbolManager:
+    # Spreads `symbols` over `shards` worker processes, each with a single
+    # combined-stream connection, and keeps the latest view of every symbol
+    # in this process for the HTTP routes. Dead workers are restarted. Workers
+    # are spawned rather than forked from the running event loop.
+    def __init__(self, symbols, shards=None, price_ticks=None, **options):
+        symbols = [symbol.upper() for symbol in symbols]
+        shards = min(shards or multiprocessing.cpu_count(), len(symbols))
+        self.groups = [symbols[i::shards] for i in range(shards)]
+        self.options = options
+        self.price_ticks = price_ticks or {}
+        self.loop = None
+        self.books = {symbol: RemoteBook(symbol) for symbol in symbols}
+        self.context = multiprocessing.get_context('spawn')
+        self.updates = self.context.Queue()
+        self.workers = [None] * len(self.groups)
+        # Latest metrics state of each shard, see Registry.render
+        self.shard_metrics = {}
+
+    def start_worker(self, index):
+        group = self.groups[index]
+        options = {**self.options, 'price_ticks': {symbol: self.price_ticks[symbol] for symbol in group if symbol in self.price_ticks}}
+        worker = self.context.Process(target=run_shard, args=(group, self.updates, options), daemon=True)
+        worker.start()
+        self.workers[index] = worker
+
+    def receive_views(self):
+        # Blocking reads on this thread; the books, metrics and listeners
+        # are only touched on the event loop, where the handlers read them
+        while True:
+            kind, *update = self.updates.get()
+            self.loop.call_soon_threadsafe(self.apply_update, kind, update)
+
+    def apply_update(self, kind, update):
+        if kind == 'metrics':
+            shard, state = update
+            self.shard_metrics[shard] = state
+            return
+        if kind == 'diffs':
+            symbol, diff = update
+            self.books[symbol].on_diffs([diff])
+            return
+        symbol, view, lag, strategy, analytics = update
+        book = self.books[symbol]
+        book.view = view
+        book.lag = lag
+        book.update_strategy(strategy)
+        book.update_analytics(analytics)
+
+    async def run(self, check_interval=5):
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self.receive_views, daemon=True).start()
+        for index in range(len(self.groups)):
+            self.start_worker(index)
+        while True:
+            await asyncio.sleep(check_interval)
+            for index, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    print(f"Shard {', '.join(self.groups[index])} exited ({worker.exitcode}), restarting")
+                    self.start_worker(index)
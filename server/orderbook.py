@@ -1,16 +1,137 @@
+import itertools
+import math
+import numpy as np
 import pandas as pd
 from BTrees.OOBTree import OOBTree # type: ignore
 
-class OrderBook:
-    def __init__(self):
+class DepthIndex:
+    # Fenwick tree of one side's amounts over the `size` ticks from `base`,
+    # so the volume up to a tick is O(log size). Level changes are queued as
+    # tick deltas and folded in by the next query: updates only pay a dict
+    # write, and a level changed several times between queries once.
+    def __init__(self, ticks, amounts, center, size):
+        self.size = size
+        self.base = center - size // 2
+        index = ticks - self.base
+        inside = (index >= 0) & (index < size)
+        window = np.bincount(index[inside], weights=amounts[inside], minlength=size)
+        # Node i holds the sum of the (i - lowbit(i), i] slots
+        prefix = np.concatenate([[0.0], np.cumsum(window)])
+        nodes = np.arange(1, size + 1)
+        self.tree = [0.0] + (prefix[nodes] - prefix[nodes - (nodes & -nodes)]).tolist()
+        self.pending = {}
+
+    def centered(self, tick):
+        # Whether `tick` is in the central half of the window
+        return self.size // 4 <= tick - self.base < self.size - self.size // 4
+
+    def add(self, tick, delta):
+        self.pending[tick] = self.pending.get(tick, 0.0) + delta
+
+    def flush(self):
+        tree, size = self.tree, self.size
+        for tick, delta in self.pending.items():
+            # Ticks outside the window are not indexed
+            i = tick - self.base + 1
+            if i < 1:
+                continue
+            while i <= size:
+                tree[i] += delta
+                i += i & -i
+        self.pending.clear()
+
+    def prefix(self, tick):
+        # Volume at the indexed ticks up to `tick` inclusive
+        if self.pending:
+            self.flush()
+        tree, total = self.tree, 0.0
+        i = min(tick - self.base + 1, self.size)
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+class BaseOrderBook:
+    # Side totals are maintained by both engines on every update. Depth
+    # within a band is read on demand (only the strategy and the analytics
+    # ask, once per batch): the tree engine from a DepthIndex, the array
+    # engine from a slice sum of its window. Tick-aggregated levels are
+    # computed from the published views, see BookView.side_levels.
+    def __init__(self, price_tick=0.1):
+        self.price_tick = price_tick
+        # Dividing integer ticks by this gives back the exact float parsed from
+        # the exchange's decimal string
+        self.ticks_per_unit = round(1 / price_tick)
+        self.totals = {'bid': 0.0, 'ask': 0.0}
+
+    def _clear_derived(self):
+        self.totals = {'bid': 0.0, 'ask': 0.0}
+
+    def _record(self, side, old_amount, amount):
+        self.totals[side] += amount - old_amount
+
+    def _record_many(self, side, old_amounts, amounts):
+        self.totals[side] += float(amounts.sum() - old_amounts.sum())
+
+    def apply_levels(self, side, prices, amounts):
+        # Applies a batch of level changes in order; engines with a vectorised
+        # path override this
+        for price, amount in zip(prices.tolist(), amounts.tolist()):
+            self.update(side, price, amount)
+
+    def best_prices(self):
+        raise NotImplementedError
+
+    def mid_price(self):
+        best_bid, best_ask = self.best_prices()
+        if best_bid is None or best_ask is None:
+            return None
+        return (best_bid + best_ask) / 2
+
+    def cumulative_volume(self, side, depth):
+        # Volume resting on `side` within `depth` bps of the mid, the band
+        # edge snapped to the price tick
+        mid_price = self.mid_price()
+        if mid_price is None:
+            return 0.0
+        if side == 'ask':
+            limit = math.floor(mid_price * (1 + depth / 10000) * self.ticks_per_unit + 1e-9)
+        else:
+            limit = math.ceil(mid_price * (1 - depth / 10000) * self.ticks_per_unit - 1e-9)
+        return self._volume_within(side, limit)
+
+    def _volume_within(self, side, limit_tick):
+        # Quantity resting between the touch and `limit_tick` inclusive
+        raise NotImplementedError
+
+    def get_levels(self, tick_size=10, depth=1000):
+        return self._rebuild_levels(tick_size, depth)
+
+class OrderBook(BaseOrderBook):
+    # Depth indexes cover `index_size` ticks around the mid; they are built
+    # by the first depth query and rebuilt when the mid leaves their central
+    # half. Levels outside the window are summed from the trees.
+    def __init__(self, price_tick=0.1, index_size=1 << 17):
+        super().__init__(price_tick)
         self.bid = OOBTree()
         self.ask = OOBTree()
+        self.index_size = index_size
+        self.depth_index = {'bid': None, 'ask': None}
 
     def clear(self):
         self.bid.clear()
         self.ask.clear()
+        self._clear_derived()
+        self.depth_index = {'bid': None, 'ask': None}
 
     def update(self, side, price, amount):
+        tree = self.bid if side == 'bid' else self.ask
+        old_amount = tree.get(price, 0)
+        self._record(side, old_amount, amount)
+        index = self.depth_index[side]
+        if index is not None and amount != old_amount:
+            index.add(int(round(price * self.ticks_per_unit)), amount - old_amount)
+
         if amount != 0:
             if side == 'bid':
                 self.bid[price] = amount
@@ -24,7 +145,71 @@ class OrderBook:
                 if price in self.ask:
                     del self.ask[price]
 
-    def get_levels(self, tick_size=10, depth=1000):
+    def levels(self, side):
+        tree = self.bid if side == 'bid' else self.ask
+        prices = np.fromiter(tree.keys(), dtype=float, count=len(tree))
+        amounts = np.fromiter(tree.values(), dtype=float, count=len(tree))
+        return prices, amounts
+
+    def top_levels(self, side, count):
+        # Best `count` levels of `side`, best first. Bids are walked down from
+        # the top with maxKey, a BTree lookup per level, since slicing from
+        # the end of the tree is linear in its size.
+        if side == 'ask':
+            levels = list(itertools.islice(self.ask.items(), count))
+        else:
+            levels = []
+            price = self.bid.maxKey() if self.bid else None
+            while price is not None and len(levels) < count:
+                levels.append((price, self.bid[price]))
+                try:
+                    price = self.bid.maxKey(price - self.price_tick / 2)
+                except ValueError:
+                    price = None
+        prices = np.fromiter((price for price, _ in levels), dtype=float, count=len(levels))
+        amounts = np.fromiter((amount for _, amount in levels), dtype=float, count=len(levels))
+        return prices, amounts
+
+    def best_prices(self):
+        best_bid = self.bid.maxKey() if self.bid else None
+        best_ask = self.ask.minKey() if self.ask else None
+        return best_bid, best_ask
+
+    def _index(self, side):
+        index = self.depth_index[side]
+        mid_tick = int(round(self.mid_price() * self.ticks_per_unit))
+        if index is None or not index.centered(mid_tick):
+            prices, amounts = self.levels(side)
+            ticks = np.round(prices * self.ticks_per_unit).astype(np.int64)
+            index = self.depth_index[side] = DepthIndex(ticks, amounts, mid_tick, self.index_size)
+        return index
+
+    def _tree_volume(self, side, low_tick, high_tick):
+        # Quantity at the ticks in [low_tick, high_tick], summed from the tree
+        if low_tick > high_tick:
+            return 0.0
+        tree = self.bid if side == 'bid' else self.ask
+        half = 0.5 / self.ticks_per_unit
+        return float(sum(tree.values(min=low_tick / self.ticks_per_unit - half,
+                                     max=high_tick / self.ticks_per_unit + half)))
+
+    def _volume_within(self, side, limit_tick):
+        tree = self.bid if side == 'bid' else self.ask
+        if not tree:
+            return 0.0
+        index = self._index(side)
+        start, end = index.base, index.base + index.size - 1
+        if side == 'ask':
+            lowest = int(round(tree.minKey() * self.ticks_per_unit))
+            return (index.prefix(limit_tick)
+                    + self._tree_volume(side, lowest, min(limit_tick, start - 1))
+                    + self._tree_volume(side, end + 1, limit_tick))
+        highest = int(round(tree.maxKey() * self.ticks_per_unit))
+        return (index.prefix(end) - index.prefix(limit_tick - 1)
+                + self._tree_volume(side, max(limit_tick, end + 1), highest)
+                + self._tree_volume(side, limit_tick, start - 1))
+
+    def _rebuild_levels(self, tick_size, depth):
         ask_df = pd.DataFrame.from_dict(self.ask, orient='index', columns=['amount']).reset_index().rename(columns={'index': 'price'})
         bid_df = pd.DataFrame.from_dict(self.bid, orient='index', columns=['amount']).reset_index().rename(columns={'index': 'price'})
 
@@ -1,27 +1,71 @@
 from orderbook import OrderBook
+from array_orderbook import ArrayOrderBook
+from book_sync import BookSync, SequenceGap
+from utils import json_loads
+from ingest import IngestQueue
+from book_view import BookView, BookReader
+from checkpoint import BookCheckpoint
+from metrics import EVENT_LAG, BATCH_SIZE, APPLY_TIME, PUBLISH_TIME, RECONNECTS, RESYNCS
 import asyncio
-import websockets
-import json
-import pandas as pd
-from threading import Thread
 import time
+import websockets
+import numpy as np
 import requests
 
-class OrderBookAggregator:
-    def __init__(self, symbol='BTCUSDT'):
+ENGINES = {
+    'tree': OrderBook,
+    'array': ArrayOrderBook,
+}
+
+class OrderBookAggregator(BookReader):
+    def __init__(self, symbol='BTCUSDT', engine='tree', price_tick=0.1, ws_url=None, snapshot_url=None, decoder=json_loads,
+                 queue_size=1000, lag_threshold_ms=5000, lag_policy='resync', publish_interval=0.25,
+                 ws_base_url="wss://fstream.binance.com", rest_base_url="https://fapi.binance.com",
+                 checkpoint_path=None, checkpoint_interval=5, checkpoint_max_age=600):
         self.symbol = symbol
-        self.ws_url = f"wss://fstream.binance.com/ws/{symbol.lower()}@depth@100ms"
-        self.api_url = f"https://api.binance.com/api/v3/depth?symbol={symbol}&limit=5"
-        self.order_book = OrderBook()
+        self.ws_url = ws_url or f"{ws_base_url}/ws/{symbol.lower()}@depth@100ms"
+        self.snapshot_url = snapshot_url or f"{rest_base_url}/fapi/v1/depth?symbol={symbol}&limit=1000"
+        self.order_book = ENGINES[engine](price_tick)
         self.websocket = None
-        self.best_bid = None
-        self.best_ask = None
-
-        self.cleaner_thread = Thread(target=self.periodic_clean)
-        self.cleaner_thread.start()
+        self.sync = BookSync()
+        self.snapshot_task = None
+        self.queue = IngestQueue(queue_size, decoder, on_overflow=self.on_queue_overflow)
+        # Lag is the local apply time minus the exchange event time `E` of the
+        # last applied diff. With lag_policy 'resync' a lag above the threshold
+        # drops the queued diffs and reloads the book, with 'ignore' it is only
+        # reported.
+        self.lag_threshold_ms = lag_threshold_ms
+        self.lag_policy = lag_policy
+        self.lag_ms = None
+        self.last_event_time = None
+        # Readers only ever see `self.view`, an immutable copy of the book
+        # republished at most every `publish_interval` seconds (after every
+        # applied batch with None): copying both sides costs milliseconds on
+        # deep books, more than applying a batch. A batch held back is
+        # published by a timer once the interval has elapsed.
+        self.publish_interval = publish_interval
+        self.view = BookView.from_book(self.order_book)
+        self.publish_pending = False
+        self.publish_timer = None
+        # Callables receiving every batch of applied diffs
+        self.diff_listeners = []
+        # ImbalanceStrategy and OrderFlowAnalytics attached to this book, if any
+        self.strategy = None
+        self.analytics = None
+        # With a checkpoint the book starts from the last saved one, see restore
+        self.checkpoint = None
+        if checkpoint_path:
+            self.checkpoint = BookCheckpoint(checkpoint_path, checkpoint_interval, checkpoint_max_age)
+            self.restore()
 
     async def connect(self):
+        # Every connection after the first counts as a reconnect, whether the
+        # previous one failed or was closed cleanly
+        connections = 0
         while True:
+            if connections:
+                RECONNECTS.inc(self.symbol)
+            connections += 1
             try:
                 print(f"Connecting to {self.ws_url}")
                 async with websockets.connect(self.ws_url, ping_interval=20, ping_timeout=10) as websocket:
@@ -33,68 +77,166 @@ class OrderBookAggregator:
                 await asyncio.sleep(5)
 
     async def listen(self):
-        while True:
-            try:
-                data = await self.websocket.recv()
-                self.process_message(json.loads(data))
-            except Exception as e:
-                print(f"Error receiving message: {e}")
-                break
+        # The reader task only queues raw frames; every time the loop gets back
+        # here all frames queued in the meantime are decoded with one decoder
+        # call and applied at once
+        # A book still live (restored from a checkpoint, or after a dropped
+        # connection) carries on if the new stream continues its sequence and
+        # resyncs on the first gap otherwise
+        self.queue.clear()
+        if self.sync.state != BookSync.LIVE:
+            self.resync()
+        reader = asyncio.create_task(self.read_frames())
+        try:
+            while True:
+                messages = await self.queue.get_batch()
+                if messages:
+                    self.handle_messages(messages)
+                if reader.done() and not len(self.queue):
+                    break
+        finally:
+            reader.cancel()
 
-    def get_best_bid_ask(self):
+    async def read_frames(self):
         try:
-            response = requests.get(self.api_url)
-            data = response.json()
-            self.best_bid = float(data['bids'][0][0])
-            self.best_ask = float(data['asks'][0][0])
+            async for data in self.websocket:
+                self.queue.put(data)
         except Exception as e:
-            print(f"Error fetching snapshot from API: {e}")
-            self.best_bid, self.best_ask = None, None
+            print(f"Error receiving message: {e}")
+        finally:
+            self.queue.wake()
+
+    def handle_messages(self, messages):
+        start = time.perf_counter()
+        updates = []
+        for message in messages:
+            try:
+                updates.extend(self.sync.on_message(message))
+            except SequenceGap as e:
+                print(f"{self.symbol} out of sync ({e}), resyncing")
+                self.resync()
+                self.sync.on_message(message)
+        self.apply_diffs(updates)
+        if updates:
+            APPLY_TIME.observe(time.perf_counter() - start, self.symbol)
+            BATCH_SIZE.observe(len(updates), self.symbol)
+            self.record_lag(updates[-1].get('E'))
+            self.publish()
+            for listener in self.diff_listeners:
+                listener(updates)
 
-    def clean_order_book(self):
-        if self.best_bid is None or self.best_ask is None:
+    def publish(self, force=False):
+        if not force and self.publish_interval is not None:
+            remaining = self.publish_interval - (time.time() - self.view.published_at)
+            if remaining > 0:
+                self.publish_pending = True
+                if self.publish_timer is None:
+                    try:
+                        self.publish_timer = asyncio.get_running_loop().call_later(remaining, self.flush_publish)
+                    except RuntimeError:
+                        # No event loop (benchmarks): left to the next batch
+                        pass
+                return
+        if self.publish_timer is not None:
+            self.publish_timer.cancel()
+            self.publish_timer = None
+        self.publish_pending = False
+        start = time.perf_counter()
+        self.view = BookView.from_book(self.order_book, self.view.version + 1, self.sync.last_update_id, self.last_event_time)
+        PUBLISH_TIME.observe(time.perf_counter() - start, self.symbol)
+
+    def flush_publish(self):
+        self.publish_timer = None
+        if self.publish_pending:
+            self.publish(force=True)
+
+    def record_lag(self, event_time):
+        if event_time is None:
             return
+        self.last_event_time = event_time
+        self.lag_ms = time.time() * 1000 - event_time
+        EVENT_LAG.observe(self.lag_ms / 1000, self.symbol)
+        if (self.lag_policy == 'resync' and self.lag_threshold_ms is not None
+                and self.lag_ms > self.lag_threshold_ms and self.sync.state == BookSync.LIVE):
+            print(f"{self.symbol} lagging {self.lag_ms:.0f} ms behind the exchange, resyncing")
+            self.queue.clear()
+            self.resync()
+
+    def on_queue_overflow(self, dropped):
+        print(f"{self.symbol} ingest queue full, dropped {dropped} queued diffs, resyncing")
+        self.resync()
+
+    def get_lag(self):
+        return {
+            'lag_ms': self.lag_ms,
+            'last_event_time': self.last_event_time,
+            'queued': len(self.queue),
+            'coalesced_frames': self.queue.coalesced_frames,
+            'dropped_frames': self.queue.dropped_frames,
+            'view_version': self.view.version,
+            'view_update_id': self.view.last_update_id,
+        }
+
+    def get_strategy(self, since=None):
+        return self.strategy.state(since) if self.strategy is not None else None
 
-        for price in list(self.order_book.bid.keys()):
-            if price > self.best_bid:
-                self.order_book.update('bid', price, 0)
+    def get_analytics(self, since=None, fields=None, limit=None):
+        return self.analytics.columns(since, fields, limit) if self.analytics is not None else None
 
-        for price in list(self.order_book.ask.keys()):
-            if price < self.best_ask:
-                self.order_book.update('ask', price, 0)
+    def restore(self):
+        start = time.perf_counter()
+        state = self.checkpoint.load()
+        if state is None:
+            return False
+        for side in ('bid', 'ask'):
+            self.order_book.apply_levels(side, *state[side])
+        self.sync.resume(state['last_update_id'])
+        self.last_event_time = state['event_time']
+        self.publish(force=True)
+        print(f"{self.symbol} restored {len(state['bid'][0])} bids and {len(state['ask'][0])} asks at update "
+              f"{state['last_update_id']} from {self.checkpoint.path} in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return True
 
-    def periodic_clean(self, interval=10):
+    def resync(self):
+        # Buffers diffs again and reloads the book from a fresh REST snapshot;
+        # the current book keeps being served until the snapshot is applied
+        RESYNCS.inc(self.symbol)
+        self.sync.reset()
+        if self.snapshot_task is not None and not self.snapshot_task.done():
+            self.snapshot_task.cancel()
+        self.snapshot_task = asyncio.create_task(self.load_snapshot())
+
+    def fetch_snapshot(self):
+        response = requests.get(self.snapshot_url, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    async def load_snapshot(self, retry_delay=1):
         while True:
-            self.get_best_bid_ask()
-            self.clean_order_book()
-            time.sleep(interval)
+            try:
+                # The book is exactly the snapshot plus the diffs that follow it
+                snapshot = await asyncio.to_thread(self.fetch_snapshot)
+                self.order_book.clear()
+                self.apply_diffs([{'b': snapshot['bids'], 'a': snapshot['asks']}])
+                self.apply_diffs(self.sync.on_snapshot(snapshot['lastUpdateId']))
+                self.publish(force=True)
+                print(f"{self.symbol} synced at update {self.sync.last_update_id}")
+                return
+            except SequenceGap as e:
+                print(f"{self.symbol} snapshot does not bridge the stream ({e}), retrying")
+                self.sync.reset()
+            except Exception as e:
+                print(f"Error fetching snapshot from API: {e}")
+            await asyncio.sleep(retry_delay)
 
     def process_message(self, message):
-        bids = message['b']
-        asks = message['a']
-
-        for bid in bids:
-            price, amount = float(bid[0]), float(bid[1])
-            self.order_book.update('bid', price, amount)
-
-        for ask in asks:
-            price, amount = float(ask[0]), float(ask[1])
-            self.order_book.update('ask', price, amount)
-
-    def get_last_snapshot(self, current_time, tick_size=10, depth=1000):
-        ask_df, bid_df = self.order_book.get_levels(tick_size=tick_size, depth=depth)
-        ask_df['side'] = 'ask'
-        bid_df['side'] = 'bid'
-        snapshot_df = pd.concat([ask_df, bid_df], ignore_index=True)
-        snapshot_df['timestamp'] = current_time
-        return snapshot_df
-    
-    def get_spread(self):
-        self.get_best_bid_ask()
-        return self.best_ask - self.best_bid
-    
-    def get_volume_ask(self):
-        return sum(self.order_book.ask.values())
-    
-    def get_volume_bid(self):
-        return sum(self.order_book.bid.values())
+        self.apply_diffs([message])
+
+    def apply_diffs(self, messages):
+        # Price/amount strings of all messages are converted in one NumPy call
+        # per side and applied to the book in order
+        for side, key in (('bid', 'b'), ('ask', 'a')):
+            levels = [level for message in messages for level in message[key]]
+            if levels:
+                levels = np.array(levels, dtype=float)
+                self.order_book.apply_levels(side, levels[:, 0], levels[:, 1])
@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from aiohttp import web, WSMsgType
+import requests
+import websockets
+from orderbook import OrderBook
+
+# Local stand-in for the Binance futures depth endpoints, to run the
+# aggregator against recorded or synthetic streams:
+#
+#   python server/replay.py serve --speed 10 --gap-every 5000
+#   WS_BASE_URL=ws://127.0.0.1:9000 REST_BASE_URL=http://127.0.0.1:9000 python server/app.py
+#
+# Serves /ws/<symbol>@depth@100ms, combined /stream?streams=... and the REST
+# /fapi/v1/depth snapshot, always consistent with the diffs generated so
+# far. Streams are deterministic for a given seed or input file; speed,
+# fixed rates, bursts, sequence gaps, out-of-order diffs and forced
+# reconnects are injected on top. `record` captures a live stream into a file `serve --input` replays.
+
+class SyntheticDepth:
+    # Random walk book: every diff changes `changes` levels, mostly near the
+    # touch, and the mid moves by a few ticks now and then, deleting the
+    # levels it crosses. Yields (delay in seconds, diff).
+    def __init__(self, symbol, seed=0, mid_price=60000.0, price_tick=0.1, levels=1000, changes=20, interval=0.1):
+        self.symbol = symbol
+        self.random = random.Random(seed)
+        self.price_tick = price_tick
+        self.decimals = max(0, len(f"{price_tick:f}".rstrip('0').split('.')[1]))
+        self.mid = round(mid_price / price_tick)
+        self.levels = levels
+        self.changes = changes
+        self.interval = interval
+        self.update_id = 1000
+
+    def price(self, tick):
+        return f"{tick * self.price_tick:.{self.decimals}f}"
+
+    def amount(self):
+        return f"{self.random.uniform(0.001, 5):.3f}"
+
+    def snapshot(self):
+        return {
+            'lastUpdateId': self.update_id,
+            'bids': [[self.price(self.mid - d), self.amount()] for d in range(1, self.levels + 1)],
+            'asks': [[self.price(self.mid + d), self.amount()] for d in range(1, self.levels + 1)],
+        }
+
+    def __iter__(self):
+        while True:
+            bids, asks = {}, {}
+            if self.random.random() < 0.2:
+                move = self.random.choice((-3, -2, -1, 1, 2, 3))
+                # Levels now on the wrong side of the mid are removed
+                crossed = range(self.mid + 1, self.mid + move + 1) if move > 0 else range(self.mid + move, self.mid)
+                for tick in crossed:
+                    (asks if move > 0 else bids)[tick] = '0'
+                self.mid += move
+            for _ in range(self.changes):
+                distance = min(1 + int(self.random.expovariate(0.1)), self.levels)
+                amount = '0' if self.random.random() < 0.25 else self.amount()
+                if self.random.random() < 0.5:
+                    bids[self.mid - distance] = amount
+                else:
+                    asks[self.mid + distance] = amount
+            previous_id = self.update_id
+            self.update_id += self.random.randint(1, 3)
+            yield self.interval, {
+                'e': 'depthUpdate', 'E': 0, 'T': 0, 's': self.symbol,
+                'U': previous_id + 1, 'u': self.update_id, 'pu': previous_id,
+                'b': [[self.price(tick), amount] for tick, amount in bids.items()],
+                'a': [[self.price(tick), amount] for tick, amount in asks.items()],
+            }
+
+class RecordedDepth:
+    # Replays a file written by `record`: a REST snapshot line followed by
+    # diffs (raw or combined-stream wrapped), paced by their event times
+    def __init__(self, path, symbol=None):
+        with open(path) as f:
+            self.initial = json.loads(f.readline())
+            self.messages = [json.loads(line) for line in f if line.strip()]
+        self.messages = [message.get('data', message) for message in self.messages]
+        self.symbol = symbol or self.messages[0]['s']
+        # Smallest price step the recording shows
+        decimals = max(len(price.split('.')[1]) if '.' in price else 0
+                       for price, _ in self.initial['bids'] + self.initial['asks'])
+        self.price_tick = 10 ** -decimals
+
+    def snapshot(self):
+        return self.initial
+
+    def __iter__(self):
+        previous = None
+        for message in self.messages:
+            if message['u'] < self.initial['lastUpdateId']:
+                continue
+            delay = (message['E'] - previous) / 1000 if previous is not None else 0
+            previous = message['E']
+            yield delay, dict(message)
+
+class DepthFeed:
+    # Book and update id as of the last generated diff, served as the REST
+    # snapshot; diffs dropped as gaps still advance it
+    def __init__(self, source):
+        self.source = source
+        self.symbol = source.symbol
+        self.book = OrderBook(source.price_tick)
+        initial = source.snapshot()
+        self.last_update_id = initial['lastUpdateId']
+        self.apply({'b': initial['bids'], 'a': initial['asks']})
+        self.subscribers = set()
+        self.sent = 0
+
+    def apply(self, message):
+        for side, key in (('bid', 'b'), ('ask', 'a')):
+            for price, amount in message[key]:
+                self.book.update(side, float(price), float(amount))
+        self.last_update_id = message.get('u', self.last_update_id)
+
+    def messages(self, gap_every=None, swap_every=None):
+        # Diffs of the source applied to the served book in order, then
+        # yielded as (delay, diff) to send: every gap_every-th one is dropped
+        # and every swap_every-th one is held back and sent after the next
+        held = None
+        for count, (delay, message) in enumerate(self.source, 1):
+            self.apply(message)
+            if gap_every and count % gap_every == 0:
+                continue
+            if swap_every and count % swap_every == 0 and held is None:
+                held = message
+                continue
+            yield delay, message
+            if held is not None:
+                yield 0, held
+                held = None
+
+    def snapshot(self, limit=1000):
+        bid_prices, bid_amounts = self.book.levels('bid')
+        ask_prices, ask_amounts = self.book.levels('ask')
+        return {
+            'lastUpdateId': self.last_update_id,
+            'E': int(time.time() * 1000),
+            'T': int(time.time() * 1000),
+            'bids': [[str(p), str(a)] for p, a in zip(bid_prices[::-1][:limit].tolist(), bid_amounts[::-1][:limit].tolist())],
+            'asks': [[str(p), str(a)] for p, a in zip(ask_prices[:limit].tolist(), ask_amounts[:limit].tolist())],
+        }
+
+class ReplayServer:
+    def __init__(self, feeds, speed=1.0, rate=None, burst_every=None, burst_size=0, gap_every=None, reconnect_every=None,
+                 swap_every=None):
+        self.feeds = {feed.symbol: feed for feed in feeds}
+        self.speed = speed  # 0 sends as fast as possible
+        self.rate = rate  # fixed messages/sec per symbol, overrides the source pacing
+        self.burst_every = burst_every
+        self.burst_size = burst_size
+        self.gap_every = gap_every
+        self.swap_every = swap_every
+        self.reconnect_every = reconnect_every
+        self.sockets = set()
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/ws/{stream}', self.single_stream)
+        app.router.add_get('/stream', self.combined_stream)
+        app.router.add_get('/fapi/v1/depth', self.depth)
+        app.router.add_get('/api/v3/depth', self.depth)
+        app.router.add_get('/fapi/v1/exchangeInfo', self.exchange_info)
+        return app
+
+    async def exchange_info(self, request):
+        # Only the price filter of each symbol served
+        return web.json_response({'symbols': [
+            {'symbol': symbol, 'filters': [{'filterType': 'PRICE_FILTER', 'tickSize': f"{feed.source.price_tick:f}"}]}
+            for symbol, feed in self.feeds.items()
+        ]})
+
+    async def depth(self, request):
+        feed = self.feeds.get(request.query.get('symbol', '').upper())
+        if feed is None:
+            raise web.HTTPBadRequest(text="unknown symbol")
+        return web.json_response(feed.snapshot(int(request.query.get('limit', 1000))))
+
+    async def single_stream(self, request):
+        symbol = request.match_info['stream'].split('@')[0].upper()
+        if symbol not in self.feeds:
+            raise web.HTTPNotFound(text="unknown stream")
+        return await self.serve_socket(request, {symbol: None})
+
+    async def combined_stream(self, request):
+        streams = request.query.get('streams', '').split('/')
+        wrapped = {stream.split('@')[0].upper(): stream for stream in streams}
+        if not set(wrapped) <= set(self.feeds):
+            raise web.HTTPNotFound(text="unknown stream")
+        return await self.serve_socket(request, wrapped)
+
+    async def serve_socket(self, request, streams):
+        # streams maps symbols to their combined-stream name, None for a raw stream
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscriptions = [(self.feeds[symbol], (ws, stream)) for symbol, stream in streams.items()]
+        for feed, subscription in subscriptions:
+            feed.subscribers.add(subscription)
+        self.sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.sockets.discard(ws)
+            for feed, subscription in subscriptions:
+                feed.subscribers.discard(subscription)
+        return ws
+
+    async def produce(self, feed):
+        last_burst, burst_end = time.time(), 0
+        for count, (delay, message) in enumerate(feed.messages(self.gap_every, self.swap_every), 1):
+            message['E'] = message['T'] = int(time.time() * 1000)
+            frame = json.dumps(message)
+            for ws, stream in list(feed.subscribers):
+                if not ws.closed:
+                    await ws.send_str(frame if stream is None else json.dumps({'stream': stream, 'data': message}))
+            feed.sent += 1
+
+            if self.burst_every and time.time() - last_burst >= self.burst_every:
+                # The next burst_size messages go out back to back
+                last_burst = time.time()
+                burst_end = count + self.burst_size
+            if count < burst_end:
+                if count % 100 == 0:
+                    await asyncio.sleep(0)
+            elif self.rate:
+                await asyncio.sleep(1 / self.rate)
+            elif self.speed:
+                await asyncio.sleep(delay / self.speed)
+            elif count % 100 == 0:
+                await asyncio.sleep(0)
+        print(f"{feed.symbol} source exhausted after {feed.sent} messages")
+
+    async def force_reconnects(self):
+        while True:
+            await asyncio.sleep(self.reconnect_every)
+            print(f"Closing {len(self.sockets)} connections")
+            for ws in list(self.sockets):
+                await ws.close(code=1001, message=b'replay reconnect')
+
+    async def report(self, interval=5):
+        previous = {symbol: 0 for symbol in self.feeds}
+        while True:
+            await asyncio.sleep(interval)
+            rates = {symbol: (feed.sent - previous[symbol]) / interval for symbol, feed in self.feeds.items()}
+            previous = {symbol: feed.sent for symbol, feed in self.feeds.items()}
+            print(' '.join(f"{symbol} {rate:.0f} msg/s" for symbol, rate in rates.items()))
+
+    async def run(self, host='127.0.0.1', port=9000):
+        runner = web.AppRunner(self.create_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        print(f"Replay server on ws://{host}:{port} and http://{host}:{port}")
+        tasks = [asyncio.create_task(self.produce(feed)) for feed in self.feeds.values()]
+        tasks.append(asyncio.create_task(self.report()))
+        if self.reconnect_every:
+            tasks.append(asyncio.create_task(self.force_reconnects()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await runner.cleanup()
+
+async def record(symbol, output, seconds, ws_base_url="wss://fstream.binance.com", rest_base_url="https://fapi.binance.com"):
+    # Writes the REST snapshot then every diff from the snapshot on
+    url = f"{ws_base_url}/ws/{symbol.lower()}@depth@100ms"
+    snapshot_url = f"{rest_base_url}/fapi/v1/depth?symbol={symbol}&limit=1000"
+    messages = []
+    async with websockets.connect(url) as websocket:
+        snapshot_task = None
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            messages.append(await websocket.recv())
+            if snapshot_task is None:
+                snapshot_task = asyncio.create_task(asyncio.to_thread(requests.get, snapshot_url, timeout=10))
+        snapshot = (await snapshot_task).json()
+    with open(output, 'w') as f:
+        f.write(json.dumps(snapshot) + '\n')
+        for message in messages:
+            f.write(message + '\n')
+    print(f"Recorded {len(messages)} diffs of {symbol} to {output}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Depth stream replay server")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve')
+    serve.add_argument('--symbols', default='BTCUSDT', help="comma-separated, synthetic streams")
+    serve.add_argument('--input', help="file written by `record`, replayed instead of a synthetic stream")
+    serve.add_argument('--seed', type=int, default=0)
+    serve.add_argument('--levels', type=int, default=1000, help="synthetic levels per side")
+    serve.add_argument('--changes', type=int, default=20, help="synthetic level changes per diff")
+    serve.add_argument('--price-tick', type=float, default=0.1, help="synthetic price tick")
+    serve.add_argument('--speed', type=float, default=1.0, help="1 real time, 10 ten times faster, 0 as fast as possible")
+    serve.add_argument('--rate', type=float, help="fixed messages/sec per symbol")
+    serve.add_argument('--burst-every', type=float, help="seconds between bursts")
+    serve.add_argument('--burst-size', type=int, default=1000, help="messages sent back to back per burst")
+    serve.add_argument('--gap-every', type=int, help="drop every Nth diff")
+    serve.add_argument('--swap-every', type=int, help="send every Nth diff after the next one")
+    serve.add_argument('--reconnect-every', type=float, help="seconds between forced disconnects")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=9000)
+
+    rec = commands.add_parser('record')
+    rec.add_argument('--symbol', default='BTCUSDT')
+    rec.add_argument('--seconds', type=float, default=600)
+    rec.add_argument('--output', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        asyncio.run(record(args.symbol.upper(), args.output, args.seconds))
+        return
+    if args.input:
+        sources = [RecordedDepth(args.input)]
+    else:
+        sources = [SyntheticDepth(symbol.upper(), args.seed + index, price_tick=args.price_tick, levels=args.levels, changes=args.changes)
+                   for index, symbol in enumerate(args.symbols.split(','))]
+    server = ReplayServer([DepthFeed(source) for source in sources], args.speed, args.rate,
+                          args.burst_every, args.burst_size, args.gap_every, args.reconnect_every, args.swap_every)
+    asyncio.run(server.run(args.host, args.port))
+
+if __name__ == '__main__':
+    main()
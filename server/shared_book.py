@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from aiohttp import web
+from book_view import BookView, BookReader
+from book_routes import symbol_route, add_book_routes, cors, instrument
+from tick_buckets import DEFAULT_TICK_SIZES
+from metrics import registry
+
+# Segment layout, all 8-byte words: a header, then for each side the prices
+# and amounts of up to `capacity` levels (bids best first like BookView),
+# then for each tick size and side the aggregated prices and amounts
+# (ascending), and a last word repeating the sequence of the complete
+# write. Header words:
+SEQUENCE, VERSION, LAST_UPDATE_ID, EVENT_TIME, PUBLISHED_AT, BID_TOTAL, ASK_TOTAL, CAPACITY, TICK_COUNT = range(9)
+# followed by the tick sizes, then the level count of every array pair
+HEADER_FIXED = 9
+
+def segment_name(prefix, symbol):
+    return f"{prefix}_{symbol.lower()}"
+
+class SharedBookLayout:
+    def __init__(self, capacity, tick_sizes):
+        self.capacity = capacity
+        self.tick_sizes = tuple(tick_sizes)
+        # One (prices, amounts) pair per side, then per tick size and side
+        self.pairs = [('levels', 'bid'), ('levels', 'ask')] + [(tick, side) for tick in self.tick_sizes for side in ('bid', 'ask')]
+        self.counts_offset = HEADER_FIXED + len(self.tick_sizes)
+        self.header_words = self.counts_offset + len(self.pairs)
+        self.trailer = self.header_words + 2 * capacity * len(self.pairs)
+        self.words = self.trailer + 1
+
+    def arrays(self, buffer):
+        words = np.ndarray(self.words, dtype=np.int64, buffer=buffer)
+        floats = np.ndarray(self.words, dtype=np.float64, buffer=buffer)
+        pairs = {}
+        offset = self.header_words
+        for key in self.pairs:
+            pairs[key] = (floats[offset:offset + self.capacity], floats[offset + self.capacity:offset + 2 * self.capacity])
+            offset += 2 * self.capacity
+        return words, floats, pairs
+
+class SharedBookWriter:
+    # Publishes the views of one book into a shared memory segment with a
+    # seqlock: the sequence word is odd while a view is being written and
+    # bumped to the next even value once it is complete, after the trailer
+    # word is set to that value, so readers in other processes copy the
+    # arrays and retry unless the sequence is the same before and after the
+    # copy and equal to the trailer. Sides and buckets deeper than
+    # `capacity` levels are truncated away from the touch; totals are stored
+    # separately and stay exact.
+    #
+    # Python cannot issue memory fences: the protocol relies on stores and
+    # loads not being reordered with each other, which x86-64 guarantees.
+    # CPUs with weaker ordering (ARM, POWER) may let a reader see the new
+    # sequence and trailer before all the data; the trailer check makes a
+    # torn copy less likely there but does not rule it out, so run with
+    # HTTP_WORKERS=0 on those.
+    def __init__(self, name, capacity=100_000, tick_sizes=DEFAULT_TICK_SIZES):
+        self.layout = SharedBookLayout(capacity, tick_sizes)
+        try:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=self.layout.words * 8)
+        except FileExistsError:
+            # Left over by a server that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.memory = shared_memory.SharedMemory(name, create=True, size=self.layout.words * 8)
+        self.words, self.floats, self.pairs = self.layout.arrays(self.memory.buf)
+        self.words[CAPACITY] = capacity
+        self.words[TICK_COUNT] = len(self.layout.tick_sizes)
+        self.floats[HEADER_FIXED:HEADER_FIXED + len(self.layout.tick_sizes)] = self.layout.tick_sizes
+        self.published_version = None
+        self.closed = False
+        # Not left in /dev/shm by an exit that skips the server's cleanup
+        atexit.register(self.close)
+
+    def publish(self, view):
+        capacity = self.layout.capacity
+        sources = {
+            ('levels', 'bid'): (view.bid_prices[:capacity], view.bid_amounts[:capacity]),
+            ('levels', 'ask'): (view.ask_prices[:capacity], view.ask_amounts[:capacity]),
+        }
+        for tick in self.layout.tick_sizes:
+            prices, amounts = view.side_levels('bid', tick)
+            sources[(tick, 'bid')] = (prices[-capacity:], amounts[-capacity:])
+            prices, amounts = view.side_levels('ask', tick)
+            sources[(tick, 'ask')] = (prices[:capacity], amounts[:capacity])
+
+        sequence = int(self.words[SEQUENCE]) + 1
+        self.words[SEQUENCE] = sequence
+        self.words[VERSION] = view.version
+        self.words[LAST_UPDATE_ID] = -1 if view.last_update_id is None else view.last_update_id
+        self.words[EVENT_TIME] = -1 if view.event_time is None else view.event_time
+        self.floats[PUBLISHED_AT] = view.published_at
+        self.floats[BID_TOTAL] = view.totals['bid']
+        self.floats[ASK_TOTAL] = view.totals['ask']
+        for index, key in enumerate(self.layout.pairs):
+            prices, amounts = sources[key]
+            target_prices, target_amounts = self.pairs[key]
+            target_prices[:len(prices)] = prices
+            target_amounts[:len(amounts)] = amounts
+            self.words[self.layout.counts_offset + index] = len(prices)
+        self.words[self.layout.trailer] = sequence + 1
+        self.words[SEQUENCE] = sequence + 1
+        self.published_version = view.version
+
+    async def run(self, book, interval=0.02):
+        # Mirrors every new view of `book`, an aggregator or a RemoteBook
+        while True:
+            if book.view.version != self.published_version:
+                self.publish(book.view)
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # The arrays over the buffer have to go before it can be closed
+        del self.words, self.floats, self.pairs
+        self.memory.close()
+        self.memory.unlink()
+
+class SharedBook(BookReader):
+    # Read-only BookReader over a segment written by SharedBookWriter. A view
+    # is rebuilt only when the writer has published a new version; requests
+    # in between reuse it.
+    def __init__(self, name, symbol, retries=1000):
+        self.symbol = symbol
+        self.retries = retries
+        self.memory = shared_memory.SharedMemory(name)
+        # Attaching registers the segment with the resource tracker, which
+        # unlinks what is still registered when it exits. A standalone worker
+        # has a tracker of its own and unregisters; workers spawned by the
+        # server share its tracker, where the writer's registration has to
+        # stay until the writer unlinks the segment
+        if multiprocessing.parent_process() is None:
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+        header = np.ndarray(HEADER_FIXED, dtype=np.int64, buffer=self.memory.buf)
+        tick_sizes = np.ndarray(int(header[TICK_COUNT]), dtype=np.float64, buffer=self.memory.buf, offset=HEADER_FIXED * 8)
+        self.layout = SharedBookLayout(int(header[CAPACITY]), [int(tick) if tick == int(tick) else float(tick) for tick in tick_sizes])
+        self.words, self.floats, self.pairs = self.layout.arrays(self.memory.buf)
+        self.cached = BookView.empty()
+        self.cached_sequence = None
+
+    @property
+    def view(self):
+        sequence = int(self.words[SEQUENCE])
+        if sequence != self.cached_sequence and sequence % 2 == 0:
+            self.read()
+        return self.cached
+
+    def read(self):
+        # Copies the segment until the sequence read before and after the
+        # copy and the trailer all agree; if the writer keeps it busy for
+        # `retries` attempts the previous view stays
+        for _ in range(self.retries):
+            before = int(self.words[SEQUENCE])
+            if before % 2:
+                time.sleep(0)
+                continue
+            header = self.words[:self.layout.header_words].copy()
+            floats = header.view(np.float64)
+            counts = header[self.layout.counts_offset:]
+            pairs = {key: (prices[:count].copy(), amounts[:count].copy())
+                     for (key, (prices, amounts)), count in zip(self.pairs.items(), counts.tolist())}
+            if int(self.words[self.layout.trailer]) != before or int(self.words[SEQUENCE]) != before:
+                continue
+            break
+        else:
+            return
+
+        bid_prices, bid_amounts = pairs[('levels', 'bid')]
+        buckets = {tick: {side: pairs[(tick, side)] for side in ('bid', 'ask')} for tick in self.layout.tick_sizes}
+        view = BookView(int(header[VERSION]), None if header[LAST_UPDATE_ID] < 0 else int(header[LAST_UPDATE_ID]),
+                        None if header[EVENT_TIME] < 0 else int(header[EVENT_TIME]),
+                        (bid_prices[::-1], bid_amounts[::-1]), pairs[('levels', 'ask')], buckets)
+        view.published_at = float(floats[PUBLISHED_AT])
+        view.totals = {'bid': float(floats[BID_TOTAL]), 'ask': float(floats[ASK_TOTAL])}
+        self.cached = view
+        self.cached_sequence = before
+
+def attach(name, symbol, timeout=30):
+    # Waits for the ingesting process to create the segment
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return SharedBook(name, symbol)
+        except FileNotFoundError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+def create_read_app(books, default_symbol):
+    routes = web.RouteTableDef()
+
+    def book_of(request):
+        symbol = request.match_info.get('symbol', default_symbol).upper()
+        if symbol not in books:
+            raise web.HTTPNotFound(text=f"unknown symbol {symbol}")
+        return books[symbol]
+
+    add_book_routes(symbol_route(routes), book_of)
+    app = web.Application(middlewares=[instrument, cors])
+    app.add_routes(routes)
+    return app
+
+async def export_metrics(updates, key, interval=1):
+    # This worker's serve times, added to the ingesting server's /metrics
+    while True:
+        updates.put((key, registry.state()))
+        await asyncio.sleep(interval)
+
+async def serve_reads(symbols, prefix, host, port, updates=None, key=None):
+    books = {symbol: attach(segment_name(prefix, symbol), symbol) for symbol in symbols}
+    runner = web.AppRunner(create_read_app(books, symbols[0]), access_log=None)
+    await runner.setup()
+    # Every worker binds the same port; the kernel spreads connections
+    site = web.TCPSite(runner, host, port, backlog=1024, reuse_port=True)
+    await site.start()
+    print(f"Read worker listening on {host}:{port}")
+    exporter = asyncio.create_task(export_metrics(updates, key)) if updates is not None else None
+    # Exits with the process that started it, which may die without
+    # terminating its daemon children
+    parent = os.getppid()
+    try:
+        while os.getppid() == parent:
+            await asyncio.sleep(1)
+    finally:
+        if exporter is not None:
+            exporter.cancel()
+        await runner.cleanup()
+
+def run_reader(symbols, prefix, host, port, updates=None, key=None):
+    asyncio.run(serve_reads(symbols, prefix, host, port, updates, key))
+
+class ReadWorkers:
+    # `workers` processes serving the BookReader endpoints of `symbols` from
+    # shared memory on `port`, restarted if they die. Workers are spawned
+    # rather than forked from the running event loop.
+    def __init__(self, symbols, workers, prefix, host, port):
+        self.args = (symbols, prefix, host, port)
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = [None] * workers
+        self.updates = self.context.Queue()
+        # Latest metrics state of each worker, see Registry.render
+        self.worker_metrics = {}
+
+    def start_worker(self, index):
+        worker = self.context.Process(target=run_reader, args=(*self.args, self.updates, f"reader-{index}"), daemon=True)
+        worker.start()
+        self.workers[index] = worker
+
+    def receive_metrics(self):
+        while True:
+            key, state = self.updates.get()
+            self.worker_metrics[key] = state
+
+    async def run(self, check_interval=5):
+        threading.Thread(target=self.receive_metrics, daemon=True).start()
+        for index in range(len(self.workers)):
+            self.start_worker(index)
+        while True:
+            await asyncio.sleep(check_interval)
+            for index, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    print(f"Read worker exited ({worker.exitcode}), restarting")
+                    self.start_worker(index)
+
+def main():
+    # Standalone read worker attaching to the segments of a running app.py
+    parser = argparse.ArgumentParser(description="Serve order book reads from shared memory")
+    parser.add_argument('--symbols', default='BTCUSDT', help="comma-separated")
+    parser.add_argument('--prefix', default='orderbook', help="SHARED_BOOK_PREFIX of the ingesting server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+    run_reader(args.symbols.upper().split(','), args.prefix, args.host, args.port)
+
+if __name__ == '__main__':
+    main()
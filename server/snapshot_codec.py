@@ -0,0 +1,20 @@
+import struct
+import numpy as np
+
+# Columnar binary layout of a /snapshot response, all little-endian:
+#
+#   header   magic b'OBK1' | version u8 | reserved u8 | reserved u16
+#            | timestamp i64 (µs) | ask count u32 | bid count u32
+#   body     ask prices f64[ask count] | ask amounts f64[ask count]
+#            | bid prices f64[bid count] | bid amounts f64[bid count]
+#
+# Prices are ascending on both sides. dashboard/snapshot_codec.py decodes it.
+CONTENT_TYPE = 'application/x-orderbook-columns'
+MAGIC = b'OBK1'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHqII')
+
+def encode_snapshot(timestamp, ask_df, bid_df):
+    columns = [ask_df['price'], ask_df['amount'], bid_df['price'], bid_df['amount']]
+    header = HEADER.pack(MAGIC, VERSION, 0, 0, int(timestamp), len(ask_df), len(bid_df))
+    return header + b''.join(column.to_numpy(dtype=np.float64).tobytes() for column in columns)
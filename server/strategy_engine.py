@@ -0,0 +1,147 @@
+import bisect
+import time
+from collections import deque
+from book_sync import BookSync
+
+def history_columns(history, since=None):
+    # (timestamp µs, portfolio value, buy and hold value) samples newer than
+    # `since` as parallel lists
+    samples = [sample for sample in history if since is None or sample[0] > since]
+    return {
+        'timestamp': [sample[0] for sample in samples],
+        'portfolio_value': [sample[1] for sample in samples],
+        'buy_and_hold_value': [sample[2] for sample in samples],
+    }
+
+class WindowQuantiles:
+    # Values seen over the last `window` seconds kept in a sorted list, so
+    # each new value costs one insort plus one removal per expired value.
+    # Quantiles interpolate linearly like pandas.
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.sorted = []
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def push(self, timestamp, value):
+        self.values.append((timestamp, value))
+        bisect.insort(self.sorted, value)
+        while self.values[0][0] < timestamp - self.window:
+            del self.sorted[bisect.bisect_left(self.sorted, self.values.popleft()[1])]
+
+    def quantile(self, q):
+        if not self.sorted:
+            return None
+        position = q * (len(self.sorted) - 1)
+        lower = int(position)
+        upper = min(lower + 1, len(self.sorted) - 1)
+        return self.sorted[lower] + (self.sorted[upper] - self.sorted[lower]) * (position - lower)
+
+class ImbalanceStrategy:
+    # Headless volume imbalance strategy run on every batch of diffs applied
+    # by an OrderBookAggregator: buys with the whole balance when the
+    # imbalance within `depth` bps rises above its rolling `quantile` over
+    # the last `window` seconds, sells everything when it falls below the
+    # 1 - quantile level, at most one trade per `cooldown` seconds. Trades
+    # are simulated at the best bid. `state()` is what /strategy serves.
+    # With `depth` None the imbalance is the whole book's, read from the
+    # side totals the engines maintain instead of summing every level.
+    def __init__(self, aggregator, depth=None, window=600, quantile=0.80, cooldown=60,
+                 initial_balance=10000, fee_rate=0.0004, history_interval=1, history_size=3600):
+        self.aggregator = aggregator
+        self.depth = depth
+        self.quantile = quantile
+        self.cooldown = cooldown
+        self.initial_balance = initial_balance
+        self.fee_rate = fee_rate
+        self.quantiles = WindowQuantiles(window)
+        self.balance = initial_balance
+        self.position = 0.0
+        self.first_price = None
+        self.price = None
+        self.imbalance = None
+        self.thresholds = (None, None)
+        self.last_trade = None
+        self.trades = 0
+        self.decision_latency_ms = None
+        # Portfolio samples for the dashboard chart, one per history_interval
+        self.history_interval = history_interval
+        self.history = deque(maxlen=history_size)
+        aggregator.diff_listeners.append(self.on_diffs)
+        aggregator.strategy = self
+
+    def on_diffs(self, diffs):
+        if self.aggregator.sync.state != BookSync.LIVE:
+            return
+        order_book = self.aggregator.order_book
+        best_bid, best_ask = order_book.best_prices()
+        if best_bid is None or best_ask is None:
+            return
+        now = time.time()
+        if self.depth is None:
+            bid, ask = order_book.totals['bid'], order_book.totals['ask']
+        else:
+            bid = order_book.cumulative_volume('bid', self.depth)
+            ask = order_book.cumulative_volume('ask', self.depth)
+        self.imbalance = float((bid - ask) / (bid + ask)) if bid + ask else 0.0
+        self.price = best_bid
+        if self.first_price is None:
+            self.first_price = best_bid
+        self.quantiles.push(now, self.imbalance)
+        self.decide(now)
+        event_time = diffs[-1].get('E')
+        if event_time is not None:
+            self.decision_latency_ms = time.time() * 1000 - event_time
+        self.record(now)
+
+    def decide(self, now):
+        upper, lower = self.quantiles.quantile(self.quantile), self.quantiles.quantile(1 - self.quantile)
+        self.thresholds = (upper, lower)
+        if self.last_trade is not None and now - self.last_trade['time'] < self.cooldown:
+            return
+        if self.imbalance > upper and self.position == 0:
+            self.position = self.balance / self.price
+            self.balance = 0
+            self.trade(now, 'buy')
+        elif self.imbalance < lower and self.position > 0:
+            self.balance = self.position * self.price * (1 - self.fee_rate)
+            self.position = 0
+            self.trade(now, 'sell')
+
+    def trade(self, now, action):
+        self.trades += 1
+        self.last_trade = {'time': now, 'action': action, 'price': self.price, 'imbalance': self.imbalance}
+        print(f"{self.aggregator.symbol} strategy {action} at {self.price}")
+
+    def portfolio_value(self):
+        return self.balance + self.position * self.price
+
+    def buy_and_hold_value(self):
+        return self.initial_balance / self.first_price * self.price
+
+    def record(self, now):
+        if self.history and now - self.history[-1][0] / 1e6 < self.history_interval:
+            return
+        self.history.append((int(now * 1e6), self.portfolio_value(), self.buy_and_hold_value()))
+
+    def state(self, since=None):
+        # Current portfolio and the history samples newer than `since` (µs)
+        return {**self.summary(), 'history': history_columns(self.history, since)}
+
+    def summary(self):
+        upper, lower = self.thresholds
+        return {
+            'imbalance': self.imbalance,
+            'upper_threshold': upper,
+            'lower_threshold': lower,
+            'price': self.price,
+            'balance': self.balance,
+            'position': self.position,
+            'portfolio_value': self.portfolio_value() if self.price is not None else self.initial_balance,
+            'buy_and_hold_value': self.buy_and_hold_value() if self.price is not None else self.initial_balance,
+            'trades': self.trades,
+            'last_trade': self.last_trade,
+            'decision_latency_ms': self.decision_latency_ms,
+        }
@@ -0,0 +1,171 @@
+import asyncio
+import json
+from collections import deque
+from tick_buckets import tick_size_of
+
+CHANNELS = ('levels', 'totals', 'spread', 'diffs')
+MIN_INTERVAL_MS = 100
+
+class Channel:
+    # One computed payload per tick, fanned out to every subscriber of the
+    # same channel parameters. New subscribers get a full image first, then
+    # only what changed since the previous tick.
+    def __init__(self, hub, key):
+        self.hub = hub
+        self.key = key
+        self.name, self.params, self.interval_ms = key[0], dict(key[1]), key[2]
+        self.subscribers = set()
+        self.state = None
+        self.pending_diffs = {'bid': {}, 'ask': {}}
+        self.task = None
+
+    def describe(self):
+        return {'channel': self.name, **self.params, 'interval_ms': self.interval_ms}
+
+    def image(self):
+        view = self.hub.aggregator.view
+        if self.name == 'levels':
+            ask_df, bid_df = view.get_levels(self.params['tick_size'], self.params['depth'])
+            return {
+                'bid': dict(zip(bid_df['price'].tolist(), bid_df['amount'].tolist())),
+                'ask': dict(zip(ask_df['price'].tolist(), ask_df['amount'].tolist())),
+            }
+        if self.name == 'totals':
+            return dict(view.totals)
+        if self.name == 'spread':
+            best_bid, best_ask = view.best_prices()
+            return {'best_bid': best_bid, 'best_ask': best_ask, 'mid': view.mid_price(), 'spread': view.spread()}
+        image = {
+            'bid': dict(zip(view.bid_prices.tolist(), view.bid_amounts.tolist())),
+            'ask': dict(zip(view.ask_prices.tolist(), view.ask_amounts.tolist())),
+        }
+        # The view can be up to a publish interval old: the diffs applied
+        # since bring the image up to the live book
+        for message in self.hub.recent_diffs:
+            for side, key in (('bid', 'b'), ('ask', 'a')):
+                for price, amount in message[key]:
+                    price, amount = float(price), float(amount)
+                    if amount:
+                        image[side][price] = amount
+                    else:
+                        image[side].pop(price, None)
+        return image
+
+    def encode(self, kind, data):
+        if self.name in ('levels', 'diffs'):
+            data = {side: [[price, amount] for price, amount in data[side].items()] for side in ('bid', 'ask')}
+        view = self.hub.aggregator.view
+        # Raw diffs are stamped with the last diff they include
+        update_id = self.hub.last_update_id if self.name == 'diffs' else view.last_update_id
+        return json.dumps({'type': kind, **self.describe(), 'version': view.version,
+                           'update_id': update_id, 'event_time': view.event_time, 'data': data})
+
+    def delta(self):
+        if self.name == 'diffs':
+            diffs, self.pending_diffs = self.pending_diffs, {'bid': {}, 'ask': {}}
+            return diffs if diffs['bid'] or diffs['ask'] else None
+
+        state = self.image()
+        previous, self.state = self.state, state
+        if self.name in ('totals', 'spread'):
+            return state if state != previous else None
+
+        changes = {}
+        for side in ('bid', 'ask'):
+            old, new = previous[side], state[side]
+            changed = {price: amount for price, amount in new.items() if old.get(price) != amount}
+            changed.update((price, 0.0) for price in old.keys() - new.keys())
+            changes[side] = changed
+        return changes if changes['bid'] or changes['ask'] else None
+
+    def record_diffs(self, updates):
+        for message in updates:
+            for side, key in (('bid', 'b'), ('ask', 'a')):
+                self.pending_diffs[side].update((float(price), float(amount)) for price, amount in message[key])
+
+    async def subscribe(self, ws):
+        if self.state is None and self.name != 'diffs':
+            self.state = self.image()
+        image = self.state if self.name != 'diffs' else self.image()
+        self.subscribers.add(ws)
+        await ws.send_str(self.encode('snapshot', image))
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self.subscribers:
+            await asyncio.sleep(self.interval_ms / 1000)
+            changes = self.delta()
+            if changes is not None:
+                await self.broadcast(self.encode('delta', changes))
+
+    async def broadcast(self, payload):
+        subscribers = list(self.subscribers)
+        results = await asyncio.gather(*(ws.send_str(payload) for ws in subscribers), return_exceptions=True)
+        for ws, result in zip(subscribers, results):
+            if isinstance(result, Exception):
+                self.hub.unsubscribe(ws, self)
+
+class StreamHub:
+    # Subscription requests are JSON messages such as
+    #   {"op": "subscribe", "channel": "levels", "tick_size": 10, "depth": 500, "interval_ms": 1000}
+    #   {"op": "subscribe", "channel": "totals" | "spread" | "diffs", "interval_ms": 250}
+    #   {"op": "unsubscribe", ...same fields...}
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.channels = {}
+        # Diffs applied after the published view, replayed onto the image of
+        # new diffs subscribers, and the update id of the last diff seen
+        self.recent_diffs = deque()
+        self.last_update_id = None
+        aggregator.diff_listeners.append(self.on_diffs)
+
+    def channel_key(self, request):
+        name = request.get('channel')
+        if name not in CHANNELS:
+            raise ValueError(f"unknown channel {name!r}, expected one of {', '.join(CHANNELS)}")
+        interval_ms = max(int(request.get('interval_ms', 1000)), MIN_INTERVAL_MS)
+        params = ()
+        if name == 'levels':
+            params = (('tick_size', tick_size_of(request.get('tick_size', 10))), ('depth', int(request.get('depth', 1000))))
+        return (name, params, interval_ms)
+
+    async def handle_request(self, ws, request):
+        if not isinstance(request, dict):
+            raise ValueError(f"expected a JSON object, got {type(request).__name__}")
+        op = request.get('op', 'subscribe')
+        key = self.channel_key(request)
+        if op == 'subscribe':
+            channel = self.channels.get(key)
+            if channel is None:
+                channel = self.channels[key] = Channel(self, key)
+            await channel.subscribe(ws)
+        elif op == 'unsubscribe':
+            if key in self.channels:
+                self.unsubscribe(ws, self.channels[key])
+        else:
+            raise ValueError(f"unknown op {op!r}")
+
+    def unsubscribe(self, ws, channel):
+        channel.subscribers.discard(ws)
+        if not channel.subscribers:
+            if channel.task is not None:
+                channel.task.cancel()
+            self.channels.pop(channel.key, None)
+
+    def unsubscribe_all(self, ws):
+        for channel in list(self.channels.values()):
+            if ws in channel.subscribers:
+                self.unsubscribe(ws, channel)
+
+    def on_diffs(self, updates):
+        view_id = self.aggregator.view.last_update_id
+        self.recent_diffs.extend(updates)
+        self.last_update_id = updates[-1].get('u', self.last_update_id)
+        if view_id is None:
+            self.recent_diffs.clear()
+        while self.recent_diffs and self.recent_diffs[0]['u'] <= view_id:
+            self.recent_diffs.popleft()
+        for channel in self.channels.values():
+            if channel.name == 'diffs':
+                channel.record_diffs(updates)
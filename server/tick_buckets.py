@@ -0,0 +1,27 @@
+import numpy as np
+
+# Tick sizes kept precomputed for shared-memory readers, in price ticks of
+# the symbol: 1, 10, 20, 50 and 100 for a 0.1 price tick
+TICK_MULTIPLES = (10, 100, 200, 500, 1000)
+
+def tick_size_of(value):
+    # Integral tick sizes are kept as ints so 10 and "10.0" are one key
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+def default_tick_sizes(price_tick):
+    return tuple(tick_size_of(round(price_tick * multiple, 10)) for multiple in TICK_MULTIPLES)
+
+DEFAULT_TICK_SIZES = default_tick_sizes(0.1)
+
+def bucket_levels(prices, amounts, tick_size):
+    # Levels of one side, prices ascending, summed per bucket index
+    # round(price / tick_size) as in OrderBook.get_levels. Returns the bucket
+    # prices (ascending) and amounts; the levels are already sorted, so each
+    # bucket is a contiguous run and one reduceat sums them all.
+    if not len(prices):
+        return np.empty(0), np.empty(0)
+    keys = np.round(prices / tick_size)
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    # Rounded so sub-unit tick sizes give 60000.1 rather than 60000.100000000006
+    return np.round(keys[starts] * tick_size, 10), np.add.reduceat(amounts, starts)
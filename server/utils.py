@@ -0,0 +1,19 @@
+import json
+import numpy as np
+
+# Fastest available JSON decoder, plain json when no faster one is installed
+try:
+    import orjson # type: ignore
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson # type: ignore
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+def last_occurrences(keys):
+    # Indices of the last occurrence of each distinct key, so that applying a
+    # batch of level changes keeps the latest amount for every price
+    _, first_reversed = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - first_reversed
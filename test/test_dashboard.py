@@ -0,0 +1,153 @@
+import copy
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Dashboard modules import each other by bare name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dashboard'))
+
+from storage import SnapshotStore, SIDES
+from tiles import TilePyramid, time_resolutions
+from heatmap import OrderbookHeatmap
+from backtest import rolling_quantiles, simulate
+
+def snapshots(start, count, interval):
+    # `count` snapshots `interval` seconds apart, one bid and one ask each
+    timestamps = np.repeat(start + np.arange(count) * int(interval * 1e6), 2)
+    return pd.DataFrame({
+        'timestamp': timestamps,
+        'price': np.tile([60000.0, 60020.0], count),
+        'amount': np.ones(2 * count),
+        'side': pd.Categorical(np.tile(['bid', 'ask'], count), categories=SIDES),
+    })
+
+def test_finest_resolution_is_the_recording_interval():
+    assert time_resolutions(60) == (60, 900, 3600)
+    assert time_resolutions(1) == (1, 10, 60, 900, 3600)
+
+def test_pyramid_queries_one_column_per_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'snapshots'))
+    start = 1_699_999_200 * 10 ** 6  # on an hour boundary
+    store.append(snapshots(start, 61, 60))
+    pyramid = TilePyramid(store, str(tmp_path / 'tiles'), record_interval=60)
+    pyramid.update()
+    pyramid.refresh()
+    times, prices, matrix, mid_price = pyramid.query(start, start + 3600 * 10 ** 6, 59000, 61000)
+    # The last snapshot's slot is not complete yet
+    assert len(times) == 60
+    assert np.diff(times).tolist() == [60 * 10 ** 6] * 59
+
+def apply_patch(figure, patch):
+    # What the Dash renderer does with a Patch: extend concatenates lists
+    for operation in patch.to_plotly_json()['operations']:
+        *path, last = operation['location']
+        target = figure
+        for key in path:
+            target = target[key]
+        if operation['operation'] == 'Extend':
+            assert isinstance(target[last], list)
+            target[last] = target[last] + list(operation['params']['value'])
+        elif operation['operation'] == 'Delete':
+            assert isinstance(target, list)
+            del target[last]
+        else:
+            target[last] = operation['params']['value']
+    return figure
+
+def test_live_patch_applies_to_the_full_figure(tmp_path):
+    heatmap = OrderbookHeatmap(str(tmp_path / 'snapshots'))
+    start = 1_699_999_200 * 10 ** 6
+    df = snapshots(start, 5, 60)
+    columns = lambda rows: (df['timestamp'].to_numpy()[rows], df['price'].to_numpy()[rows],
+                            df['amount'].to_numpy()[rows], df['side'].cat.codes.to_numpy()[rows])
+    heatmap.add_columns(*columns(slice(0, 6)))
+    figure, drawn = heatmap.create_heatmap()
+
+    # Two snapshots added, the oldest dropped
+    heatmap.add_columns(*columns(slice(6, 10)))
+    heatmap.drop_columns(start)
+    patch, drawn = heatmap.live_patch(drawn)
+    patched = apply_patch(copy.deepcopy(figure), patch)
+
+    expected, _ = heatmap.create_heatmap()
+    for trace, key in ((0, 'x'), (0, 'z'), (1, 'x'), (1, 'y')):
+        assert patched['data'][trace][key] == expected['data'][trace][key]
+    assert len(patched['data'][0]['x']) == 4
+
+def load_module(directory, name):
+    # Loaded from its path under a prefixed name: server/ and dashboard/
+    # both have a snapshot_codec module
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), directory, f'{name}.py')
+    spec = importlib.util.spec_from_file_location(f'{directory}_{name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_snapshot_codec_round_trip():
+    server_codec = load_module('server', 'snapshot_codec')
+    decode_snapshot = load_module('dashboard', 'snapshot_codec').decode_snapshot
+    ask_df = pd.DataFrame({'price': [60001.0, 60002.5], 'amount': [0.5, 1.25]})
+    bid_df = pd.DataFrame({'price': [59990.0, 59999.9, 60000.0], 'amount': [3.0, 0.001, 2.0]})
+    payload = server_codec.encode_snapshot(1_700_000_000_123_456, ask_df, bid_df)
+    assert len(payload) == server_codec.HEADER.size + 8 * 2 * 5
+
+    df = decode_snapshot(payload)
+    assert (df['timestamp'] == 1_700_000_000_123_456).all()
+    assert df['side'].tolist() == ['ask'] * 2 + ['bid'] * 3
+    assert df['price'].tolist() == ask_df['price'].tolist() + bid_df['price'].tolist()
+    assert df['amount'].tolist() == ask_df['amount'].tolist() + bid_df['amount'].tolist()
+
+    empty = pd.DataFrame({'price': np.empty(0), 'amount': np.empty(0)})
+    assert decode_snapshot(server_codec.encode_snapshot(0, empty, empty)).empty
+    with pytest.raises(ValueError):
+        decode_snapshot(b'JSON' + payload[4:])
+
+def step_by_step(timestamps, imbalance, price, upper, lower, cooldown, fee_rate=0.0004, initial_balance=10000):
+    # The live strategy's loop (server/strategy_engine.py) one sample at a time
+    cash, units, last_trade, trades, notional, equity = initial_balance, 0.0, None, 0, 0.0, []
+    for t, value, p, high, low in zip(timestamps, imbalance, price, upper, lower):
+        if last_trade is None or t - last_trade >= cooldown * 1e6:
+            if value > high and units == 0:
+                units, cash = cash / p, 0.0
+                notional += units * p
+                last_trade, trades = t, trades + 1
+            elif value < low and units > 0:
+                cash, units = units * p * (1 - fee_rate), 0.0
+                notional += cash
+                last_trade, trades = t, trades + 1
+        equity.append(cash + units * p)
+    equity = np.array(equity)
+    return {
+        'trades': trades,
+        'pnl': equity[-1] - initial_balance,
+        'return': equity[-1] / initial_balance - 1,
+        'max_drawdown': np.max(1 - equity / np.maximum.accumulate(equity)),
+        'turnover': notional / initial_balance,
+    }
+
+def test_simulate_matches_the_step_by_step_strategy():
+    rng = np.random.default_rng(11)
+    timestamps = np.cumsum(rng.integers(1, 3, 2000)) * 10 ** 6
+    imbalance = np.clip(np.cumsum(rng.normal(0, 0.05, 2000)) * 0.1, -1, 1)
+    price = 60000 * np.exp(np.cumsum(rng.normal(0, 1e-4, 2000)))
+    thresholds = rolling_quantiles(timestamps, imbalance, 120, [0.2, 0.8])
+    for cooldown in (0, 30, 300):
+        result = simulate(timestamps, imbalance, price, thresholds[0.8], thresholds[0.2], cooldown)
+        expected = step_by_step(timestamps, imbalance, price, thresholds[0.8], thresholds[0.2], cooldown)
+        assert result['trades'] == expected['trades'] > 0
+        for key in ('pnl', 'return', 'max_drawdown', 'turnover'):
+            assert result[key] == pytest.approx(expected[key])
+
+def test_rolling_quantiles_over_the_time_window():
+    rng = np.random.default_rng(12)
+    timestamps = np.cumsum(rng.integers(1, 4, 300)) * 10 ** 6
+    values = rng.normal(size=300)
+    results = rolling_quantiles(timestamps, values, 20, [0.25, 0.9], chunk_cells=64)
+    for i in range(len(values)):
+        window = values[:i + 1][timestamps[:i + 1] >= timestamps[i] - 20 * 10 ** 6]
+        for q in (0.25, 0.9):
+            assert results[q][i] == pytest.approx(np.quantile(window, q))
@@ -0,0 +1,563 @@
+import asyncio
+import json
+import os
+import pickle
+import sys
+from multiprocessing import resource_tracker
+
+import numpy as np
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+# Server modules import each other by bare name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+
+from book_sync import BookSync, SequenceGap
+from exchange_info import DEFAULT_PRICE_TICK, parse_price_ticks, price_ticks
+from orderbook import OrderBook
+from array_orderbook import ArrayOrderBook
+from replay import DepthFeed, SyntheticDepth
+from book_view import BookView
+from shared_book import SharedBook, SharedBookWriter, SEQUENCE
+from tick_buckets import bucket_levels, default_tick_sizes
+import orderbook_aggregator
+from orderbook_aggregator import OrderBookAggregator
+from streaming import StreamHub, Channel
+from book_routes import add_book_routes, symbol_route
+from multi_symbol import ShardIngestor
+from ingest import IngestQueue, coalesce_messages
+from checkpoint import BookCheckpoint
+from history import SnapshotHistory
+from strategy_engine import WindowQuantiles
+from metrics import Registry, RECONNECTS
+from analytics import OrderFlowAnalytics
+
+def futures_diff(first_id, final_id, previous_id):
+    return {'U': first_id, 'u': final_id, 'pu': previous_id, 'b': [], 'a': []}
+
+def spot_diff(first_id, final_id):
+    return {'U': first_id, 'u': final_id, 'b': [], 'a': []}
+
+def test_buffers_until_snapshot():
+    sync = BookSync()
+    assert sync.on_message(futures_diff(95, 98, 94)) == []
+    assert sync.state == BookSync.BUFFERING
+    assert len(sync.buffer) == 1
+
+def test_snapshot_bridge_drops_older_diffs():
+    sync = BookSync()
+    stale = futures_diff(90, 94, 89)
+    bridge = futures_diff(95, 101, 94)
+    following = futures_diff(102, 104, 101)
+    for message in (stale, bridge, following):
+        sync.on_message(message)
+    assert sync.on_snapshot(100) == [bridge, following]
+    assert sync.last_update_id == 104
+
+def test_futures_bridge_on_diff_following_the_snapshot():
+    sync = BookSync()
+    following = futures_diff(101, 103, 100)
+    sync.on_message(following)
+    assert sync.on_snapshot(100) == [following]
+
+def test_spot_bridge():
+    # U <= lastUpdateId + 1 <= u
+    sync = BookSync()
+    stale = spot_diff(95, 100)
+    bridge = spot_diff(101, 103)
+    sync.on_message(stale)
+    sync.on_message(bridge)
+    assert sync.on_snapshot(100) == [bridge]
+    assert sync.on_message(spot_diff(104, 105)) != []
+    with pytest.raises(SequenceGap):
+        sync.on_message(spot_diff(107, 108))
+
+def test_snapshot_older_than_buffered_diffs():
+    sync = BookSync()
+    sync.on_message(futures_diff(105, 107, 104))
+    with pytest.raises(SequenceGap):
+        sync.on_snapshot(100)
+
+def test_pu_chaining():
+    sync = BookSync()
+    sync.on_snapshot(100)
+    assert sync.on_message(futures_diff(99, 102, 98)) != []
+    assert sync.on_message(futures_diff(103, 105, 102)) != []
+    # Already applied
+    assert sync.on_message(futures_diff(103, 105, 102)) == []
+    with pytest.raises(SequenceGap):
+        sync.on_message(futures_diff(108, 110, 107))
+
+def test_reset_and_resume():
+    sync = BookSync()
+    sync.on_snapshot(100)
+    sync.on_message(futures_diff(99, 102, 98))
+    sync.reset()
+    assert sync.state == BookSync.BUFFERING
+    assert sync.last_update_id is None
+    assert sync.on_message(futures_diff(103, 105, 102)) == []
+
+    sync.resume(200)
+    assert sync.state == BookSync.LIVE
+    assert len(sync.buffer) == 0
+    assert sync.on_message(futures_diff(195, 200, 194)) == []
+    assert sync.on_message(futures_diff(201, 203, 200)) != []
+    with pytest.raises(SequenceGap):
+        sync.on_message(futures_diff(206, 207, 205))
+
+@pytest.mark.parametrize('gap_every,swap_every', [(None, 7), (11, None), (11, 7)])
+def test_resync_against_replay_feed(gap_every, swap_every):
+    # Diffs from the replay feed with dropped and out-of-order messages, a
+    # new snapshot taken on every gap: the book ends up equal to the feed's
+    feed = DepthFeed(SyntheticDepth('BTCUSDT', seed=1, levels=200, changes=10))
+    book = OrderBook()
+    sync = BookSync()
+
+    def apply(message):
+        for side, key in (('bid', 'b'), ('ask', 'a')):
+            for price, amount in message[key]:
+                book.update(side, float(price), float(amount))
+
+    def load_snapshot():
+        snapshot = feed.snapshot(limit=10 ** 6)
+        book.clear()
+        apply({'b': snapshot['bids'], 'a': snapshot['asks']})
+        for message in sync.on_snapshot(snapshot['lastUpdateId']):
+            apply(message)
+
+    load_snapshot()
+    gaps = 0
+    messages = feed.messages(gap_every, swap_every)
+    # Stops once every generated diff is applied, not on a held back one
+    for count in range(1000):
+        _, message = next(messages)
+        try:
+            for accepted in sync.on_message(message):
+                apply(accepted)
+        except SequenceGap:
+            gaps += 1
+            sync.reset()
+            sync.on_message(message)
+            load_snapshot()
+        if count >= 200 and sync.last_update_id == feed.last_update_id:
+            break
+    assert gaps > 0
+    assert sync.last_update_id == feed.last_update_id
+    for side in ('bid', 'ask'):
+        prices, amounts = book.levels(side)
+        feed_prices, feed_amounts = feed.book.levels(side)
+        np.testing.assert_allclose(prices, feed_prices)
+        np.testing.assert_allclose(amounts, feed_amounts)
+
+def test_price_ticks_configured_or_default():
+    configured = parse_price_ticks("ethusdt:0.01, SOLUSDT:0.001")
+    # Nothing listens there, the exchange info cannot be fetched
+    ticks = price_ticks(['ETHUSDT', 'BTCUSDT'], 'http://127.0.0.1:9', configured)
+    assert ticks == {'ETHUSDT': 0.01, 'BTCUSDT': DEFAULT_PRICE_TICK}
+
+def test_tick_sizes_follow_the_price_tick():
+    assert default_tick_sizes(0.1) == (1, 10, 20, 50, 100)
+    assert default_tick_sizes(0.01) == (0.1, 1, 2, 5, 10)
+    prices, amounts = bucket_levels(np.array([2500.01, 2500.04, 2500.06, 2500.12]), np.ones(4), 0.1)
+    assert prices.tolist() == [2500.0, 2500.1]
+    assert amounts.tolist() == [2, 2]
+
+def test_shared_book_skips_torn_writes():
+    book = OrderBook()
+    book.apply_levels('bid', np.array([99.9, 100.0]), np.array([1.0, 2.0]))
+    book.apply_levels('ask', np.array([100.1]), np.array([3.0]))
+    writer = SharedBookWriter(f"orderbook_test_{os.getpid()}", capacity=16)
+    try:
+        writer.publish(BookView.from_book(book, 1, 42))
+        reader = SharedBook(writer.memory.name, 'TEST', retries=10)
+        # Attached from the writer's own process: undo the reader's unregister
+        resource_tracker.register(writer.memory._name, 'shared_memory')
+        view = reader.view
+        assert view.version == 1 and view.last_update_id == 42
+        assert view.bid_prices.tolist() == [100.0, 99.9]
+        assert view.get_levels(1, 10)[0]['amount'].tolist() == [3.0]
+
+        # Sequence moved on without the trailer: a write still in progress
+        writer.publish(BookView.from_book(book, 2, 43))
+        writer.words[writer.layout.trailer] -= 2
+        reader.read()
+        assert reader.view.version == 1
+        writer.words[writer.layout.trailer] += 2
+        assert reader.view.version == 2
+        assert int(writer.words[SEQUENCE]) % 2 == 0
+    finally:
+        writer.close()
+
+def test_diffs_image_includes_diffs_after_the_view():
+    aggregator = OrderBookAggregator('BTCUSDT', publish_interval=60)
+    hub = StreamHub(aggregator)
+    aggregator.sync.on_snapshot(100)
+    aggregator.apply_diffs([{'b': [['100.0', '1']], 'a': [['100.1', '2'], ['100.3', '4']]}])
+    aggregator.publish(force=True)
+    # Applied but not published yet
+    aggregator.handle_messages([{'U': 101, 'u': 102, 'pu': 100, 'b': [['100.0', '5']], 'a': [['100.2', '1'], ['100.3', '0']]}])
+    assert aggregator.view.last_update_id == 100
+
+    channel = Channel(hub, hub.channel_key({'channel': 'diffs'}))
+    assert channel.image() == {'bid': {100.0: 5.0}, 'ask': {100.1: 2.0, 100.2: 1.0}}
+    assert json.loads(channel.encode('snapshot', channel.image()))['update_id'] == 102
+
+    aggregator.publish(force=True)
+    aggregator.handle_messages([{'U': 103, 'u': 103, 'pu': 102, 'b': [], 'a': [['100.1', '3']]}])
+    assert [message['u'] for message in hub.recent_diffs] == [103]
+
+def test_depth_index_matches_summed_bands():
+    # A small index window, so the mid drifts out of it and levels fall
+    # on both sides of it
+    rng = np.random.default_rng(5)
+    book = OrderBook(price_tick=0.1, index_size=64)
+    for step in range(300):
+        mid = 1000 + 10 * np.sin(step / 30)
+        for side, sign in (('bid', -1), ('ask', 1)):
+            prices = np.round(mid + sign * rng.integers(1, 80, 5) * 0.1, 1)
+            amounts = np.where(rng.random(5) < 0.3, 0.0, rng.uniform(0.1, 2, 5))
+            book.apply_levels(side, prices, amounts)
+        if step % 10 == 0:
+            mid_price = book.mid_price()
+            for depth in (1, 5, 25, 100, 10000):
+                for side in ('bid', 'ask'):
+                    prices, amounts = book.levels(side)
+                    inside = (prices <= mid_price * (1 + depth / 10000) if side == 'ask'
+                              else prices >= mid_price * (1 - depth / 10000))
+                    assert book.cumulative_volume(side, depth) == pytest.approx(amounts[inside].sum())
+
+def test_snapshot_rejects_empty_buckets():
+    aggregator = OrderBookAggregator('BTCUSDT', publish_interval=60)
+    aggregator.sync.on_snapshot(100)
+    aggregator.apply_diffs([{'b': [['100.0', '1']], 'a': [['100.1', '2']]}])
+    aggregator.publish(force=True)
+    routes = web.RouteTableDef()
+    add_book_routes(symbol_route(routes), lambda request: aggregator)
+    app = web.Application()
+    app.add_routes(routes)
+
+    async def statuses():
+        async with TestClient(TestServer(app)) as client:
+            return [(await client.get(path)).status
+                    for path in ('/snapshot/0/10', '/snapshot/0.0/10', '/snapshot/1/0', '/snapshot/1/10')]
+
+    assert asyncio.run(statuses()) == [400, 400, 400, 200]
+
+def combined_frame(symbol, first_id, final_id, bids=()):
+    diff = {'e': 'depthUpdate', 's': symbol, 'U': first_id, 'u': final_id, 'pu': first_id - 1, 'b': list(bids), 'a': []}
+    return json.dumps({'stream': f"{symbol.lower()}@depth@100ms", 'data': diff})
+
+def test_shard_queue_coalesces_per_symbol_and_resyncs_on_overflow():
+    async def run():
+        shard = ShardIngestor(['AAAUSDT', 'BBBUSDT'], None, queue_size=4)
+        resynced = []
+        for symbol, aggregator in shard.aggregators.items():
+            aggregator.resync = lambda symbol=symbol: resynced.append(symbol)
+        # Interleaved symbols, each contiguous: one merged diff per symbol
+        for update_id in (10, 11):
+            shard.queue.put(combined_frame('AAAUSDT', update_id, update_id, [['1.0', str(update_id)]]))
+            shard.queue.put(combined_frame('BBBUSDT', update_id + 100, update_id + 100))
+        assert [(diff['s'], diff['U'], diff['u']) for diff in shard.queue.items] == [
+            ('AAAUSDT', 10, 11), ('BBBUSDT', 110, 111)]
+        assert shard.queue.items[0]['b'] == [('1.0', '11')]
+
+        # Gaps in both symbols cannot be merged: the queue is dropped
+        for update_id in (20, 30):
+            shard.queue.put(combined_frame('AAAUSDT', update_id, update_id))
+        assert len(shard.queue) == 0 and shard.queue.dropped_frames == 4
+        assert resynced == ['AAAUSDT', 'BBBUSDT']
+
+    asyncio.run(run())
+
+def level_diff(first_id, final_id, previous_id, bids=(), asks=()):
+    return {**futures_diff(first_id, final_id, previous_id), 'b': list(bids), 'a': list(asks)}
+
+def test_coalesce_contiguous_diffs():
+    merged = coalesce_messages([
+        level_diff(10, 12, 9, [['1.0', '1']], [['2.0', '1']]),
+        level_diff(13, 15, 12, [['1.0', '0'], ['1.1', '3']]),
+        # pu does not chain to 15: a new run
+        level_diff(18, 20, 17, asks=[['2.0', '4']]),
+        level_diff(21, 21, 20, asks=[['2.1', '5']]),
+    ])
+    assert [(diff['U'], diff['u'], diff['pu']) for diff in merged] == [(10, 15, 9), (18, 21, 17)]
+    assert merged[0]['b'] == [('1.0', '0'), ('1.1', '3')]
+    assert merged[0]['a'] == [('2.0', '1')]
+    assert merged[1]['a'] == [('2.0', '4'), ('2.1', '5')]
+
+    # The merged diffs still chain for BookSync
+    sync = BookSync()
+    sync.on_snapshot(9)
+    assert sync.on_message(merged[0]) != []
+    with pytest.raises(SequenceGap):
+        sync.on_message(merged[1])
+
+def test_coalesce_spot_diffs_without_pu():
+    merged = coalesce_messages([spot_diff(10, 12), spot_diff(13, 14), spot_diff(16, 17)])
+    assert [(diff['U'], diff['u']) for diff in merged] == [(10, 14), (16, 17)]
+
+def test_ingest_queue_coalesces_when_full():
+    async def run():
+        overflows = []
+        queue = IngestQueue(maxsize=4, on_overflow=overflows.append)
+        for update_id in range(10, 14):
+            queue.put(json.dumps(level_diff(update_id, update_id, update_id - 1, [['1.0', str(update_id)]])))
+        assert len(queue) == 1 and queue.coalesced_frames == 3
+        queue.put(json.dumps(level_diff(14, 14, 13)))
+        batch = await queue.get_batch()
+        assert [(diff['U'], diff['u']) for diff in batch] == [(10, 13), (14, 14)]
+        assert batch[0]['b'] == [('1.0', '13')]
+        assert overflows == [] and len(queue) == 0
+
+    asyncio.run(run())
+
+def test_ingest_queue_overflow_clears_and_resyncs():
+    async def run():
+        aggregator = OrderBookAggregator('BTCUSDT', queue_size=4)
+        resyncs = []
+        aggregator.resync = lambda: resyncs.append(aggregator.symbol)
+        # Gaps between every diff: nothing merges
+        for update_id in (10, 20, 30, 40):
+            aggregator.queue.put(json.dumps(level_diff(update_id, update_id, update_id - 1)))
+        assert len(aggregator.queue) == 0
+        assert aggregator.queue.dropped_frames == 4
+        assert resyncs == ['BTCUSDT']
+        assert await aggregator.queue.get_batch() == []
+
+    asyncio.run(run())
+
+def test_array_engine_matches_tree_engine():
+    # The same random diffs on both engines. A small window and a drifting
+    # mid make the array engine recentre and keep far levels in overflow.
+    rng = np.random.default_rng(7)
+    tree, array = OrderBook(price_tick=0.1, index_size=128), ArrayOrderBook(price_tick=0.1, window=64)
+    recenters = set()
+    for step in range(400):
+        mid = 1000 + 15 * np.sin(step / 40)
+        for side, sign in (('bid', -1), ('ask', 1)):
+            offsets = rng.integers(1, 120, 6)
+            prices = np.round(mid + sign * offsets * 0.1, 1)
+            amounts = np.where(rng.random(6) < 0.3, 0.0, np.round(rng.uniform(0.1, 2, 6), 3))
+            if step % 2:
+                tree.apply_levels(side, prices, amounts)
+                array.apply_levels(side, prices, amounts)
+            else:
+                for price, amount in zip(prices.tolist(), amounts.tolist()):
+                    tree.update(side, price, amount)
+                    array.update(side, price, amount)
+        recenters.add(array.base)
+        assert array.best_prices() == tree.best_prices()
+        for side in ('bid', 'ask'):
+            tree_prices, tree_amounts = tree.levels(side)
+            array_prices, array_amounts = array.levels(side)
+            np.testing.assert_array_equal(array_prices, tree_prices)
+            np.testing.assert_array_equal(array_amounts, tree_amounts)
+            assert array.totals[side] == pytest.approx(tree.totals[side])
+            for depth in (1, 10, 100, 10000):
+                assert array.cumulative_volume(side, depth) == pytest.approx(tree.cumulative_volume(side, depth))
+    assert len(recenters) > 1
+    assert array.overflow['bid'] or array.overflow['ask']
+
+def test_checkpoint_round_trip_resumes_the_sequence(tmp_path):
+    path = str(tmp_path / 'BTCUSDT.book')
+    aggregator = OrderBookAggregator('BTCUSDT', publish_interval=60)
+    aggregator.sync.on_snapshot(100)
+    aggregator.apply_diffs([{'b': [['99.9', '1'], ['100.0', '2']], 'a': [['100.1', '3']]}])
+    aggregator.last_event_time = 1_700_000_000_000
+    aggregator.publish(force=True)
+    BookCheckpoint(path).save(aggregator.view)
+
+    restored = OrderBookAggregator('BTCUSDT', publish_interval=60, checkpoint_path=path)
+    assert restored.sync.state == BookSync.LIVE
+    assert restored.view.last_update_id == 100
+    assert restored.view.event_time == 1_700_000_000_000
+    for side in ('bid', 'ask'):
+        np.testing.assert_array_equal(restored.order_book.levels(side)[0], aggregator.order_book.levels(side)[0])
+        np.testing.assert_array_equal(restored.order_book.levels(side)[1], aggregator.order_book.levels(side)[1])
+    # The sequence carries on from the checkpoint, a gap still raises
+    assert restored.sync.on_message(futures_diff(99, 101, 100)) != []
+    with pytest.raises(SequenceGap):
+        restored.sync.on_message(futures_diff(105, 106, 104))
+
+def test_checkpoint_rejects_stale_or_corrupt_files(tmp_path):
+    path = str(tmp_path / 'BTCUSDT.book')
+    book = OrderBook()
+    book.apply_levels('bid', np.array([100.0]), np.array([1.0]))
+    book.apply_levels('ask', np.array([100.1]), np.array([1.0]))
+    BookCheckpoint(path).save(BookView.from_book(book, 1, 42))
+    assert BookCheckpoint(path).load()['last_update_id'] == 42
+    assert BookCheckpoint(path, max_age=0).load() is None
+
+    # Truncated: the sizes in the header no longer match the file
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 8)
+    assert BookCheckpoint(path).load() is None
+    assert OrderBookAggregator('BTCUSDT', checkpoint_path=path).sync.state == BookSync.BUFFERING
+
+    with open(path, 'wb') as f:
+        f.write(b'not a checkpoint' * 8)
+    assert BookCheckpoint(path).load() is None
+    assert BookCheckpoint(str(tmp_path / 'missing.book')).load() is None
+
+def test_book_view_cumulative_queries_and_side_levels():
+    book = OrderBook()
+    book.apply_levels('bid', np.array([99.0, 99.5, 99.9]), np.array([4.0, 2.0, 1.0]))
+    book.apply_levels('ask', np.array([100.1, 100.4, 101.2]), np.array([1.0, 3.0, 5.0]))
+    view = BookView.from_book(book, 1, 10)
+    # Bids from the best price down, cumulative from the touch
+    assert view.bid_prices.tolist() == [99.9, 99.5, 99.0]
+    assert view.bid_cumulative.tolist() == [1.0, 3.0, 7.0]
+    assert view.ask_cumulative.tolist() == [1.0, 4.0, 9.0]
+    assert view.totals == {'bid': 7.0, 'ask': 9.0}
+    assert not view.bid_cumulative.flags.writeable
+
+    # Mid 100.0: 50 bps reaches 99.5 and 100.5
+    assert view.cumulative_volume('bid', 50) == 3.0
+    assert view.cumulative_volume('ask', 50) == 4.0
+    assert view.cumulative_volume('ask', 1) == 0.0
+    assert view.fill_price('ask', 2.0) == 100.4
+    assert view.fill_price('bid', 7.0) == 99.0
+    assert view.fill_price('bid', 7.5) is None
+
+    prices, amounts = view.side_levels('bid', 1)
+    assert prices.tolist() == [99.0, 100.0] and amounts.tolist() == [4.0, 3.0]
+    prices, amounts = view.side_levels('ask', 1)
+    assert prices.tolist() == [100.0, 101.0] and amounts.tolist() == [4.0, 5.0]
+    # Kept with the view for later requests
+    assert view.side_levels('ask', 1)[0] is prices
+    ask_df, bid_df = view.get_levels(1, 50)
+    assert ask_df['price'].tolist() == [100.0] and bid_df['price'].tolist() == [100.0]
+
+    empty = BookView.empty()
+    assert empty.cumulative_volume('bid', 100) == 0.0
+    assert empty.get_levels(1, 10)[0].empty
+
+def shifted_view(shift):
+    book = OrderBook()
+    book.apply_levels('bid', np.array([97.0, 98.0, 99.0]) + shift, np.array([3.0, 2.0, 1.0]))
+    book.apply_levels('ask', np.array([101.0, 102.0, 108.0]) + shift, np.array([1.0, 1.0, 4.0]))
+    return BookView.from_book(book)
+
+def test_snapshot_history_rebuckets_and_thins_rows():
+    history = SnapshotHistory(tick_size=1, width=50, capacity=3)
+    for second, shift in enumerate((0, 10, 20, 30)):
+        assert history.record(second * 10 ** 6, shifted_view(shift))
+    assert not history.record(4 * 10 ** 6, BookView.empty())
+    # The oldest row was overwritten
+    assert len(history) == 3
+    assert history.query()['timestamp'].unique().tolist() == [10 ** 6, 2 * 10 ** 6, 3 * 10 ** 6]
+
+    df = history.query(start=10 ** 6, end=10 ** 6, tick_size=5)
+    levels = lambda side: dict(zip(df[df['side'] == side]['price'], df[df['side'] == side]['amount']))
+    # Bids 107 in the 105 bucket, 108 and 109 in the 110 one
+    assert levels('bid') == {105.0: 3.0, 110.0: 3.0}
+    assert levels('ask') == {110.0: 2.0, 120.0: 4.0}
+    assert df['amount'].sum() == 12.0
+
+    # One row per 2 s slot, the last of each, stamped with the slot start
+    thinned = history.query(resolution=2 * 10 ** 6)
+    assert thinned['timestamp'].unique().tolist() == [0, 2 * 10 ** 6]
+    assert thinned[thinned['timestamp'] == 0]['price'].min() == 107.0
+    assert thinned[thinned['timestamp'] == 2 * 10 ** 6]['price'].min() == 127.0
+
+    with pytest.raises(ValueError):
+        history.query(tick_size=1.5)
+
+def test_window_quantiles_match_numpy_over_the_window():
+    rng = np.random.default_rng(9)
+    quantiles = WindowQuantiles(window=10)
+    assert quantiles.quantile(0.8) is None
+    times = np.cumsum(rng.uniform(0.1, 2, 300))
+    values = rng.normal(size=300).round(2)  # with repeated values
+    for i, (now, value) in enumerate(zip(times, values)):
+        quantiles.push(now, value)
+        window = values[:i + 1][times[:i + 1] >= now - 10]
+        assert len(quantiles) == len(window)
+        for q in (0.0, 0.2, 0.8, 1.0):
+            assert quantiles.quantile(q) == pytest.approx(np.quantile(window, q))
+
+def test_metrics_render_and_merge_shard_states():
+    local, shard = Registry(), Registry()
+    for registry in (local, shard):
+        registry.histogram('apply_seconds', 'Apply time', ('symbol',), buckets=(0.001, 0.01))
+        registry.counter('resyncs_total', 'Resyncs', ('symbol',))
+    levels = local.gauge('levels', 'Levels per side', ('side',))
+    local.collectors.append(lambda: levels.set(3, 'bid'))
+    local.metrics['apply_seconds'].observe(0.0005, 'BTCUSDT')
+    local.metrics['apply_seconds'].observe(0.5, 'BTCUSDT')
+    local.metrics['resyncs_total'].inc('BTCUSDT')
+    shard.metrics['apply_seconds'].observe(0.005, 'BTCUSDT')
+    shard.metrics['resyncs_total'].inc('BTCUSDT', amount=2)
+    shard.metrics['resyncs_total'].inc('ETHUSDT')
+
+    # Shard states reach the HTTP process pickled through a queue
+    text = local.render([pickle.loads(pickle.dumps(shard.state()))])
+    assert text.splitlines() == [
+        '# HELP apply_seconds Apply time',
+        '# TYPE apply_seconds histogram',
+        'apply_seconds_bucket{symbol="BTCUSDT",le="0.001"} 1',
+        'apply_seconds_bucket{symbol="BTCUSDT",le="0.01"} 2',
+        'apply_seconds_bucket{symbol="BTCUSDT",le="+Inf"} 3',
+        'apply_seconds_sum{symbol="BTCUSDT"} 0.5055',
+        'apply_seconds_count{symbol="BTCUSDT"} 3',
+        '# HELP resyncs_total Resyncs',
+        '# TYPE resyncs_total counter',
+        'resyncs_total{symbol="BTCUSDT"} 3',
+        'resyncs_total{symbol="ETHUSDT"} 1',
+        '# HELP levels Levels per side',
+        '# TYPE levels gauge',
+        'levels{side="bid"} 3',
+    ]
+    # Rendering does not fold the shard series into the local ones
+    assert local.metrics['resyncs_total'].series == {('BTCUSDT',): 1}
+    assert Registry().render() == '\n'
+
+def test_analytics_bands_and_slopes():
+    aggregator = OrderBookAggregator('BTCUSDT', price_tick=0.01, publish_interval=60)
+    analytics = OrderFlowAnalytics(aggregator, top_levels=3, bands=(1, 5, 50, 100))
+    aggregator.sync.on_snapshot(100)
+    aggregator.handle_messages([{'U': 101, 'u': 101, 'pu': 100,
+                                 'b': [['99.99', '1'], ['99.95', '2'], ['99.50', '4']],
+                                 'a': [['100.01', '1'], ['100.05', '3'], ['101.00', '5']]}])
+    # The best bid grows by 2, the best ask shrinks by 0.5
+    aggregator.handle_messages([{'U': 102, 'u': 102, 'pu': 101, 'b': [['99.99', '3']], 'a': [['100.01', '0.5']]}])
+    first, second = ({field: values[row] for field, values in analytics.columns().items()} for row in (0, 1))
+
+    # Mid 100: the bands reach 99.99/100.01, 99.95/100.05, 99.5/100.5, 99/101
+    assert [first[f'bid_{band}'] for band in (1, 5, 50, 100)] == [1, 3, 7, 7]
+    assert [first[f'ask_{band}'] for band in (1, 5, 50, 100)] == [1, 4, 4, 9]
+    bands = np.array([1, 5, 50, 100])
+    assert first['bid_slope'] == pytest.approx(bands @ [1, 3, 7, 7] / (bands @ bands))
+    assert first['ask_slope'] == pytest.approx(bands @ [1, 4, 4, 9] / (bands @ bands))
+    assert first['mid'] == pytest.approx(100.0) and first['microprice'] == pytest.approx(100.0)
+    assert first['spread'] == pytest.approx(0.02)
+    assert first['top_imbalance'] == pytest.approx((7 - 9) / 16)
+    assert first['ofi'] == 0
+
+    assert second['ofi_best'] == pytest.approx(2 + 0.5)
+    assert second['ofi'] == pytest.approx(2.5)
+    assert second['microprice'] == pytest.approx((99.99 * 0.5 + 100.01 * 3) / 3.5)
+    assert second['bid_1'] == 3 and second['ask_1'] == 0.5
+
+def test_clean_closes_count_as_reconnects(monkeypatch):
+    class Connection:
+        async def __aenter__(self):
+            return self
+        async def __aexit__(self, *exc_info):
+            return False
+
+    monkeypatch.setattr(orderbook_aggregator.websockets, 'connect', lambda *args, **kwargs: Connection())
+    aggregator = OrderBookAggregator('RECONNECTUSDT')
+    closes = []
+
+    async def listen():
+        # The server closes the first two connections, the third is cancelled
+        closes.append(None)
+        if len(closes) == 3:
+            raise asyncio.CancelledError
+    aggregator.listen = listen
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(aggregator.connect())
+    assert RECONNECTS.series[('RECONNECTUSDT',)] == 2